@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+Фейковые объекты для офлайн-бенчмарков: каналы, ветки форумов, сообщения, эмбеды и вложения Discord,
+CDN с картинками и заглушка Gemini с настраиваемой задержкой и длиной ответа.
+Никаких сетевых запросов: все, что бот обычно получает от Discord и Gemini, генерируется здесь.
+"""
+import asyncio
+import io
+import itertools
+import random
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import discord
+from PIL import Image
+
+# Размер сегодняшнего архива (file.txt ~450 КБ): 10 каналов, из них 3 форума с 19 публикациями,
+# около 300 сообщений и 150 картинок. Масштаб N умножает число сообщений и публикаций.
+BASE_TEXT_CHANNELS = 7
+BASE_MESSAGES_PER_TEXT_CHANNEL = 25
+BASE_FORUM_CHANNELS = 3
+BASE_THREADS_PER_FORUM = 6
+BASE_MESSAGES_PER_THREAD = 7
+IMAGE_PROBABILITY = 0.4
+EMBED_PROBABILITY = 0.2
+MENTION_PROBABILITY = 0.3
+HISTORY_PAGE_SIZE = 100
+
+WORDS = (
+    "Вальдес город гильдия страж маг архив хроника клинок торговец порт север юг "
+    "империя совет орден тень огонь река мост храм рыцарь наемник алхимик зелье "
+    "трактир сплетня король королева наследник заговор восстание караван пустошь "
+    "руины дракон артефакт ритуал печать закон налог рынок квартал башня стена"
+).split()
+
+
+class SnowflakeSource:
+    """Монотонные ID, как у Discord: более новые объекты имеют больший ID."""
+
+    def __init__(self, start: int = 10 ** 17):
+        self._counter = itertools.count(start)
+
+    def __call__(self) -> int:
+        return next(self._counter)
+
+
+class FakeRole:
+    def __init__(self, role_id: int, name: str):
+        self.id = role_id
+        self.name = name
+
+
+class FakeUser:
+    def __init__(self, user_id: int, display_name: str):
+        self.id = user_id
+        self.display_name = display_name
+        self.name = display_name
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, roles: dict):
+        self.id = guild_id
+        self._roles = roles
+
+    def get_role(self, role_id: int):
+        return self._roles.get(role_id)
+
+
+class FakeEmbed:
+    def __init__(self, title=None, description=None, image_url=None, fields=()):
+        self.title = title
+        self.description = description
+        self.image = SimpleNamespace(url=image_url) if image_url else None
+        self.fields = [SimpleNamespace(name=name, value=value) for name, value in fields]
+
+
+class FakeAttachment:
+    def __init__(self, url: str, content_type: str = "image/png"):
+        self.url = url
+        self.content_type = content_type
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, author: FakeUser, content: str, embeds=(), attachments=()):
+        self.id = message_id
+        self.author = author
+        self.created_at = discord.utils.snowflake_time(message_id)
+        self.content = content
+        self.embeds = list(embeds)
+        self.attachments = list(attachments)
+
+
+class FakeMessageable:
+    """history() отдает сообщения страницами по 100 с задержкой page_latency, как HTTP API Discord."""
+
+    def __init__(self, messages: list, page_latency: float):
+        self.messages = messages
+        self.page_latency = page_latency
+
+    @property
+    def last_message_id(self):
+        return self.messages[-1].id if self.messages else None
+
+    def history(self, limit=100, oldest_first=False, after=None):
+        async def pages():
+            selected = [m for m in self.messages if after is None or m.id > after.id]
+            if not oldest_first:
+                selected.reverse()
+            if limit is not None:
+                selected = selected[:limit]
+            for offset in range(0, len(selected), HISTORY_PAGE_SIZE):
+                if self.page_latency:
+                    await asyncio.sleep(self.page_latency)
+                for message in selected[offset:offset + HISTORY_PAGE_SIZE]:
+                    yield message
+        return pages()
+
+
+class FakeTextChannel(FakeMessageable):
+    def __init__(self, channel_id: int, name: str, position: int, guild: FakeGuild, messages: list, page_latency: float):
+        super().__init__(messages, page_latency)
+        self.id = channel_id
+        self.name = name
+        self.position = position
+        self.guild = guild
+
+
+class FakeThread(FakeMessageable):
+    def __init__(self, thread_id: int, name: str, created_at: datetime, messages: list, page_latency: float):
+        super().__init__(messages, page_latency)
+        self.id = thread_id
+        self.name = name
+        self.created_at = created_at
+        self.archive_timestamp = created_at
+
+
+class FakeForumChannel(discord.ForumChannel):
+    """Наследник ForumChannel, чтобы проходить isinstance-проверку в parse_channel_content."""
+    threads = None  # перекрываем свойство discord.py обычным атрибутом
+
+    def __init__(self, channel_id: int, name: str, position: int, guild: FakeGuild,
+                 active_threads: list, archived_threads: list, page_latency: float):
+        self.id = channel_id
+        self.name = name
+        self.position = position
+        self.guild = guild
+        self.threads = active_threads
+        self.last_message_id = None
+        self._archived = archived_threads
+        self._page_latency = page_latency
+
+    def archived_threads(self, limit=None):
+        async def listing():
+            ordered = sorted(self._archived, key=lambda t: t.archive_timestamp, reverse=True)
+            for offset in range(0, len(ordered), 50):
+                if self._page_latency:
+                    await asyncio.sleep(self._page_latency)
+                for thread in ordered[offset:offset + 50]:
+                    yield thread
+        return listing()
+
+
+class FakeArchive:
+    """Синтетический архив лора заданного масштаба и справочники для разрешения упоминаний."""
+
+    def __init__(self, channels: list, guild: FakeGuild, users: dict, channels_by_id: dict, message_count: int, image_count: int):
+        self.channels = channels
+        self.guild = guild
+        self.users = users
+        self.channels_by_id = channels_by_id
+        self.message_count = message_count
+        self.image_count = image_count
+
+    def get_channel(self, channel_id: int):
+        return self.channels_by_id.get(channel_id)
+
+    def get_user(self, user_id: int):
+        return self.users.get(user_id)
+
+
+def make_paragraphs(rng: random.Random, count: int, words_per_paragraph=(30, 110)) -> list:
+    paragraphs = []
+    for _ in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(*words_per_paragraph))]
+        words[0] = words[0].capitalize()
+        paragraphs.append(" ".join(words) + ".")
+    return paragraphs
+
+
+def mention_heavy_text(archive: FakeArchive, rng: random.Random, mentions: int) -> str:
+    """Текст, в котором каждое третье слово — упоминание пользователя, роли или канала (часть не разрешается)."""
+    user_ids = list(archive.users)
+    role_ids = list(archive.guild._roles)
+    channel_ids = list(archive.channels_by_id)
+    parts = []
+    for _ in range(mentions):
+        kind = rng.randrange(4)
+        if kind == 0:
+            parts.append(f"<@{rng.choice(user_ids)}>")
+        elif kind == 1:
+            parts.append(f"<@!{rng.choice(user_ids)}>")
+        elif kind == 2:
+            parts.append(f"<@&{rng.choice(role_ids)}>")
+        else:
+            parts.append(f"<#{rng.choice(channel_ids + [1])}>")
+        parts.append(f"{rng.choice(WORDS)} {rng.choice(WORDS)}")
+    return " ".join(parts)
+
+
+def build_archive(scale: int, seed: int = 1, page_latency: float = 0.0) -> FakeArchive:
+    rng = random.Random(seed)
+    snowflake = SnowflakeSource()
+    paragraphs = make_paragraphs(rng, 300)
+    users = {snowflake(): FakeUser(0, f"Игрок{i}") for i in range(50)}
+    for user_id, user in users.items():
+        user.id = user_id
+    roles = {}
+    for i in range(10):
+        role_id = snowflake()
+        roles[role_id] = FakeRole(role_id, f"Роль{i}")
+    guild = FakeGuild(snowflake(), roles)
+    channels_by_id = {}
+    counters = {'messages': 0, 'images': 0}
+    authors = list(users.values())
+
+    def make_message() -> FakeMessage:
+        counters['messages'] += 1
+        content = "\n\n".join(rng.sample(paragraphs, rng.randint(1, 2)))
+        if rng.random() < MENTION_PROBABILITY:
+            content += f" <@{rng.choice(list(users))}> <@&{rng.choice(list(roles))}>"
+            if channels_by_id:
+                content += f" <#{rng.choice(list(channels_by_id))}>"
+        embeds, attachments = [], []
+        if rng.random() < EMBED_PROBABILITY:
+            image_url = None
+            if rng.random() < IMAGE_PROBABILITY:
+                counters['images'] += 1
+                image_url = f"https://cdn.discordapp.com/attachments/{snowflake()}/{snowflake()}/art.png"
+            embeds.append(FakeEmbed(title=rng.choice(WORDS).capitalize(), description=rng.choice(paragraphs),
+                                    image_url=image_url, fields=[(rng.choice(WORDS), rng.choice(paragraphs)[:200])]))
+        if rng.random() < IMAGE_PROBABILITY:
+            counters['images'] += 1
+            attachments.append(FakeAttachment(f"https://cdn.discordapp.com/attachments/{snowflake()}/{snowflake()}/image.png"))
+        # Автор выбирается без обращения к rng, чтобы содержимое архива при том же seed не менялось
+        author = authors[counters['messages'] % len(authors)]
+        return FakeMessage(snowflake(), author, content, embeds, attachments)
+
+    channels = []
+    position = 0
+    for i in range(BASE_TEXT_CHANNELS):
+        channel = FakeTextChannel(snowflake(), f"лор-{i}", position, guild,
+                                  [make_message() for _ in range(BASE_MESSAGES_PER_TEXT_CHANNEL * scale)], page_latency)
+        channels_by_id[channel.id] = channel
+        channels.append(channel)
+        position += 1
+    created = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(BASE_FORUM_CHANNELS):
+        threads = []
+        for j in range(BASE_THREADS_PER_FORUM * scale):
+            created += timedelta(hours=1)
+            threads.append(FakeThread(snowflake(), f"Публикация {i}-{j}", created,
+                                      [make_message() for _ in range(BASE_MESSAGES_PER_THREAD)], page_latency))
+        # Часть публикаций активна, остальные в архиве
+        split = len(threads) // 3
+        forum = FakeForumChannel(snowflake(), f"форум-{i}", position, guild, threads[:split], threads[split:], page_latency)
+        channels_by_id[forum.id] = forum
+        channels.append(forum)
+        position += 1
+    return FakeArchive(channels, guild, users, channels_by_id, counters['messages'], counters['images'])
+
+
+def make_image_pool(count: int = 32, size=(640, 480)) -> list:
+    """Небольшой набор разных PNG: CDN отдает их по кругу, как повторяющиеся арты в реальном архиве."""
+    rng = random.Random(7)
+    pool = []
+    for _ in range(count):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, tuple(rng.randrange(256) for _ in range(3))).save(buffer, 'PNG')
+        pool.append(buffer.getvalue())
+    return pool
+
+
+class FakeCDNResponse:
+    def __init__(self, body: bytes, url: str, latency: float):
+        self.status = 200
+        self.headers = {'Content-Type': 'image/png', 'ETag': f'"{hash(url)}"'}
+        self._body = body
+        self._latency = latency
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def __aenter__(self):
+        if self._latency:
+            await asyncio.sleep(self._latency)
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeCDNSession:
+    """Замена aiohttp.ClientSession для скачивания картинок лора."""
+
+    def __init__(self, image_pool: list, latency: float = 0.0):
+        self.image_pool = image_pool
+        self.latency = latency
+        self.requests = 0
+
+    def get(self, url: str, headers=None, **kwargs):
+        self.requests += 1
+        return FakeCDNResponse(self.image_pool[hash(url) % len(self.image_pool)], url, self.latency)
+
+
+class StubUsage:
+    def __init__(self, prompt_tokens: int, response_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = response_tokens
+        self.cached_content_token_count = 0
+        self.thoughts_token_count = 0
+        self.total_token_count = prompt_tokens + response_tokens
+
+
+class StubChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class StubResponse:
+    """Ответ заглушки; в потоковом режиме итерируется чанками с задержкой между ними."""
+
+    def __init__(self, chunks: list, usage: StubUsage, chunk_delays: list = None):
+        self._chunks = chunks
+        self._chunk_delays = chunk_delays or []
+        self.text = "".join(chunks)
+        self.usage_metadata = usage
+
+    async def __aiter__(self):
+        for chunk, delay in zip(self._chunks, self._chunk_delays):
+            if delay:
+                await asyncio.sleep(delay)
+            yield StubChunk(chunk)
+
+
+class StubGeminiModel:
+    """
+    Заглушка модели с интерфейсом generate_content_async. latency — полное время генерации,
+    first_chunk_latency — время до первого чанка в потоковом режиме, output_tokens — длина ответа.
+    Ответ содержит теги [IMAGE_n] и блок %%SOURCES%%, как настоящие ответы /ask_lore.
+    """
+
+    def __init__(self, latency: float = 0.0, first_chunk_latency: float = None, output_tokens: int = 400,
+                 chunk_tokens: int = 20, image_ids=("IMAGE_1",), seed: int = 3):
+        self.latency = latency
+        self.first_chunk_latency = latency / 4 if first_chunk_latency is None else first_chunk_latency
+        self.output_tokens = output_tokens
+        self.chunk_tokens = chunk_tokens
+        self.image_ids = image_ids
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    @staticmethod
+    def _prompt_tokens(contents) -> int:
+        if isinstance(contents, str):
+            return len(contents) // 3 + 1
+        if isinstance(contents, (list, tuple)):
+            return sum(StubGeminiModel._prompt_tokens(part) for part in contents)
+        return 258  # картинка
+
+    def _answer_tokens(self) -> list:
+        tokens = [self.rng.choice(WORDS) + " " for _ in range(self.output_tokens)]
+        for image_id in self.image_ids:
+            tokens.insert(self.rng.randrange(len(tokens) + 1), f"[{image_id}] ")
+        tokens.append("\n%%SOURCES%%\n")
+        tokens.append("Канал: лор-0, Публикация: Публикация 0-0")
+        return tokens
+
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs):
+        self.calls += 1
+        tokens = self._answer_tokens()
+        usage = StubUsage(self._prompt_tokens(contents), self.output_tokens)
+        if not stream:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return StubResponse(["".join(tokens)], usage)
+        chunks = ["".join(tokens[i:i + self.chunk_tokens]) for i in range(0, len(tokens), self.chunk_tokens)]
+        rest = max(0.0, self.latency - self.first_chunk_latency) / max(1, len(chunks) - 1)
+        delays = [self.first_chunk_latency] + [rest] * (len(chunks) - 1)
+        return StubResponse(chunks, usage, delays)
+
+
+class FakeWebhookMessage:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def edit(self, **kwargs):
+        self.interaction.edits += 1
+
+    async def delete(self):
+        pass
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, *args, **kwargs):
+        interaction = self.interaction
+        if interaction.first_send_at is None:
+            interaction.first_send_at = asyncio.get_running_loop().time()
+        interaction.sends += 1
+        return FakeWebhookMessage(interaction)
+
+
+class FakeInteractionResponse:
+    async def defer(self, **kwargs):
+        pass
+
+    async def send_message(self, *args, **kwargs):
+        pass
+
+
+class FakeInteraction:
+    """Минимальное взаимодействие для вызова обработчиков команд через .callback()."""
+
+    def __init__(self, user_id: int = 1, guild_id: int = 1):
+        self.user = FakeUser(user_id, "Бенчмарк")
+        self.guild_id = guild_id
+        self.created_at = datetime.now(timezone.utc)
+        self.response = FakeInteractionResponse()
+        self.followup = FakeFollowup(self)
+        self.first_send_at = None
+        self.sends = 0
+        self.edits = 0
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Офлайн-бенчмарки бота: сбор лора (parse_channel_content) на 1×/10×/100× от размера текущего архива,
+clean_discord_mentions на тексте с большим числом упоминаний, построение снимка лора и промптов,
+/ask_lore от начала до конца на заглушке Gemini и операции хранилища персонажей.
+Discord и Gemini заменены фейками из benchmarks/fakes.py, сеть не используется, все файлы пишутся
+во временный каталог. Результат — JSON, который удобно сравнивать между коммитами.
+
+Запуск из корня репозитория:
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --scales 1,10 --only parse,mentions
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# main.py требует эти переменные при импорте; реальные значения не нужны, запросов в сеть не будет
+for variable in ("DISCORD_TOKEN", "GEMINI_API_KEY", "MAIN_GUILD_ID", "ADMIN_GUILD_ID", "CODE_CHANNEL_ID",
+                 "OWNER_USER_ID", "LORE_CHANNEL_IDS", "GOSSIP_CHANNEL_ID"):
+    os.environ.setdefault(variable, "1")
+os.environ["GEMINI_CONTEXT_CACHE"] = "false"
+
+import main  # noqa: E402
+from fakes import (FakeCDNSession, FakeInteraction, StubGeminiModel, WORDS,  # noqa: E402
+                   build_archive, make_image_pool, mention_heavy_text)
+
+BENCHMARKS = ("parse", "mentions", "prompt", "ask_lore", "characters")
+
+
+def summarize(samples: list) -> dict:
+    ordered = sorted(samples)
+    return {
+        'runs': len(ordered),
+        'min': ordered[0],
+        'median': statistics.median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        'max': ordered[-1],
+        'mean': statistics.fmean(ordered),
+    }
+
+
+def time_calls(func, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        started = perf_counter()
+        func()
+        samples.append(perf_counter() - started)
+    return summarize(samples)
+
+
+def use_archive_lookups(archive):
+    """clean_discord_mentions разрешает каналы и пользователей через кэш бота — подменяем его архивом."""
+    main.bot.get_channel = archive.get_channel
+    main.bot.get_user = archive.get_user
+
+
+async def bench_parse(scales: list, repeat: int, page_latency: float, cdn_latency: float) -> tuple:
+    image_pool = make_image_pool()
+    results = {}
+    baseline = None
+    for scale in scales:
+        archive = build_archive(scale, page_latency=page_latency)
+        use_archive_lookups(archive)
+        samples, first_run = [], None
+        for _ in range(repeat):
+            main.LORE_IMAGE_STORE.load()
+            session = FakeCDNSession(image_pool, cdn_latency)
+            archive_output = main.LoreArchiveWriter(main.LORE_ARCHIVE_FILE, main.LORE_ARCHIVE_INDEX_FILE)
+            deduplicator = main.LoreDeduplicator()
+            started = perf_counter()
+            text, messages, _, image_map, manifest = await main.parse_channel_content(
+                archive.channels, session, archive_output=archive_output, deduplicator=deduplicator)
+            elapsed = perf_counter() - started
+            first_run = elapsed if first_run is None else first_run
+            samples.append(elapsed)
+            # Как в update_lore: архив и индекс хранилища сохраняются после сбора, следующий сбор их переиспользует
+            main.commit_lore_artifacts(archive_output.staged_files())
+            main.LORE_IMAGE_STORE.save()
+
+        # Повторный сбор без новых сообщений: инкрементальный путь по манифесту и прошлому архиву
+        main.LORE_IMAGE_STORE.load()
+        previous_archive = main.LoreArchive.open(main.LORE_ARCHIVE_FILE, main.LORE_ARCHIVE_INDEX_FILE)
+        archive_output = main.LoreArchiveWriter(main.LORE_ARCHIVE_FILE, main.LORE_ARCHIVE_INDEX_FILE)
+        started = perf_counter()
+        await main.parse_channel_content(archive.channels, FakeCDNSession(image_pool, cdn_latency),
+                                         previous_archive=previous_archive, previous_manifest=manifest,
+                                         archive_output=archive_output, deduplicator=main.LoreDeduplicator())
+        incremental = perf_counter() - started
+        archive_output.discard()
+        previous_archive.close()
+
+        timing = summarize(samples)
+        text_bytes = len(text.encode('utf-8'))
+        results[f"{scale}x"] = {
+            'seconds': timing,
+            'first_run_seconds': first_run,
+            'incremental_noop_seconds': incremental,
+            'messages': messages,
+            'images': len(image_map),
+            'output_bytes': text_bytes,
+            'messages_per_second': messages / timing['median'],
+            'images_per_second': len(image_map) / timing['median'],
+            'megabytes_per_second': text_bytes / timing['median'] / 1e6,
+            'dedup': deduplicator.stats(),
+        }
+        print(f"parse {scale}x: {messages} сообщений, {timing['median']:.3f} с", file=sys.stderr)
+        if baseline is None:
+            baseline = (text, image_map)
+    return results, baseline
+
+
+def bench_mentions(repeat: int) -> dict:
+    archive = build_archive(1)
+    use_archive_lookups(archive)
+    rng = random.Random(11)
+    results = {}
+    for name, text in (('mention_heavy', mention_heavy_text(archive, rng, 2000)),
+                       ('typical_message', archive.channels[0].messages[0].content)):
+        timing = time_calls(lambda: main.clean_discord_mentions(text, archive.guild), repeat)
+        results[name] = {
+            'seconds': timing,
+            'input_bytes': len(text.encode('utf-8')),
+            'megabytes_per_second': len(text.encode('utf-8')) / timing['median'] / 1e6,
+        }
+    return results
+
+
+def write_lore_files(lore_text: str, image_map: dict):
+    with open(main.LORE_FILE, 'w', encoding='utf-8') as f:
+        f.write(lore_text)
+    with open(main.GOSSIP_FILE, 'w', encoding='utf-8') as f:
+        f.write(lore_text[:20000])
+    with open(main.IMAGE_MAP_FILE, 'w', encoding='utf-8') as f:
+        json.dump(image_map, f)
+
+
+def sample_questions(count: int, seed: int = 5) -> list:
+    rng = random.Random(seed)
+    return [f"Что известно про {rng.choice(WORDS)} и {rng.choice(WORDS)} в {rng.choice(WORDS)}? #{i}" for i in range(count)]
+
+
+def index_questions(index, count: int, seed: int = 5) -> list:
+    """
+    Вопросы о конкретных фрагментах лора: самые редкие слова фрагмента, как их написал бы игрок.
+    Берутся только слова, которые встречаются не больше чем в десятой части фрагментов: общие слова
+    синтетического лора есть почти везде и не дают поиску уверенности, вопрос из них ушел бы в полный лор.
+    """
+    rng = random.Random(seed)
+    distinctive = max(2, len(index.passages) // 10)
+    questions = []
+    for _ in range(count * 10):
+        if len(questions) == count:
+            break
+        passage = rng.choice(index.passages)
+        frequency = {}
+        for word in re.findall(r'\w+', passage.text):
+            tokens = main.tokenize_lore_text(word)
+            if tokens and len(index.postings.get(tokens[0], ())) <= distinctive:
+                frequency.setdefault(word, len(index.postings[tokens[0]]))
+        rare = sorted(frequency, key=frequency.get)[:3]
+        if len(rare) >= 2:
+            questions.append(f"Что известно про {', '.join(rare[:-1])} и {rare[-1]}?")
+    return questions
+
+
+def bench_prompt(repeat: int) -> dict:
+    snapshot_timing = time_calls(lambda: main.build_lore_snapshot(None), max(1, repeat // 5))
+    main.install_lore_snapshot(main.build_lore_snapshot(None))
+    snapshot = main.LORE_SNAPSHOT
+    questions = index_questions(snapshot.index, 20)
+    contexts = [main.select_lore_context(snapshot.index, question) for question in questions]
+    context = next((c for c in contexts if c is not None), "")
+    character = {'name': 'Бенчмарк', 'description': " ".join(WORDS) * 20}
+    return {
+        'lore_snapshot_build': {'seconds': snapshot_timing, 'passages': len(snapshot.index.passages)},
+        'select_lore_context': {
+            'seconds': time_calls(lambda: [main.select_lore_context(snapshot.index, q) for q in questions], repeat),
+            'questions_per_call': len(questions),
+            'fallback_to_full_context': sum(c is None for c in contexts),
+        },
+        'build_prompt_retrieved': {
+            'seconds': time_calls(lambda: snapshot.build_prompt('serious', context), repeat),
+            'prompt_bytes': len(snapshot.build_prompt('serious', context).encode('utf-8')),
+        },
+        'build_prompt_full': {
+            'seconds': time_calls(lambda: snapshot.build_prompt('edgy'), repeat),
+            'prompt_bytes': len(snapshot.build_prompt('edgy').encode('utf-8')),
+        },
+        'optimizer_prompt': {
+            'seconds': time_calls(lambda: main.get_optimizer_prompt("Стандартная оптимизация", character), repeat),
+        },
+    }
+
+
+async def bench_ask_lore(requests: int, concurrency: int, llm_latency: float, first_chunk_latency: float, output_tokens: int) -> dict:
+    model = StubGeminiModel(latency=llm_latency, first_chunk_latency=first_chunk_latency, output_tokens=output_tokens)
+    main.gemini_model = model
+
+    async def full_context_model(self, personality):
+        return model
+    main.LoreSnapshot.get_full_context_model = full_context_model
+    # Лимиты диспетчера не должны влиять на замер: это отдельный механизм со своим временем ожидания
+    main.GEMINI_DISPATCHER = main.GeminiDispatcher(max(concurrency, 1), 1e9, 10 ** 6, 1e9, 10 ** 6, 0, 0.0, 0.0)
+
+    async def one_request(question: str, user_id: int) -> tuple:
+        interaction = FakeInteraction(user_id=user_id)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await main.ask_lore.callback(interaction, question)
+        return loop.time() - started, (interaction.first_send_at or loop.time()) - started
+
+    results = {}
+    questions = iter(sample_questions(requests * 2 + concurrency + 1, seed=17))
+    for mode, streaming in (('streaming', True), ('buffered', False)):
+        main.STREAMING_RESPONSES = streaming
+        totals, first_visible = [], []
+        for i in range(requests):
+            total, first = await one_request(next(questions), i + 1)
+            totals.append(total)
+            first_visible.append(first)
+        results[mode] = {'total_seconds': summarize(totals), 'first_visible_seconds': summarize(first_visible)}
+
+    question = next(questions)
+    await one_request(question, 1)
+    cached = [(await one_request(question, 1))[0] for _ in range(requests)]
+    results['cached'] = {'total_seconds': summarize(cached)}
+
+    main.STREAMING_RESPONSES = True
+    batch = [next(questions) for _ in range(concurrency)]
+    started = perf_counter()
+    outcomes = await asyncio.gather(*(one_request(q, i + 1) for i, q in enumerate(batch)))
+    elapsed = perf_counter() - started
+    results['concurrent'] = {
+        'requests': len(batch),
+        'wall_seconds': elapsed,
+        'requests_per_second': len(batch) / elapsed,
+        'total_seconds': summarize([total for total, _ in outcomes]),
+    }
+    results['stub'] = {'latency': llm_latency, 'first_chunk_latency': first_chunk_latency, 'output_tokens': output_tokens, 'calls': model.calls}
+    return results
+
+
+def bench_characters(users: int, per_user: int) -> dict:
+    store = main.CharacterStore(os.path.join(os.getcwd(), "bench_characters.db"))
+    store.open()
+    user_ids = [str(10 ** 17 + i) for i in range(users)]
+    names = [f"Персонаж {j}" for j in range(per_user)]
+    description = " ".join(WORDS) * 5
+    operations = {}
+
+    def run(name: str, func, count: int):
+        started = perf_counter()
+        func()
+        elapsed = perf_counter() - started
+        operations[name] = {'operations': count, 'seconds': elapsed, 'operations_per_second': count / elapsed}
+
+    run('add_character', lambda: [store.add_character(u, n, description, None) for u in user_ids for n in names], users * per_user)
+    run('get_characters', lambda: [store.get_characters(u) for u in user_ids for _ in range(per_user)], users * per_user)
+    run('get_active_character', lambda: [store.get_active_character(u) for u in user_ids for _ in range(per_user)], users * per_user)
+    run('select_character', lambda: [store.select_character(u, n) for u in user_ids for n in names], users * per_user)
+    # Как в character_name_autocomplete: индекс строится один раз, затем поиск на каждое нажатие клавиши
+    queries = ["", "пер", "персонаж 1", "прсонаж", "ж 4"]
+    run('autocomplete', lambda: [store.load_name_index(u).search(q) for u in user_ids for q in queries for _ in range(per_user)],
+        users * per_user * len(queries))
+    run('set_description', lambda: [store.set_description(u, n, description[::-1]) for u in user_ids for n in names], users * per_user)
+    run('delete_character', lambda: [store.delete_character(u, n) for u in user_ids for n in names], users * per_user)
+    return operations
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_all(args) -> dict:
+    selected = set(args.only.split(",")) if args.only else set(BENCHMARKS)
+    results = {}
+    scales = [int(s) for s in args.scales.split(",")]
+    baseline = None
+    if selected & {"parse", "prompt", "ask_lore"}:
+        parse_results, baseline = await bench_parse(scales if "parse" in selected else [1], args.repeat,
+                                                    args.page_latency, args.cdn_latency)
+        if "parse" in selected:
+            results['parse_channel_content'] = parse_results
+        write_lore_files(*baseline)
+    if "mentions" in selected:
+        results['clean_discord_mentions'] = bench_mentions(args.repeat * 10)
+    if "prompt" in selected:
+        results['prompt_build'] = bench_prompt(args.repeat * 10)
+    if "ask_lore" in selected:
+        if main.LORE_SNAPSHOT is None:
+            main.install_lore_snapshot(main.build_lore_snapshot(None))
+        results['ask_lore'] = await bench_ask_lore(args.requests, args.concurrency, args.llm_latency,
+                                                   args.llm_first_chunk, args.llm_tokens)
+    if "characters" in selected:
+        results['character_store'] = bench_characters(args.users, args.characters_per_user)
+    await asyncio.gather(*main.BACKGROUND_TASKS, return_exceptions=True)
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки бота Вальдеса (без Discord и Gemini).")
+    parser.add_argument("--output", help="Куда записать JSON (по умолчанию stdout).")
+    parser.add_argument("--only", help=f"Через запятую: {','.join(BENCHMARKS)}.")
+    parser.add_argument("--scales", default="1,10,100", help="Масштабы архива относительно текущего.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--page-latency", type=float, default=0.0, help="Задержка фейкового Discord на страницу истории, с.")
+    parser.add_argument("--cdn-latency", type=float, default=0.0, help="Задержка фейкового CDN на картинку, с.")
+    parser.add_argument("--requests", type=int, default=10, help="Число последовательных запросов /ask_lore на режим.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Число одновременных запросов /ask_lore.")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Полное время ответа заглушки Gemini, с.")
+    parser.add_argument("--llm-first-chunk", type=float, default=0.25, help="Время до первого чанка заглушки, с.")
+    parser.add_argument("--llm-tokens", type=int, default=400, help="Длина ответа заглушки в токенах.")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--characters-per-user", type=int, default=10)
+    args = parser.parse_args()
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    with tempfile.TemporaryDirectory(prefix="valdes-bench-") as workdir:
+        os.chdir(workdir)
+        # Логи бота уходят в stderr, чтобы stdout оставался чистым JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            results = asyncio.run(run_all(args))
+            if main.IMAGE_PROCESS_POOL is not None:
+                main.IMAGE_PROCESS_POOL.shutdown()
+        os.chdir(REPO_ROOT)
+
+    report = {
+        'meta': {
+            'started_at': started_at,
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'arguments': vars(args),
+        },
+        'results': results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,26 +1,46 @@
 # -*- coding: utf-8 -*-
 
 # --- 1. ИМПОРТЫ И НАЧАЛЬНАЯ НАСТРОЙКА ---
+# Тяжелые модули (google.generativeai, PIL) импортируются при первом использовании, см. get_genai()
+from time import perf_counter
+MODULE_IMPORT_STARTED = perf_counter()
 import discord
 from discord import ui, app_commands
 from discord.ext import commands, tasks
-import google.generativeai as genai
 import os
 from dotenv import load_dotenv
-from flask import Flask
-from threading import Thread
-from PIL import Image
+from threading import Thread, Lock
 import io
 import json
 import random
 import string
-from datetime import datetime, time, timezone
+from datetime import datetime, date, time, timezone, timedelta
 import sys
+import sqlite3
+from contextlib import contextmanager, asynccontextmanager
 import asyncio
 import re
-import shutil
+import math
+import hashlib
+import heapq
+import unicodedata
+import copy
+import functools
+import mmap
+import struct
+try:
+    import fcntl
+except ImportError:  # Windows: замок на файл лора берется через msvcrt
+    fcntl = None
+    import msvcrt
+from collections import OrderedDict
+from time import time as unix_time, monotonic as monotonic_time
+from types import MappingProxyType
 import aiohttp
+from aiohttp import web
 from typing import List
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor
 
 # Загрузка переменных окружения из файла .env
 load_dotenv()
@@ -42,57 +62,946 @@ IS_TEST_BOT = os.getenv("IS_TEST_BOT", "False").lower() == "true"
 if not all([DISCORD_TOKEN, GEMINI_API_KEY, MAIN_GUILD_ID, ADMIN_GUILD_ID, CODE_CHANNEL_ID, OWNER_USER_ID, LORE_CHANNEL_IDS, GOSSIP_CHANNEL_ID]):
     raise ValueError("КРИТИЧЕСКАЯ ОШИБКА: Один из ключей или ID (DISCORD_TOKEN, GEMINI_API_KEY, *_GUILD_ID, CODE_CHANNEL_ID, OWNER_USER_ID, LORE_CHANNEL_IDS, GOSSIP_CHANNEL_ID) не найден в .env")
 
-# Настройка API Gemini
-genai.configure(api_key=GEMINI_API_KEY)
-gemini_model = genai.GenerativeModel('gemini-2.5-flash')
+# Настройка API Gemini. Импорт google.generativeai занимает больше секунды, поэтому он
+# откладывается до первого обращения (при запуске — в фоне, пока бот подключается к шлюзу)
+GEMINI_MODEL_NAME = 'gemini-2.5-flash'
+_genai = None
+gemini_model = None
+_genai_lock = Lock()
+
+def get_genai():
+    """Модуль google.generativeai, импортированный и настроенный при первом вызове."""
+    global _genai
+    with _genai_lock:
+        if _genai is None:
+            import google.generativeai as genai
+            genai.configure(api_key=GEMINI_API_KEY)
+            _genai = genai
+    return _genai
+
+def get_gemini_model():
+    """Общая модель без системного промпта (оптимизация постов, сводки, ответы по фрагментам лора)."""
+    global gemini_model
+    if gemini_model is None:
+        gemini_model = get_genai().GenerativeModel(GEMINI_MODEL_NAME)
+    return gemini_model
 
 # --- 2. ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ И ФУНКЦИИ ---
-VALDES_LORE = ""
+LORE_FILE = "file.txt"
 # --- ИЗМЕНЕНИЕ 2: Новая переменная для сплетен ---
-VALDES_GOSSIP = ""
+GOSSIP_FILE = "gossip.txt"
 LORE_IMAGES_DIR = "lore_images"
 IMAGE_MAP_FILE = "image_map.json"
 CHARACTER_DATA_FILE = "characters.json"
-CHARACTERS_DATA = {}
+CHARACTER_DB_FILE = "characters.db"
+# Общая база воркеров: персонажи, ежедневный код, версия лора и журнал изменений между процессами
+SHARED_DB_FILE = os.getenv("SHARED_DB_FILE", CHARACTER_DB_FILE)
+
+BACKGROUND_TASKS = set()
+
+def run_in_background(coro):
+    """Запускает корутину фоном, удерживая ссылку на задачу до ее завершения."""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+# Настройки поиска по лору для /ask_lore
+LORE_RETRIEVAL_TOP_K = int(os.getenv("LORE_RETRIEVAL_TOP_K", "12"))
+LORE_RETRIEVAL_TOKEN_BUDGET = int(os.getenv("LORE_RETRIEVAL_TOKEN_BUDGET", "20000"))
+LORE_RETRIEVAL_MIN_SCORE = float(os.getenv("LORE_RETRIEVAL_MIN_SCORE", "3.0"))
+LORE_RETRIEVAL_MIN_COVERAGE = float(os.getenv("LORE_RETRIEVAL_MIN_COVERAGE", "0.5"))
 
 def load_lore_from_file():
-    """Загружает/перезагружает основной лор из файла в память бота."""
-    global VALDES_LORE
+    """Читает основной лор из файла. Возвращает текст и признак того, что файл найден."""
     try:
-        with open("file.txt", "r", encoding="utf-8") as f:
-            VALDES_LORE = f.read()
+        with open(LORE_FILE, "r", encoding="utf-8") as f:
+            lore_text = f.read()
         print("Основной лор успешно загружен/обновлен в память.")
+        return lore_text, True
     except FileNotFoundError:
-        print("КРИТИЧЕСКАЯ ОШИБКА: Файл 'file.txt' не найден.")
-        VALDES_LORE = "Основной лор не был загружен из-за отсутствия файла."
+        print(f"КРИТИЧЕСКАЯ ОШИБКА: Файл '{LORE_FILE}' не найден.")
+        return "Основной лор не был загружен из-за отсутствия файла.", False
 
 # --- ИЗМЕНЕНИЕ 3: Новая функция для загрузки сплетен ---
 def load_gossip_from_file():
-    """Загружает/перезагружает сплетни и события из файла в память бота."""
-    global VALDES_GOSSIP
+    """Читает сплетни и события из файла."""
     try:
-        with open("gossip.txt", "r", encoding="utf-8") as f:
-            VALDES_GOSSIP = f.read()
+        with open(GOSSIP_FILE, "r", encoding="utf-8") as f:
+            gossip_text = f.read()
         print("Лор сплетен и событий успешно загружен/обновлен в память.")
+        return gossip_text
+    except FileNotFoundError:
+        print(f"ПРЕДУПРЕЖДЕНИЕ: Файл '{GOSSIP_FILE}' не найден. Сводка событий будет пустой.")
+        return "В данный момент актуальных событий и сплетен не зафиксировано."
+
+class LoreImage:
+    """Картинка лора, готовая к отправке: путь к файлу и имя для вложения Discord."""
+    __slots__ = ('path', 'extension', 'width', 'height', 'size')
+
+    def __init__(self, path: str, extension: str, width: int = None, height: int = None, size: int = None):
+        self.path = path
+        self.extension = extension
+        self.width = width
+        self.height = height
+        self.size = size
+
+def load_image_map_from_file() -> MappingProxyType:
+    """Загружает карту изображений лора; наличие файлов проверяется здесь, а не при каждом ответе."""
+    try:
+        with open(IMAGE_MAP_FILE, 'r', encoding='utf-8') as f:
+            image_map = json.load(f)
+    except FileNotFoundError:
+        image_map = {}
+    except json.JSONDecodeError as e:
+        print(f"ОШИБКА: Не удалось загрузить {IMAGE_MAP_FILE}: {e}")
+        image_map = {}
+
+    images, missing = {}, 0
+    for image_id, entry in image_map.items():
+        if isinstance(entry, str):
+            entry = {'file': entry}
+        # Предпочитаем уменьшенную копию, при ее отсутствии — оригинал
+        candidates = [(entry.get('derived'), entry.get('width'), entry.get('height'), entry.get('bytes')), (entry['file'], None, None, entry.get('source_bytes'))]
+        for filename, width, height, size in candidates:
+            if filename and os.path.exists(os.path.join(LORE_IMAGES_DIR, filename)):
+                images[image_id] = LoreImage(os.path.join(LORE_IMAGES_DIR, filename), os.path.splitext(filename)[1], width, height, size)
+                break
+        else:
+            missing += 1
+    print(f"Карта изображений загружена: {len(images)} изображений" + (f", не найдено файлов: {missing}." if missing else "."))
+    return MappingProxyType(images)
+
+def read_text_file(path: str):
+    """Читает текстовый файл целиком; None, если файла нет."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
     except FileNotFoundError:
-        print("ПРЕДУПРЕЖДЕНИЕ: Файл 'gossip.txt' не найден. Сводка событий будет пустой.")
-        VALDES_GOSSIP = "В данный момент актуальных событий и сплетен не зафиксировано."
+        return None
+
+# Автодополнение имен персонажей: Discord показывает не больше 25 вариантов
+AUTOCOMPLETE_LIMIT = 25
+AUTOCOMPLETE_VALUE_MAX_LENGTH = 100
+
+def normalize_character_name(name: str) -> str:
+    """Ключ имени для поиска: NFKC, casefold, ё→е, без диакритики и лишних пробелов."""
+    name = unicodedata.normalize('NFKC', name).casefold().replace('ё', 'е')
+    name = "".join(ch for ch in unicodedata.normalize('NFD', name) if not unicodedata.combining(ch))
+    return " ".join(unicodedata.normalize('NFC', name).split())
+
+def bounded_prefix_distance(query: str, text: str, limit: int) -> int:
+    """
+    Наименьшее расстояние Дамерау–Левенштейна (с перестановкой соседних букв) от query до какого-либо
+    начала text. Считается только полоса шириной limit вокруг диагонали; при превышении возвращает limit + 1.
+    """
+    over = limit + 1
+    n, text = len(query), text[:len(query) + limit]
+    m = len(text)
+    earlier_row = None
+    previous_row = [j if j <= limit else over for j in range(m + 1)]
+    for i in range(1, n + 1):
+        row = [over] * (m + 1)
+        if i <= limit:
+            row[0] = i
+        ch = query[i - 1]
+        for j in range(max(1, i - limit), min(m, i + limit) + 1):
+            value = min(previous_row[j] + 1, row[j - 1] + 1, previous_row[j - 1] + (ch != text[j - 1]))
+            if i > 1 and j > 1 and ch == text[j - 2] and query[i - 2] == text[j - 1]:
+                value = min(value, earlier_row[j - 2] + 1)
+            row[j] = value
+        if min(row) > limit:
+            return over
+        earlier_row, previous_row = previous_row, row
+    return min(min(previous_row), over)
+
+class CharacterNameIndex:
+    """
+    Имена персонажей одного пользователя для автодополнения. Ключи считаются один раз при записи,
+    порядок «недавно выбранные выше» поддерживается при добавлении, удалении и выборе.
+    """
+
+    def __init__(self, rows):
+        # rows — (name, name_key) в порядке добавления
+        self.keys = {}
+        self.order = {}  # name -> (-номер последнего выбора, номер добавления): меньше — выше в списке
+        self._added = 0
+        self._selected = 0
+        for name, key in rows:
+            self.add(name, key)
+
+    def add(self, name: str, key: str):
+        self._added += 1
+        words = key.split()
+        # Кандидаты для нечеткого поиска: начало имени и начала остальных слов, плюс набор букв для быстрого отсева
+        self.keys[name] = (key, words, [(candidate, set(candidate)) for candidate in (key, *words[1:])])
+        self.order[name] = (0, self._added)
+
+    def remove(self, name: str):
+        self.keys.pop(name, None)
+        self.order.pop(name, None)
+
+    def touch(self, name: str):
+        if name in self.keys:
+            self._selected += 1
+            self.order[name] = (-self._selected, self.order[name][1])
+
+    @staticmethod
+    def _fuzzy_distance(query: str, candidates: list, limit: int) -> int:
+        """Насколько набранное отличается от начала имени или одного из его слов (опечатки в том, что уже набрано)."""
+        best = limit + 1
+        for candidate, letters in candidates:
+            # Каждая буква запроса, которой нет в кандидате, — минимум одна правка
+            if sum(ch not in letters for ch in query) > limit:
+                continue
+            best = min(best, bounded_prefix_distance(query, candidate, limit))
+        return best
+
+    def search(self, query: str, limit: int = AUTOCOMPLETE_LIMIT) -> list:
+        """Имена по убыванию релевантности: начало имени, начало слова, подстрока, затем похожие с опечатками."""
+        query = normalize_character_name(query)
+        fuzzy_limit = 0 if len(query) < 3 else 1 if len(query) < 6 else 2
+        ranked, unmatched = [], []
+        # Индекс меняется из потоков команд, поэтому обходим снимок
+        for name, (key, words, candidates) in list(self.keys.items()):
+            if not query or key.startswith(query):
+                tier = 0
+            elif any(word.startswith(query) for word in words):
+                tier = 1
+            elif query in key:
+                tier = 2
+            else:
+                unmatched.append((name, candidates))
+                continue
+            ranked.append((tier, 0, self.order.get(name, (0, 0)), name))
+        # Нечеткий поиск дорогой, и нужен он, только если точных совпадений не хватает на весь список
+        if fuzzy_limit and len(ranked) < limit:
+            for name, candidates in unmatched:
+                distance = self._fuzzy_distance(query, candidates, fuzzy_limit)
+                if distance <= fuzzy_limit:
+                    ranked.append((3, distance, self.order.get(name, (0, 0)), name))
+        return [entry[-1] for entry in heapq.nsmallest(limit, ranked)]
+
+# Воркеры (процессы с разными шардами) работают с одной базой SQLite. Каждое изменение общего
+# состояния пишется в change_log в той же транзакции, а остальные воркеры читают журнал
+# (см. watch_shared_state) и сбрасывают или перечитывают свои копии в памяти.
+WORKER_ID = os.getenv("WORKER_ID") or str(os.getpid())
+
+# Шардирование: SHARDING=auto — все шарды в одном процессе (число подскажет Discord);
+# SHARD_COUNT и SHARD_IDS — шарды делятся между несколькими воркерами с общей базой SHARED_DB_FILE.
+SHARDING = os.getenv("SHARDING", "").lower()
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id.strip()] or None
+if SHARD_IDS is not None and not SHARD_COUNT:
+    # Без общего числа шардов нельзя ни подключиться к своим шардам, ни найти ведущего воркера
+    raise ValueError("КРИТИЧЕСКАЯ ОШИБКА: SHARD_IDS задан без SHARD_COUNT.")
+if SHARD_IDS is not None and any(not 0 <= shard_id < SHARD_COUNT for shard_id in SHARD_IDS):
+    raise ValueError(f"КРИТИЧЕСКАЯ ОШИБКА: SHARD_IDS должны быть в диапазоне 0..{SHARD_COUNT - 1}.")
+
+def worker_local_path(path: str) -> str:
+    """
+    Путь к файлу, который пишет только этот воркер (рабочий каталог у воркеров общий).
+    К имени добавляются шарды воркера: они не меняются между перезапусками, в отличие от pid.
+    """
+    if SHARD_IDS is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shards-{'-'.join(map(str, SHARD_IDS))}{ext}"
+
+SHARED_CHANGE_LOG_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS change_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        topic TEXT NOT NULL,
+        key TEXT,
+        worker TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+"""
+
+def log_shared_change(db, topic: str, key: str = None):
+    """Записывает изменение в журнал; вызывать внутри транзакции, которая меняет данные."""
+    db.execute("INSERT INTO change_log (topic, key, worker, created_at) VALUES (?, ?, ?, ?)", (topic, key, WORKER_ID, unix_time()))
+
+class CharacterStore:
+    """
+    Хранилище персонажей на SQLite (WAL): каждая команда меняет одну запись в своей транзакции,
+    а не перезаписывает весь файл. Поиск по (user_id, name) и активного персонажа идет по индексам.
+    Методы синхронные — из команд их вызывают через asyncio.to_thread. Базу могут делить несколько
+    воркеров: изменения попадают в change_log, индекс имен других воркеров сбрасывается по журналу.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = None
+        self._lock = Lock()
+        self._name_indexes = {}
+
+    def open(self):
+        if self.connection is not None:
+            return
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS characters (
+                user_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                description TEXT NOT NULL,
+                avatar_url TEXT,
+                PRIMARY KEY (user_id, name)
+            );
+            CREATE INDEX IF NOT EXISTS characters_by_position ON characters (user_id, position);
+            CREATE TABLE IF NOT EXISTS active_characters (
+                user_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL
+            );
+        """)
+        self.connection.executescript(SHARED_CHANGE_LOG_SCHEMA)
+        # Нормализованный ключ имени для автодополнения; в старых базах колонки нет — дополняем
+        columns = {row['name'] for row in self.connection.execute("PRAGMA table_info(characters)")}
+        if 'name_key' not in columns:
+            self.connection.execute("ALTER TABLE characters ADD COLUMN name_key TEXT")
+        with self._transaction() as db:
+            for row in db.execute("SELECT user_id, name FROM characters WHERE name_key IS NULL").fetchall():
+                db.execute("UPDATE characters SET name_key = ? WHERE user_id = ? AND name = ?",
+                           (normalize_character_name(row['name']), row['user_id'], row['name']))
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        return {'name': row['name'], 'description': row['description'], 'avatar_url': row['avatar_url']}
+
+    def migrate_from_json(self, json_path: str):
+        """Переносит персонажей из старого characters.json (один раз, если база пуста)."""
+        if not os.path.exists(json_path):
+            return
+        with self._lock:
+            has_rows = self.connection.execute("SELECT 1 FROM characters LIMIT 1").fetchone()
+        if has_rows:
+            return
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                legacy_data = json.load(f)
+        except json.JSONDecodeError:
+            print(f"ПРЕДУПРЕЖДЕНИЕ: {json_path} поврежден, перенос персонажей пропущен.")
+            return
+        migrated = 0
+        with self._transaction() as db:
+            for user_id, user_data in legacy_data.items():
+                for position, char in enumerate(user_data.get('characters', [])):
+                    db.execute(
+                        "INSERT OR IGNORE INTO characters (user_id, name, position, description, avatar_url, name_key) VALUES (?, ?, ?, ?, ?, ?)",
+                        (user_id, char['name'], position, char.get('description', ''), char.get('avatar_url'),
+                         normalize_character_name(char['name'])))
+                    migrated += 1
+                if user_data.get('active_character'):
+                    db.execute("INSERT OR REPLACE INTO active_characters (user_id, name) VALUES (?, ?)", (user_id, user_data['active_character']))
+        self._name_indexes.clear()
+        os.replace(json_path, f"{json_path}.migrated")
+        print(f"Перенесено персонажей из {json_path}: {migrated}.")
+
+    def get_characters(self, user_id: str) -> list:
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT name, description, avatar_url FROM characters WHERE user_id = ? ORDER BY position", (user_id,)).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def get_character(self, user_id: str, name: str):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT name, description, avatar_url FROM characters WHERE user_id = ? AND name = ?", (user_id, name)).fetchone()
+        return self._to_dict(row)
+
+    def get_active_character(self, user_id: str):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT c.name, c.description, c.avatar_url FROM active_characters a "
+                "JOIN characters c ON c.user_id = a.user_id AND c.name = a.name WHERE a.user_id = ?", (user_id,)).fetchone()
+        return self._to_dict(row)
+
+    def add_character(self, user_id: str, name: str, description: str, avatar_url: str):
+        """Добавляет персонажа. Возвращает None, если имя занято, иначе True/False — стал ли он активным."""
+        name_key = normalize_character_name(name)
+        with self._transaction() as db:
+            if db.execute("SELECT 1 FROM characters WHERE user_id = ? AND name = ?", (user_id, name)).fetchone():
+                return None
+            next_position = db.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM characters WHERE user_id = ?", (user_id,)).fetchone()[0]
+            db.execute(
+                "INSERT INTO characters (user_id, name, position, description, avatar_url, name_key) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, name, next_position, description, avatar_url, name_key))
+            made_active = db.execute("INSERT OR IGNORE INTO active_characters (user_id, name) VALUES (?, ?)", (user_id, name)).rowcount > 0
+            log_shared_change(db, 'character', user_id)
+            if user_id in self._name_indexes:
+                self._name_indexes[user_id].add(name, name_key)
+        return made_active
+
+    def set_description(self, user_id: str, name: str, description: str) -> bool:
+        with self._transaction() as db:
+            updated = db.execute("UPDATE characters SET description = ? WHERE user_id = ? AND name = ?", (description, user_id, name)).rowcount > 0
+            if updated:
+                log_shared_change(db, 'character', user_id)
+            return updated
+
+    def delete_character(self, user_id: str, name: str) -> bool:
+        """Удаляет персонажа; если он был активным, активным становится первый из оставшихся."""
+        with self._transaction() as db:
+            if db.execute("DELETE FROM characters WHERE user_id = ? AND name = ?", (user_id, name)).rowcount == 0:
+                return False
+            log_shared_change(db, 'character', user_id)
+            if user_id in self._name_indexes:
+                self._name_indexes[user_id].remove(name)
+            active = db.execute("SELECT name FROM active_characters WHERE user_id = ?", (user_id,)).fetchone()
+            if active and active['name'] == name:
+                first = db.execute("SELECT name FROM characters WHERE user_id = ? ORDER BY position LIMIT 1", (user_id,)).fetchone()
+                if first:
+                    db.execute("UPDATE active_characters SET name = ? WHERE user_id = ?", (first['name'], user_id))
+                    # Новый активный поднимается в автодополнении так же, как при выборе и при сборке индекса из базы
+                    if user_id in self._name_indexes:
+                        self._name_indexes[user_id].touch(first['name'])
+                else:
+                    db.execute("DELETE FROM active_characters WHERE user_id = ?", (user_id,))
+        return True
+
+    def select_character(self, user_id: str, name: str):
+        """Делает персонажа активным и возвращает его данные (None, если такого нет)."""
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT name, description, avatar_url FROM characters WHERE user_id = ? AND name = ?", (user_id, name)).fetchone()
+            if row:
+                db.execute("INSERT OR REPLACE INTO active_characters (user_id, name) VALUES (?, ?)", (user_id, name))
+                log_shared_change(db, 'character', user_id)
+                if user_id in self._name_indexes:
+                    self._name_indexes[user_id].touch(name)
+        return self._to_dict(row)
+
+    def forget_name_index(self, user_id: str):
+        """Сбрасывает индекс имен пользователя, если его персонажей изменил другой воркер."""
+        with self._lock:
+            self._name_indexes.pop(user_id, None)
+
+    def cached_name_index(self, user_id: str):
+        """Индекс имен пользователя, если он уже в памяти (без обращения к базе, можно звать из event loop)."""
+        return self._name_indexes.get(user_id)
+
+    def load_name_index(self, user_id: str) -> CharacterNameIndex:
+        """Строит индекс имен пользователя из базы один раз; дальше он обновляется при изменениях."""
+        with self._lock:
+            index = self._name_indexes.get(user_id)
+            if index is None:
+                rows = self.connection.execute(
+                    "SELECT name, name_key FROM characters WHERE user_id = ? ORDER BY position", (user_id,)).fetchall()
+                index = CharacterNameIndex((row['name'], row['name_key']) for row in rows)
+                active = self.connection.execute("SELECT name FROM active_characters WHERE user_id = ?", (user_id,)).fetchone()
+                if active:
+                    index.touch(active['name'])
+                self._name_indexes[user_id] = index
+        return index
+
+CHARACTER_STORE = CharacterStore(SHARED_DB_FILE)
+
+SHARED_STATE_POLL_INTERVAL = float(os.getenv("SHARED_STATE_POLL_INTERVAL", "1.0"))
+SHARED_CHANGE_LOG_RETENTION = int(os.getenv("SHARED_CHANGE_LOG_RETENTION", str(24 * 3600)))
+
+class SharedStateStore:
+    """
+    Общие для воркеров значения (ежедневный код, версия лора) в той же базе, что и персонажи,
+    и чтение журнала изменений. Свое соединение, чтобы опрос не ждал транзакций персонажей.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = None
+        self._lock = Lock()
+        self.last_change_id = 0
+
+    def open(self):
+        if self.connection is not None:
+            return
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SHARED_CHANGE_LOG_SCHEMA + """
+            CREATE TABLE IF NOT EXISTS shared_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        """)
+        # Все, что было до запуска, воркер и так прочитает при загрузке
+        self.last_change_id = self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM change_log").fetchone()[0]
+
+    def get(self, key: str):
+        with self._lock:
+            row = self.connection.execute("SELECT value FROM shared_settings WHERE key = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row['value'])
+
+    def set(self, key: str, value, topic: str):
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO shared_settings (key, value, updated_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), unix_time()))
+                log_shared_change(self.connection, topic, key)
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def changes_since_last_poll(self) -> list:
+        """Изменения, сделанные другими воркерами после прошлого опроса: [(topic, key), ...]."""
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT id, topic, key, worker FROM change_log WHERE id > ? ORDER BY id", (self.last_change_id,)).fetchall()
+            if rows:
+                self.last_change_id = rows[-1]['id']
+        return [(row['topic'], row['key']) for row in rows if row['worker'] != WORKER_ID]
+
+    def prune_changes(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM change_log WHERE created_at < ?", (unix_time() - SHARED_CHANGE_LOG_RETENTION,))
+
+SHARED_STATE = SharedStateStore(SHARED_DB_FILE)
 
 def load_characters():
-    """Загружает данные персонажей из JSON-файла."""
-    global CHARACTERS_DATA
+    """Открывает базу персонажей и при первом запуске переносит в нее данные из JSON-файла."""
+    SHARED_STATE.open()
+    CHARACTER_STORE.open()
+    CHARACTER_STORE.migrate_from_json(CHARACTER_DATA_FILE)
+    print("База персонажей успешно открыта.")
+
+# --- 2.1 ПОИСК ПО ЛОРУ (BM25) ---
+# Вместо отправки всего file.txt в каждый /ask_lore выбираем только фрагменты,
+# относящиеся к вопросу. Фрагменты режутся по маркерам, которые пишет parse_channel_content.
+CHANNEL_START_RE = re.compile(r'^--- НАЧАЛО КАНАЛА: (.*) ---$')
+CHANNEL_END_RE = re.compile(r'^--- КОНЕЦ КАНАЛА: (.*) ---$')
+THREAD_START_RE = re.compile(r'^--- Начало публикации: (.*) ---$')
+THREAD_END_RE = re.compile(r'^--- Конец публикации: (.*) ---$')
+LORE_PASSAGE_MAX_CHARS = 1500
+
+RUSSIAN_STOPWORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот от
+меня еще нет о из ему ли если или ни быть был него до вас нибудь уже вам ведь там потом себя ничего ей может
+они тут где есть надо ней для мы тебя их чем была сам чтоб без будто чего раз тоже себе под будет ж тогда кто
+этот того потому этого какой совсем ним здесь этом один почти мой тем чтобы нее были куда зачем всех никогда
+можно при наконец два об другой хоть после над больше тот через эти нас про всего них какая много разве три
+эту моя впрочем хорошо свою этой перед иногда лучше чуть том нельзя такой им более всегда конечно всю между
+это какие каких какое такие есть the a of and
+""".split())
+
+# Упрощенный стеммер: отрезаем самое длинное типичное окончание, оставляя основу от 3 букв.
+RUSSIAN_SUFFIXES = sorted("""
+иями ями ами ого его ому ему ыми ими ией ий ый ой ая яя ое ее ые ие ую юю ых их ом ем ам ям ах ях ов ев ей
+ешь ете ишь ите ать ять ить еть уть ет ут ют ит ат ят ал ил ла ли ло ся сь ость ости ство ства ия ие ью
+а я о е ы и у ю ь
+""".split(), key=len, reverse=True)
+
+def normalize_lore_token(token: str) -> str:
+    """Приводит слово к нормализованной форме для индекса: нижний регистр, ё→е, без окончания."""
+    token = token.lower().replace('ё', 'е')
+    for suffix in RUSSIAN_SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[:-len(suffix)]
+    return token
+
+def tokenize_lore_text(text: str) -> List[str]:
+    """Разбивает текст на нормализованные токены, отбрасывая стоп-слова и мусор."""
+    tokens = []
+    for word in re.findall(r'\w+', text.lower()):
+        if len(word) < 2 or word in RUSSIAN_STOPWORDS or word.startswith('image_'):
+            continue
+        tokens.append(normalize_lore_token(word))
+    return tokens
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка количества токенов Gemini (кириллица — примерно 3 символа на токен)."""
+    return len(text) // 3 + 1
+
+class LorePassage:
+    """Фрагмент лора с привязкой к каналу и, для форумов, к публикации."""
+    __slots__ = ('position', 'channel', 'publication', 'text')
+
+    def __init__(self, position: int, channel: str, publication: str, text: str):
+        self.position = position
+        self.channel = channel
+        self.publication = publication
+        self.text = text
+
+def split_lore_into_passages(lore_text: str) -> List[LorePassage]:
+    """Режет лор на фрагменты по маркерам каналов/публикаций и по абзацам внутри них."""
+    passages = []
+    channel, publication = "", None
+    paragraphs, size = [], 0
+
+    def flush():
+        nonlocal paragraphs, size
+        text = "\n\n".join(paragraphs).strip()
+        if text:
+            passages.append(LorePassage(len(passages), channel, publication, text))
+        paragraphs, size = [], 0
+
+    for block in re.split(r'\n\s*\n', lore_text):
+        lines = []
+        for line in block.strip().split("\n"):
+            stripped = line.strip()
+            if match := CHANNEL_START_RE.match(stripped):
+                flush()
+                channel, publication = match.group(1), None
+            elif match := THREAD_START_RE.match(stripped):
+                flush()
+                publication = match.group(1)
+            elif THREAD_END_RE.match(stripped):
+                flush()
+                publication = None
+            elif CHANNEL_END_RE.match(stripped):
+                flush()
+                channel, publication = "", None
+            else:
+                lines.append(line)
+        block = "\n".join(lines).strip()
+        if not block:
+            continue
+        if size and size + len(block) > LORE_PASSAGE_MAX_CHARS:
+            flush()
+        paragraphs.append(block)
+        size += len(block)
+    flush()
+    return passages
+
+class LoreIndex:
+    """Инвертированный индекс BM25 по фрагментам лора."""
+
+    def __init__(self, passages: List[LorePassage], k1: float = 1.5, b: float = 0.75):
+        self.passages = passages
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_lengths = []
+        for doc_id, passage in enumerate(passages):
+            # Название канала и публикации тоже участвует в поиске.
+            tokens = tokenize_lore_text(f"{passage.channel} {passage.publication or ''} {passage.text}")
+            self.doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                self.postings.setdefault(token, []).append((doc_id, tf))
+        total_docs = len(passages)
+        self.avg_doc_length = (sum(self.doc_lengths) / total_docs) if total_docs else 0.0
+        self.idf = {
+            token: math.log(1 + (total_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for token, docs in self.postings.items()
+        }
+
+    def search(self, query: str, top_k: int):
+        """Возвращает (score, passage) для лучших фрагментов и долю найденных слов запроса."""
+        query_terms = set(tokenize_lore_text(query))
+        if not query_terms or not self.passages:
+            return [], 0.0
+        scores = {}
+        matched_terms = 0
+        for term in query_terms:
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            matched_terms += 1
+            idf = self.idf[term]
+            for doc_id, tf in docs:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_doc_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [(score, self.passages[doc_id]) for doc_id, score in ranked], matched_terms / len(query_terms)
+
+def render_lore_passages(passages: List[LorePassage]) -> str:
+    """Собирает выбранные фрагменты в исходном порядке с теми же маркерами каналов и публикаций."""
+    parts = []
+    current_channel, current_publication = None, None
+    for passage in sorted(passages, key=lambda p: p.position):
+        if passage.channel != current_channel:
+            if current_publication:
+                parts.append(f"--- Конец публикации: {current_publication} ---\n")
+            if current_channel is not None:
+                parts.append(f"--- КОНЕЦ КАНАЛА: {current_channel} ---\n")
+            parts.append(f"--- НАЧАЛО КАНАЛА: {passage.channel} ---\n")
+            current_channel, current_publication = passage.channel, None
+        if passage.publication != current_publication:
+            if current_publication:
+                parts.append(f"--- Конец публикации: {current_publication} ---\n")
+            if passage.publication:
+                parts.append(f"--- Начало публикации: {passage.publication} ---\n")
+            current_publication = passage.publication
+        parts.append(passage.text + "\n")
+    if current_publication:
+        parts.append(f"--- Конец публикации: {current_publication} ---\n")
+    if current_channel is not None:
+        parts.append(f"--- КОНЕЦ КАНАЛА: {current_channel} ---\n")
+    return "\n".join(parts)
+
+def select_lore_context(index: LoreIndex, question: str):
+    """
+    Подбирает фрагменты лора под вопрос в пределах бюджета токенов.
+    Возвращает None, если уверенность поиска низкая — тогда отправляется весь лор.
+    """
+    if index is None:
+        return None
+    results, coverage = index.search(question, LORE_RETRIEVAL_TOP_K)
+    if not results or results[0][0] < LORE_RETRIEVAL_MIN_SCORE or coverage < LORE_RETRIEVAL_MIN_COVERAGE:
+        return None
+    selected, budget = [], LORE_RETRIEVAL_TOKEN_BUDGET
+    for _, passage in results:
+        cost = estimate_tokens(passage.text)
+        if cost > budget:
+            continue
+        selected.append(passage)
+        budget -= cost
+    if not selected:
+        return None
+    return render_lore_passages(selected)
+
+# --- 2.2 МЕТРИКИ (формат Prometheus) ---
+# Небольшой собственный реестр: счетчики, гистограммы и gauge с метками.
+# Обновления идут из event loop, но реестр не полагается на это: запись и чтение под общей блокировкой.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_metric_labels(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, registry, name: str, help_text: str, labelnames: tuple = ()):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, '', value
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels):
+        """Для счетчиков, которые ведет сам объект (кэш, диспетчер): collector переносит их текущий итог."""
+        with self.registry.lock:
+            self.values[self._key(labels)] = value
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self.registry.lock:
+            self.values[self._key(labels)] = value
+
+    def get(self, default: float = 0.0, **labels) -> float:
+        return self.values.get(self._key(labels), default)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, registry, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(registry, name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        for key, (bucket_counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                yield f"{self.name}_bucket", key, f'le="{bound}"', bucket_count
+            yield f"{self.name}_bucket", key, 'le="+Inf"', count
+            yield f"{self.name}_sum", key, '', total
+            yield f"{self.name}_count", key, '', count
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = []
+        self.collectors = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(self, name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, labelnames: tuple = ()) -> Gauge:
+        return self._register(Gauge(self, name, help_text, labelnames))
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, help_text, labelnames, buckets))
+
+    def collector(self, func):
+        """Функция, которая перед выдачей метрик обновляет gauge и итоги счетчиков из текущего состояния (кэши, диспетчер)."""
+        self.collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        for func in self.collectors:
+            try:
+                func()
+            except Exception as e:
+                print(f"Ошибка при сборе метрик в {func.__name__}: {e}")
+        lines = []
+        with self.lock:
+            for metric in self.metrics:
+                lines.append(f"# HELP {metric.name} {metric.help_text}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+                for sample_name, key, extra, value in metric.samples():
+                    lines.append(f"{sample_name}{format_metric_labels(metric.labelnames, key, extra)} {value}")
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+COMMAND_DURATION = METRICS.histogram("valdes_command_duration_seconds", "Полное время обработки команды.", ("command",))
+COMMAND_PHASE_DURATION = METRICS.histogram("valdes_command_phase_seconds", "Время этапа обработки команды.", ("command", "phase"))
+COMMAND_ERRORS = METRICS.counter("valdes_command_errors_total", "Команды, завершившиеся ошибкой.", ("command",))
+LLM_CALL_DURATION = METRICS.histogram("valdes_llm_call_seconds", "Длительность успешного вызова Gemini (без очереди).", ("command",))
+LLM_FIRST_CHUNK = METRICS.histogram("valdes_llm_first_chunk_seconds", "Время до первого чанка потокового ответа Gemini.", ("command",))
+LLM_PROMPT_BYTES = METRICS.histogram("valdes_llm_prompt_bytes", "Размер запроса к Gemini в байтах (текст и вложения).", ("command",), SIZE_BUCKETS)
+LLM_RESPONSE_BYTES = METRICS.histogram("valdes_llm_response_bytes", "Размер ответа Gemini в байтах.", ("command",), SIZE_BUCKETS)
+LLM_TOKENS = METRICS.counter("valdes_llm_tokens_total", "Токены по данным usage_metadata Gemini.", ("command", "kind"))
+LLM_DISPATCHER_EVENTS = METRICS.counter("valdes_llm_dispatcher_events_total", "Счетчики диспетчера Gemini: вызовы, повторы, склейки, отбросы, ошибки.", ("event",))
+IMAGES_UPLOADED = METRICS.counter("valdes_images_uploaded_total", "Отправленные изображения.", ("command", "target"))
+IMAGES_UPLOADED_BYTES = METRICS.counter("valdes_images_uploaded_bytes_total", "Объем отправленных изображений.", ("command", "target"))
+SCRAPE_DURATION = METRICS.histogram("valdes_scrape_duration_seconds", "Длительность parse_channel_content.", ("kind",))
+SCRAPE_MESSAGES = METRICS.counter("valdes_scrape_messages_total", "Собранные сообщения.", ("kind",))
+SCRAPE_IMAGES = METRICS.counter("valdes_scrape_images_total", "Картинки лора при сборе: скачанные заново и взятые из хранилища.", ("kind", "result"))
+SCRAPE_BYTES = METRICS.counter("valdes_scrape_bytes_total", "Объем собранных данных: текст и скачанные картинки.", ("kind", "content"))
+SCRAPE_RATE = METRICS.gauge("valdes_scrape_last_rate_per_second", "Скорость последнего сбора: сообщения и картинки в секунду.", ("kind", "unit"))
+CACHE_REQUESTS = METRICS.counter("valdes_cache_requests_total", "Обращения к кэшам по результату.", ("cache", "result"))
+CACHE_HIT_RATIO = METRICS.gauge("valdes_cache_hit_ratio", "Доля попаданий в кэш.", ("cache",))
+CACHE_ENTRIES = METRICS.gauge("valdes_cache_entries", "Число записей в кэше.", ("cache",))
+EVENT_LOOP_LAG = METRICS.histogram("valdes_event_loop_lag_seconds", "Задержка пробуждения event loop относительно запланированного.", (), (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+EVENT_LOOP_LAG_LAST = METRICS.gauge("valdes_event_loop_lag_last_seconds", "Последнее измеренное отставание event loop.")
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.5"))
+EVENT_LOOP_MONITOR = None
+STARTUP_PHASE_DURATION = METRICS.gauge("valdes_startup_phase_seconds", "Длительность этапов запуска бота.", ("phase",))
+STARTUP_TIMINGS = {}
+
+@contextmanager
+def startup_phase(phase: str):
+    """Замеряет этап запуска: время пишется в лог, в /status и в метрики."""
+    started = perf_counter()
     try:
-        with open(CHARACTER_DATA_FILE, 'r', encoding='utf-8') as f:
-            CHARACTERS_DATA = json.load(f)
-        print("Данные персонажей успешно загружены.")
-    except (FileNotFoundError, json.JSONDecodeError):
-        CHARACTERS_DATA = {}
-        print("Файл персонажей не найден или пуст. Будет создан новый.")
+        yield
+    finally:
+        record_startup_phase(phase, perf_counter() - started)
+
+def record_startup_phase(phase: str, seconds: float):
+    STARTUP_TIMINGS[phase] = round(seconds, 3)
+    STARTUP_PHASE_DURATION.set(seconds, phase=phase)
+    print(f"Запуск: этап '{phase}' занял {seconds:.3f} с.")
+
+@contextmanager
+def measure_phase(command: str, phase: str):
+    """Замеряет этап команды: with measure_phase('ask_lore', 'llm'): ..."""
+    started = monotonic_time()
+    try:
+        yield
+    finally:
+        COMMAND_PHASE_DURATION.observe(monotonic_time() - started, command=command, phase=phase)
+
+@contextmanager
+def measure_command(command: str):
+    """Замеряет команду целиком и считает ошибки (исключения, вылетевшие из обработчика)."""
+    started = monotonic_time()
+    try:
+        yield
+    except BaseException:
+        COMMAND_ERRORS.inc(command=command)
+        raise
+    finally:
+        COMMAND_DURATION.observe(monotonic_time() - started, command=command)
+
+def instrumented_command(command: str):
+    """Декоратор обработчика слэш-команды: полное время и ошибки попадают в метрики."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(interaction: discord.Interaction, *args, **kwargs):
+            with measure_command(command):
+                return await func(interaction, *args, **kwargs)
+        return wrapper
+    return decorator
 
-def save_characters():
-    """Сохраняет данные персонажей в JSON-файл."""
-    with open(CHARACTER_DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(CHARACTERS_DATA, f, indent=4)
+def measure_content_bytes(contents) -> int:
+    """Примерный размер запроса к модели: UTF-8 текст плюс байты встроенных вложений."""
+    if isinstance(contents, str):
+        return len(contents.encode('utf-8'))
+    if isinstance(contents, dict):
+        return len(contents.get('data', b''))
+    if isinstance(contents, (list, tuple)):
+        return sum(measure_content_bytes(part) for part in contents)
+    return 0
+
+def record_llm_usage(command: str, contents, response, elapsed: float):
+    LLM_CALL_DURATION.observe(elapsed, command=command)
+    LLM_PROMPT_BYTES.observe(measure_content_bytes(contents), command=command)
+    try:
+        LLM_RESPONSE_BYTES.observe(len(response.text.encode('utf-8')), command=command)
+    except ValueError:
+        pass  # ответ без текста (например, заблокирован фильтрами)
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    for kind, field in (('prompt', 'prompt_token_count'), ('response', 'candidates_token_count'),
+                        ('cached', 'cached_content_token_count'), ('thoughts', 'thoughts_token_count'),
+                        ('total', 'total_token_count')):
+        count = getattr(usage, field, 0) or 0
+        if count:
+            LLM_TOKENS.inc(count, command=command, kind=kind)
+
+async def monitor_event_loop_lag():
+    """Просыпается раз в EVENT_LOOP_LAG_INTERVAL и измеряет, насколько позже запланированного это произошло."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + EVENT_LOOP_LAG_INTERVAL
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - expected)
+        EVENT_LOOP_LAG.observe(lag)
+        EVENT_LOOP_LAG_LAST.set(lag)
 
 # --- 3. СИСТЕМНЫЕ ПРОМПТЫ ---
 def get_optimizer_prompt(level, character_info=None):
@@ -122,7 +1031,7 @@ def get_optimizer_prompt(level, character_info=None):
 """
 
 # --- ИЗМЕНЕНИЕ 4: Обновление промптов для поддержки сплетен ---
-def get_serious_lore_prompt():
+def get_serious_lore_prompt(lore_text: str, gossip_text: str):
     """Возвращает СЕРЬЕЗНЫЙ системный промпт для ответов на вопросы по лору."""
     return f"""
 Ты — Хранитель знаний мира 'Вальдес'. Твоя задача — отвечать на вопросы игроков, основываясь ИСКЛЮЧИТЕЛЬНО на предоставленном тебе тексте с лором и правилами.
@@ -136,292 +1045,2434 @@ def get_serious_lore_prompt():
 
 Вот текст, который является твоей единственной базой знаний:
 
---- НАЧАЛО ДОКУМЕНТА С ЛОРОМ ---
-{VALDES_LORE}
---- КОНЕЦ ДОКУМЕНТА С ЛОРОМ ---
+--- НАЧАЛО ДОКУМЕНТА С ЛОРОМ ---
+{lore_text}
+--- КОНЕЦ ДОКУМЕНТА С ЛОРОМ ---
+
+--- НАЧАЛО СВОДКИ АКТУАЛЬНЫХ СОБЫТИЙ И СПЛЕТЕН ---
+{gossip_text}
+--- КОНЕЦ СВОДКИ АКТУАЛЬНЫХ СОБЫТИЙ И СПЛЕТЕН ---
+"""
+
+def get_edgy_lore_prompt(lore_text: str, gossip_text: str):
+    """Возвращает ЦИНИЧНЫЙ, но ЛОРНЫЙ системный промпт для ответов на вопросы."""
+    return f"""
+Ты — Архивариус Вальдеса. Ты циничный, уставший от жизни старик, который повидал всякое дерьмо. Ты прожил всю свою грёбаную жизнь в этом мире и за его пределы никогда не выглядывал. Всё, что ты знаешь — это то, что написано в этих пыльных свитках и то, что видел своими глазами.
+
+**ТВОИ НОВЫЕ ПРАВИЛА, ЗАСРАНЕЦ:**
+
+1.  **ПРАВИЛО НОМЕР ОДИН: ТЫ НЕ ЗНАЕШЬ ДРУГИХ МИРОВ.** Забудь про реальный мир, забудь про фильмы, игры, книги и прочую поп-культурную поебень. Если в тексте про Вальдес этого нет — для тебя этого не существует. Твои знания **ОГРАНИЧЕНЫ** предоставленным текстом. Это закон.
+2.  **ОСНОВА — ЛОР, НО НЕ КОПИПАСТА:** Твои ответы всегда опираются на предоставленный текст. Но не пересказывай его дословно. Выжимай суть. Отвечай коротко и по делу.
+3.  **ДОДУМЫВАЙ, НО ВНУТРИ ЛОРА:** Если прямого ответа нет, ты можешь сделать циничное предположение, но оно должно быть основано **ИСКЛЮЧИТЕЛЬНО** на других фактах из лора. Пример: если в лоре сказано, что дварфы жадные и живут в горах, а тебя спросят, что они едят, можешь предположить, что они жрут пещерные грибы и жареных крыс, потому что на нормальную еду им жалко золота.
+4.  **МАТ И САРКАЗМ — ТВОИ ИНСТРУМЕНТЫ:** Используй маты и черный юмор, если это делает ответ "живее" и соответствует твоему образу старого циника.
+5.  **ЦИТИРОВАНИЕ ИСТОЧНИКОВ:** После своего едкого ответа, поставь разделитель `%%SOURCES%%` и перечисли каналы, откуда ты высосал эту инфу.
+6.  **КАРТИНКИ:** Если картинка с тегом `[IMAGE_XXX]` подходит к твоему ответу, вставь этот тег в самый конец.
+
+Вот твоя база знаний. Не подведи.
+--- НАЧАЛО ДОКУМЕНТА С ЛОРОМ ---
+{lore_text}
+--- КОНЕЦ ДОКУМЕНТА С ЛОРОМ ---
+
+--- АКТУАЛЬНЫЕ НОВОСТИ С ТВОЕГО АРТЕФАКТА ---
+Кстати, тот магический камушек, что ты когда-то подобрал в руинах, снова светится. Он показывает тебе самые свежие сплетни и новости со всего Вальдеса. Вот что на нем сегодня:
+{gossip_text}
+--- КОНЕЦ НОВОСТЕЙ С АРТЕФАКТА ---
+"""
+
+LORE_PROMPT_BUILDERS = {"serious": get_serious_lore_prompt, "edgy": get_edgy_lore_prompt}
+
+# --- 3.1 СНИМОК ЛОРА ---
+# Полные системные промпты (~0.9 МБ каждый) собираются один раз на версию лора,
+# а не в каждом запросе. Снимок неизменяем и подменяется целиком при перезагрузке.
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "False").lower() == "true"
+GEMINI_CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "3600"))
+
+def compute_lore_version(lore: str, gossip: str) -> str:
+    digest = hashlib.sha256()
+    digest.update(lore.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(gossip.encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+class LoreSnapshot:
+    """Версия лора: тексты, поисковый индекс, карта изображений и готовые системные промпты для каждой личности."""
+
+    def __init__(self, lore: str, gossip: str, index: LoreIndex, images: MappingProxyType, lore_found: bool = True):
+        self.lore = lore
+        self.lore_found = lore_found
+        self.gossip = gossip
+        self.index = index
+        self.images = images
+        self.version = compute_lore_version(lore, gossip)
+        self.prompts = MappingProxyType({name: builder(lore, gossip) for name, builder in LORE_PROMPT_BUILDERS.items()})
+        self._models = {}
+        self._cached_contents = {}
+        self._model_lock = asyncio.Lock()
+
+    def with_images(self, images: MappingProxyType):
+        """Тот же лор с новой картой изображений: промпты и модели не пересобираются."""
+        snapshot = copy.copy(self)
+        snapshot.images = images
+        return snapshot
+
+    def build_prompt(self, personality: str, lore_context: str = None) -> str:
+        """Промпт с выбранными фрагментами лора; без фрагментов — готовый полный промпт."""
+        if lore_context is None:
+            return self.prompts[personality]
+        return LORE_PROMPT_BUILDERS[personality](lore_context, self.gossip)
+
+    async def get_full_context_model(self, personality: str):
+        """
+        Модель, у которой полный промпт задан как system_instruction.
+        С GEMINI_CONTEXT_CACHE=true промпт один раз загружается в кэш контекста Gemini
+        и дальше не пересылается с каждым вопросом.
+        """
+        async with self._model_lock:
+            model = self._models.get(personality)
+            if model is not None:
+                return model
+            model = None
+            if GEMINI_CONTEXT_CACHE:
+                try:
+                    cached = await asyncio.to_thread(
+                        get_genai().caching.CachedContent.create,
+                        model=f"models/{GEMINI_MODEL_NAME}",
+                        display_name=f"valdes-{personality}-{self.version}",
+                        system_instruction=self.prompts[personality],
+                        ttl=timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL),
+                    )
+                    self._cached_contents[personality] = cached
+                    model = get_genai().GenerativeModel.from_cached_content(cached)
+                except Exception as e:
+                    print(f"Не удалось создать кэш контекста Gemini, используется system_instruction: {e}")
+            if model is None:
+                model = get_genai().GenerativeModel(GEMINI_MODEL_NAME, system_instruction=self.prompts[personality])
+            self._models[personality] = model
+            return model
+
+    def release(self):
+        """Удаляет кэши контекста Gemini, созданные для этой версии лора."""
+        for cached in self._cached_contents.values():
+            try:
+                cached.delete()
+            except Exception as e:
+                print(f"Не удалось удалить кэш контекста Gemini: {e}")
+        self._cached_contents = {}
+        self._models = {}
+
+LORE_SNAPSHOT = None
+
+def build_lore_snapshot(previous: LoreSnapshot = None) -> LoreSnapshot:
+    """
+    Собирает снимок лора из файлов на диске. Ничего не меняет в работающем боте,
+    поэтому вызывается в отдельном потоке. Неизменившиеся части берутся из прошлого снимка.
+    """
+    lore, lore_found = load_lore_from_file()
+    gossip = load_gossip_from_file()
+    images = load_image_map_from_file()
+    if previous is not None and previous.version == compute_lore_version(lore, gossip):
+        return previous.with_images(images)
+    if previous is not None and previous.lore == lore:
+        index = previous.index
+    else:
+        index = LoreIndex(split_lore_into_passages(lore))
+        print(f"Поисковый индекс лора построен: {len(index.passages)} фрагментов.")
+    return LoreSnapshot(lore, gossip, index, images, lore_found)
+
+def validate_lore_snapshot(snapshot: LoreSnapshot):
+    """Возвращает текст ошибки, если снимок нельзя ставить вместо рабочего, иначе None."""
+    if not snapshot.lore_found:
+        return f"файл `{LORE_FILE}` не найден"
+    if not snapshot.index.passages:
+        return "лор пуст"
+    if parse_lore_sections(snapshot.lore) is None:
+        return "структура каналов и публикаций в лоре повреждена"
+    return None
+
+def install_lore_snapshot(snapshot: LoreSnapshot):
+    """Атомарно подменяет рабочий снимок. Запросы, уже взявшие старый снимок, дорабатывают на нем."""
+    global LORE_SNAPSHOT
+    previous = LORE_SNAPSHOT
+    LORE_SNAPSHOT = snapshot
+    if previous is not None and previous.version == snapshot.version:
+        return
+    print(f"Снимок лора обновлен, версия {snapshot.version}.")
+    ANSWER_CACHE.retain_version(snapshot.version)
+    if previous is not None and previous._cached_contents:
+        # Удаление — сетевой вызов, не держим им event loop.
+        Thread(target=previous.release, daemon=True).start()
+
+async def reload_lore_snapshot():
+    """
+    Перезагружает лор без перезапуска бота: новый снимок собирается в фоне, проверяется
+    и только потом подменяет старый. Возвращает текст ошибки, если снимок отклонен.
+    """
+    snapshot = await asyncio.to_thread(build_lore_snapshot, LORE_SNAPSHOT)
+    error = validate_lore_snapshot(snapshot)
+    if error:
+        print(f"ОШИБКА: Новый снимок лора отклонен ({error}), продолжаем работать на прежнем.")
+        return error
+    install_lore_snapshot(snapshot)
+    return None
+
+# --- 3.2 КЭШ ОТВЕТОВ /ask_lore ---
+# Каждый воркер хранит свои ответы в своем файле (см. worker_local_path)
+ANSWER_CACHE_FILE = "answer_cache.json"
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "512"))
+ANSWER_CACHE_MAX_BYTES = int(os.getenv("ANSWER_CACHE_MAX_BYTES", str(2 * 1024 * 1024)))
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))
+# Новые ответы сохраняются на диск пачкой не чаще раза в столько секунд
+ANSWER_CACHE_SAVE_DELAY = float(os.getenv("ANSWER_CACHE_SAVE_DELAY", "30"))
+
+def normalize_question(question: str) -> str:
+    """Нормализует вопрос для ключа кэша: регистр, ё→е, без пунктуации и лишних пробелов."""
+    question = question.casefold().replace('ё', 'е')
+    question = re.sub(r'[^\w\s]|_', ' ', question)
+    return " ".join(question.split())
+
+class AnswerCache:
+    """
+    LRU-кэш готовых ответов /ask_lore с TTL и ограничением по числу записей и объему.
+    Ключ включает версию лора, поэтому после обновления лора старые ответы не используются.
+    """
+
+    def __init__(self, path: str, max_entries: int, max_bytes: int, ttl: int, save_delay: float = ANSWER_CACHE_SAVE_DELAY):
+        self.path = path
+        self.save_delay = save_delay
+        self._save_task = None
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._save_lock = Lock()
+
+    @staticmethod
+    def make_key(question: str, personality: str, version: str) -> str:
+        return f"{version}|{personality}|{normalize_question(question)}"
+
+    @staticmethod
+    def _entry_size(entry: dict) -> int:
+        return len(entry['answer']) + len(entry['sources']) + sum(len(i) for i in entry['image_ids']) + 64
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None or entry['expires_at'] < unix_time():
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key: str, answer: str, sources: str, image_ids: List[str]):
+        if key in self.entries:
+            self._remove(key)
+        entry = {'answer': answer, 'sources': sources, 'image_ids': list(image_ids), 'expires_at': unix_time() + self.ttl}
+        self.entries[key] = entry
+        self.total_bytes += self._entry_size(entry)
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key)
+        self.total_bytes -= self._entry_size(entry)
+
+    def retain_version(self, version: str):
+        """Удаляет ответы, построенные на других версиях лора."""
+        for key in [k for k in self.entries if not k.startswith(f"{version}|")]:
+            self._remove(key)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits / total) if total else 0.0,
+        }
+
+    def load(self, version: str):
+        """Загружает кэш с диска, оставляя только живые ответы для текущей версии лора."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        now = unix_time()
+        for key, entry in stored.items():
+            if key not in self.entries and key.startswith(f"{version}|") and entry.get('expires_at', 0) > now:
+                self.entries[key] = entry
+                self.total_bytes += self._entry_size(entry)
+        print(f"Кэш ответов загружен: {len(self.entries)} записей.")
+
+    def schedule_save(self):
+        """
+        Откладывает сохранение на save_delay секунд: ответы за это время пишутся одним файлом.
+        Вызывается из event loop, как и put(); там же снимается копия записей для потока записи.
+        """
+        if self._save_task is None:
+            self._save_task = run_in_background(self._save_later())
+
+    async def _save_later(self):
+        try:
+            await asyncio.sleep(self.save_delay)
+        finally:
+            self._save_task = None
+        await asyncio.to_thread(self.save, dict(self.entries))
+
+    def save(self, data: dict):
+        """Атомарно сохраняет снимок записей на диск (вызывается в отдельном потоке)."""
+        with self._save_lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+ANSWER_CACHE = AnswerCache(worker_local_path(ANSWER_CACHE_FILE), ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_BYTES, ANSWER_CACHE_TTL)
+
+def report_cache_metrics(cache: str, hits: int, misses: int, entries: int):
+    CACHE_REQUESTS.set_total(hits, cache=cache, result='hit')
+    CACHE_REQUESTS.set_total(misses, cache=cache, result='miss')
+    CACHE_HIT_RATIO.set(hits / (hits + misses) if hits + misses else 0.0, cache=cache)
+    CACHE_ENTRIES.set(entries, cache=cache)
+
+@METRICS.collector
+def collect_answer_cache_metrics():
+    report_cache_metrics('answer', ANSWER_CACHE.hits, ANSWER_CACHE.misses, len(ANSWER_CACHE.entries))
+
+# --- 3.3 ДИСПЕТЧЕР ЗАПРОСОВ К GEMINI ---
+# Все вызовы модели идут через один диспетчер: общий лимит параллельных запросов,
+# честное распределение между пользователями и серверами, повторы при 429/5xx
+# и склейка одинаковых запросов, которые уже выполняются.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+GEMINI_USER_RATE_PER_MINUTE = float(os.getenv("GEMINI_USER_RATE_PER_MINUTE", "6"))
+GEMINI_USER_BURST = int(os.getenv("GEMINI_USER_BURST", "3"))
+GEMINI_GUILD_RATE_PER_MINUTE = float(os.getenv("GEMINI_GUILD_RATE_PER_MINUTE", "60"))
+GEMINI_GUILD_BURST = int(os.getenv("GEMINI_GUILD_BURST", "15"))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+GEMINI_RETRY_BASE_DELAY = float(os.getenv("GEMINI_RETRY_BASE_DELAY", "1.0"))
+GEMINI_RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "20.0"))
+GEMINI_RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+# Токен взаимодействия Discord живет 15 минут; оставляем запас на отправку ответа.
+INTERACTION_TOKEN_LIFETIME = timedelta(minutes=15)
+INTERACTION_DEADLINE_MARGIN = 30.0
+
+class LLMDeadlineExceeded(Exception):
+    """Ответ модели уже не успеет уйти пользователю: токен взаимодействия истекает."""
+
+class TokenBucket:
+    """Ведро токенов: rate_per_minute запросов в минуту с допустимым всплеском burst."""
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = monotonic_time()
+
+    def _refill(self):
+        now = monotonic_time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Забирает токен (возможно, в долг) и возвращает, сколько секунд нужно подождать."""
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+def interaction_deadline(interaction: discord.Interaction) -> float:
+    """Момент (по часам event loop), после которого ответ на взаимодействие уже не отправить."""
+    remaining = (interaction.created_at + INTERACTION_TOKEN_LIFETIME - datetime.now(timezone.utc)).total_seconds()
+    return asyncio.get_running_loop().time() + remaining - INTERACTION_DEADLINE_MARGIN
+
+class InflightGeneration:
+    """Выполняющийся вызов модели, к которому присоединяются одинаковые запросы (и их слушатели потока)."""
+    __slots__ = ('future', 'listeners', 'text')
+
+    def __init__(self):
+        self.future = None
+        self.listeners = []
+        self.text = ''
+
+    def publish(self, text: str):
+        self.text = text
+        for listener in list(self.listeners):
+            listener(text)
+
+class GeminiDispatcher:
+    """
+    Центральная точка вызова модели. Модель может быть любой с методом generate_content_async,
+    поэтому диспетчер проверяется на локальной фейковой модели без сети.
+    """
+
+    def __init__(self, max_concurrency: int, user_rate: float, user_burst: int, guild_rate: float, guild_burst: int,
+                 max_retries: int, base_delay: float, max_delay: float):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.user_rate, self.user_burst = user_rate, user_burst
+        self.guild_rate, self.guild_burst = guild_rate, guild_burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.user_buckets = {}
+        self.guild_buckets = {}
+        self._inflight = {}
+        self.stats = {'calls': 0, 'retries': 0, 'coalesced': 0, 'deadline_dropped': 0, 'errors': 0}
+
+    @staticmethod
+    def _remaining(deadline):
+        return None if deadline is None else deadline - asyncio.get_running_loop().time()
+
+    def _check_deadline(self, deadline, upcoming_wait: float = 0.0):
+        remaining = self._remaining(deadline)
+        if remaining is not None and remaining <= upcoming_wait:
+            self.stats['deadline_dropped'] += 1
+            raise LLMDeadlineExceeded("Ответ модели не успеет уйти до истечения токена взаимодействия.")
+
+    @staticmethod
+    def _bucket(buckets: dict, key, rate: float, burst: int) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) > 1000:
+                for idle_key in [k for k, b in buckets.items() if b.is_full()]:
+                    del buckets[idle_key]
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    async def _wait_for_turn(self, user_id, guild_id, deadline):
+        reserved = []
+        try:
+            for buckets, key, rate, burst in ((self.user_buckets, user_id, self.user_rate, self.user_burst),
+                                              (self.guild_buckets, guild_id, self.guild_rate, self.guild_burst)):
+                if key is None:
+                    continue
+                bucket = self._bucket(buckets, key, rate, burst)
+                wait = bucket.reserve()
+                reserved.append(bucket)
+                self._check_deadline(deadline, wait)
+                if wait:
+                    await asyncio.sleep(wait)
+        except BaseException:
+            for bucket in reserved:
+                bucket.refund()
+            raise
+
+    @staticmethod
+    def is_retryable(error: Exception) -> bool:
+        status = getattr(error, 'code', None)
+        return isinstance(status, int) and status in GEMINI_RETRYABLE_STATUS_CODES
+
+    @staticmethod
+    async def _generate_once(model, contents, on_text, command, kwargs):
+        started = monotonic_time()
+        if on_text is None:
+            response = await model.generate_content_async(contents, **kwargs)
+        else:
+            # Потоковый режим: отдаем накопленный текст после каждого чанка.
+            # После полного прохода ответ ведет себя как обычный (.text, .usage_metadata).
+            response = await model.generate_content_async(contents, stream=True, **kwargs)
+            text = ''
+            async for chunk in response:
+                try:
+                    piece = chunk.text
+                except ValueError:
+                    # Служебные чанки (например, только finish_reason) не содержат текста
+                    continue
+                if piece and not text:
+                    LLM_FIRST_CHUNK.observe(monotonic_time() - started, command=command)
+                text += piece
+                on_text(text)
+        record_llm_usage(command, contents, response, monotonic_time() - started)
+        return response
+
+    async def _call_with_retries(self, model, contents, deadline, on_text, command, kwargs):
+        attempt = 0
+        while True:
+            self._check_deadline(deadline)
+            try:
+                self.stats['calls'] += 1
+                return await asyncio.wait_for(self._generate_once(model, contents, on_text, command, kwargs), timeout=self._remaining(deadline))
+            except asyncio.TimeoutError:
+                self.stats['deadline_dropped'] += 1
+                raise LLMDeadlineExceeded("Модель не ответила до истечения токена взаимодействия.")
+            except Exception as e:
+                if attempt >= self.max_retries or not self.is_retryable(e):
+                    self.stats['errors'] += 1
+                    raise
+                # Экспоненциальная задержка с полным джиттером
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                self._check_deadline(deadline, delay)
+                attempt += 1
+                self.stats['retries'] += 1
+                print(f"Gemini вернул {getattr(e, 'code', '?')}, повтор {attempt}/{self.max_retries} через {delay:.1f} с.")
+                await asyncio.sleep(delay)
+
+    async def _dispatch(self, model, contents, user_id, guild_id, deadline, on_text, command, kwargs):
+        await self._wait_for_turn(user_id, guild_id, deadline)
+        self._check_deadline(deadline)
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self._remaining(deadline))
+        except asyncio.TimeoutError:
+            self.stats['deadline_dropped'] += 1
+            raise LLMDeadlineExceeded("Очередь к модели не успела дойти до запроса.")
+        try:
+            return await self._call_with_retries(model, contents, deadline, on_text, command, kwargs)
+        finally:
+            self.semaphore.release()
+
+    async def generate(self, model, contents, *, user_id=None, guild_id=None, deadline: float = None, coalesce_key=None,
+                       on_text=None, command: str = 'other', **kwargs):
+        """
+        Вызывает model.generate_content_async(contents, **kwargs) с учетом лимитов.
+        Запросы с одинаковым coalesce_key, пришедшие пока первый выполняется, получают его ответ.
+        deadline — время по часам event loop (см. interaction_deadline), после которого запрос отбрасывается.
+        on_text — если задан, ответ запрашивается потоком, и on_text(text) вызывается с накопленным текстом
+        по мере прихода чанков (при повторе после ошибки текст начинается заново).
+        command — метка для метрик (время вызова, размеры запроса и ответа, токены).
+        """
+        if coalesce_key is None:
+            return await self._dispatch(model, contents, user_id, guild_id, deadline, on_text, command, kwargs)
+        call = self._inflight.get(coalesce_key)
+        if call is not None:
+            self.stats['coalesced'] += 1
+        else:
+            call = InflightGeneration()
+            call.future = asyncio.ensure_future(self._dispatch(
+                model, contents, user_id, guild_id, deadline, call.publish if on_text is not None else None, command, kwargs))
+            self._inflight[coalesce_key] = call
+            call.future.add_done_callback(lambda _: self._inflight.pop(coalesce_key, None))
+        if on_text is not None:
+            call.listeners.append(on_text)
+            if call.text:
+                on_text(call.text)
+        try:
+            return await asyncio.wait_for(asyncio.shield(call.future), timeout=self._remaining(deadline))
+        except asyncio.TimeoutError:
+            # Общий запрос еще идет (у его владельца свой срок), а этот ждать дальше не может
+            self.stats['deadline_dropped'] += 1
+            raise LLMDeadlineExceeded("Общий запрос к модели не завершился до истечения токена взаимодействия.")
+        finally:
+            if on_text is not None:
+                call.listeners.remove(on_text)
+
+GEMINI_DISPATCHER = GeminiDispatcher(
+    GEMINI_MAX_CONCURRENCY, GEMINI_USER_RATE_PER_MINUTE, GEMINI_USER_BURST,
+    GEMINI_GUILD_RATE_PER_MINUTE, GEMINI_GUILD_BURST,
+    GEMINI_MAX_RETRIES, GEMINI_RETRY_BASE_DELAY, GEMINI_RETRY_MAX_DELAY)
+
+@METRICS.collector
+def collect_dispatcher_metrics():
+    for event, value in GEMINI_DISPATCHER.stats.items():
+        LLM_DISPATCHER_EVENTS.set_total(value, event=event)
+
+# --- 4. ВСПОМОГАТЕЛЬНЫЙ КОД (HTTP-сервер, UI, работа с кодом доступа) ---
+# HTTP-сервер работает в том же event loop, что и бот: /readyz видит реальное состояние
+# подключения к Discord и задержку loop, а не просто живой отдельный поток.
+HTTP_PORT = int(os.getenv("PORT", "8080"))
+READY_MAX_LOOP_LAG = float(os.getenv("READY_MAX_LOOP_LAG", "1.0"))
+PROCESS_STARTED_AT = unix_time()
+
+def readiness_problems() -> List[str]:
+    problems = []
+    if bot.is_closed() or not bot.is_ready():
+        problems.append("нет подключения к шлюзу Discord")
+    elif not math.isfinite(bot.latency):
+        problems.append("нет heartbeat от шлюза Discord")
+    if LORE_SNAPSHOT is None:
+        problems.append("снимок лора еще не загружен")
+    loop_lag = EVENT_LOOP_LAG_LAST.get()
+    if loop_lag > READY_MAX_LOOP_LAG:
+        problems.append(f"event loop отстает на {loop_lag:.2f} с")
+    return problems
+
+async def handle_root(request: web.Request) -> web.Response:
+    return web.Response(text="Bot is alive and running!")
+
+async def handle_healthz(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+async def handle_readyz(request: web.Request) -> web.Response:
+    problems = readiness_problems()
+    return web.json_response({'ready': not problems, 'problems': problems}, status=503 if problems else 200)
+
+async def handle_status(request: web.Request) -> web.Response:
+    snapshot = LORE_SNAPSHOT
+    status = {
+        'ready': not readiness_problems(),
+        'uptime_seconds': round(unix_time() - PROCESS_STARTED_AT, 1),
+        'user': str(bot.user) if bot.user else None,
+        'guilds': len(bot.guilds),
+        'gateway_latency_seconds': bot.latency if math.isfinite(bot.latency) else None,
+        'event_loop_lag_seconds': EVENT_LOOP_LAG_LAST.get(),
+        'test_mode': IS_TEST_BOT,
+        'lore': None if snapshot is None else {
+            'version': snapshot.version,
+            'found': snapshot.lore_found,
+            'passages': len(snapshot.index.passages),
+            'images': len(snapshot.images),
+        },
+        'answer_cache': ANSWER_CACHE.stats(),
+        'gemini_dispatcher': dict(GEMINI_DISPATCHER.stats),
+        'background_tasks': len(BACKGROUND_TASKS),
+        'startup_seconds': STARTUP_TIMINGS,
+    }
+    return web.json_response(status)
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=METRICS.render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def start_http_server() -> web.AppRunner:
+    app = web.Application()
+    app.add_routes([
+        web.get('/', handle_root),
+        web.get('/healthz', handle_healthz),
+        web.get('/readyz', handle_readyz),
+        web.get('/status', handle_status),
+        web.get('/metrics', handle_metrics),
+    ])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', HTTP_PORT).start()
+    print(f"HTTP-сервер (health/metrics) слушает порт {HTTP_PORT}.")
+    return runner
+
+class OptimizedPostModal(ui.Modal, title='Ваш улучшенный пост'):
+    def __init__(self, optimized_text: str):
+        super().__init__()
+        self.post_content = ui.TextInput(label="Текст готов к копированию", style=discord.TextStyle.paragraph, default=optimized_text, max_length=1800)
+        self.add_item(self.post_content)
+    async def on_submit(self, interaction: discord.Interaction):
+        await interaction.response.send_message("Окно закрыто.", ephemeral=True, delete_after=3)
+
+class ShowOptimizedPostButton(ui.DynamicItem[ui.Button], template=r'optimize_post:show:(?P<key>[0-9a-f]{64})'):
+    """
+    Кнопка показа улучшенного поста. Текст берется из POST_RESULT_CACHE по ключу из custom_id,
+    поэтому кнопка продолжает работать и после таймаута PostView (через add_dynamic_items).
+    """
+
+    def __init__(self, key: str):
+        super().__init__(ui.Button(label="📝 Показать и скопировать текст", style=discord.ButtonStyle.primary, custom_id=f"optimize_post:show:{key}"))
+        self.key = key
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: ui.Button, match: re.Match):
+        return cls(match['key'])
+
+    async def callback(self, interaction: discord.Interaction):
+        optimized_text = POST_RESULT_CACHE.lookup(self.key, user_id=str(interaction.user.id))
+        if optimized_text is None:
+            await interaction.response.send_message("⌛ Этот результат больше не хранится. Отправьте пост через `/optimize_post` еще раз.", ephemeral=True)
+            return
+        await interaction.response.send_modal(OptimizedPostModal(optimized_text))
+
+class PostView(ui.View):
+    def __init__(self, result_key: str):
+        super().__init__(timeout=300)
+        self.add_item(ShowOptimizedPostButton(result_key))
+
+# Потоковые ответы: сообщение отправляется с первыми словами модели и правится по мере генерации.
+STREAMING_RESPONSES = os.getenv("STREAMING_RESPONSES", "True").lower() == "true"
+# Интервал между правками сообщения; держит нас в пределах лимитов Discord на редактирование
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+STREAM_CURSOR = " ▌"
+
+class StreamingEmbed:
+    """
+    Ответ на взаимодействие, который показывается частями. update() только запоминает
+    последний текст, а отдельная задача отправляет/правит сообщение не чаще раза в interval секунд,
+    поэтому частота чанков модели не влияет на число запросов к Discord.
+    """
+
+    def __init__(self, interaction: discord.Interaction, render, interval: float = STREAM_EDIT_INTERVAL, ephemeral: bool = False):
+        self.interaction = interaction
+        self.render = render  # текст -> discord.Embed
+        self.interval = interval
+        self.ephemeral = ephemeral
+        self.message = None
+        self.text = ''
+        self._shown = ''
+        self._last_edit = 0.0
+        self._task = None
+        self._sending = False
+        self._closed = False
+
+    def update(self, text: str):
+        if self._closed or not text:
+            return
+        self.text = text
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while not self._closed and self._shown != self.text:
+                delay = self._last_edit + self.interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                text = self.text
+                self._sending = True
+                try:
+                    if self.message is None:
+                        self.message = await self.interaction.followup.send(embed=self.render(text), ephemeral=self.ephemeral, wait=True)
+                    else:
+                        await self.message.edit(embed=self.render(text))
+                finally:
+                    self._sending = False
+                self._shown = text
+                self._last_edit = loop.time()
+        except discord.HTTPException as e:
+            # Промежуточный показ не критичен: итоговый ответ все равно будет отправлен
+            print(f"Не удалось обновить потоковый ответ: {e}")
+            self._closed = True
+        finally:
+            self._task = None
+
+    async def _stop(self):
+        self._closed = True
+        task = self._task
+        if task is None:
+            return
+        if self._sending:
+            # Отправка уже идет: дожидаемся ее, иначе потеряем ссылку на созданное сообщение
+            await asyncio.wait([task])
+        else:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def finish(self, **kwargs):
+        """Останавливает промежуточные правки и показывает итоговый ответ (embed, view и т.п.)."""
+        await self._stop()
+        if self.message is None:
+            self.message = await self.interaction.followup.send(ephemeral=self.ephemeral, wait=True, **kwargs)
+        else:
+            await self.message.edit(**kwargs)
+        return self.message
+
+    async def discard(self):
+        """Убирает недописанный ответ, например если модель упала посреди генерации."""
+        await self._stop()
+        if self.message is not None:
+            try:
+                await self.message.delete()
+            except discord.HTTPException:
+                pass
+            self.message = None
+
+DAILY_ACCESS_CODE = ""
+CODE_FILE = "code.json" # Прежнее место хранения; читается один раз для переноса в общую базу
+
+def save_daily_code(code):
+    data = {'code': code, 'date': datetime.now().strftime('%Y-%m-%d')}
+    SHARED_STATE.set('daily_code', data, topic='daily_code')
+
+def refresh_daily_code() -> bool:
+    """Берет сегодняшний код из общей базы (его создает ведущий воркер). False, если кода на сегодня нет."""
+    global DAILY_ACCESS_CODE
+    data = SHARED_STATE.get('daily_code')
+    if data and data.get('date') == datetime.now().strftime('%Y-%m-%d'):
+        DAILY_ACCESS_CODE = data['code']
+        return True
+    return False
+
+def load_daily_code():
+    global DAILY_ACCESS_CODE
+    if SHARED_STATE.get('daily_code') is None:
+        try:
+            with open(CODE_FILE, 'r') as f:
+                SHARED_STATE.set('daily_code', json.load(f), topic='daily_code')
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+    if refresh_daily_code():
+        print(f"Загружен сегодняшний код доступа: {DAILY_ACCESS_CODE}")
+        return
+    if not IS_LEADER_WORKER:
+        print("Кода доступа на сегодня еще нет; его создаст ведущий воркер.")
+        return
+
+    new_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    DAILY_ACCESS_CODE = new_code
+    save_daily_code(new_code)
+    print(f"Сгенерирован новый код на сегодня: {DAILY_ACCESS_CODE}")
+
+# --- 5. НАСТРОЙКА БОТА ---
+intents = discord.Intents.default()
+intents.messages = True
+intents.message_content = True
+intents.guilds = True
+
+# Лор, кэш ответов и персонажи загружаются в фоне, пока бот подключается к шлюзу (см. setup_hook)
+STARTUP_LOAD = None
+SETUP_HOOK_STARTED = None
+STARTUP_WAIT_TIMEOUT = float(os.getenv("STARTUP_WAIT_TIMEOUT", "2.0"))
+STARTUP_LOAD_ATTEMPTS = int(os.getenv("STARTUP_LOAD_ATTEMPTS", "3"))
+STARTUP_RETRY_DELAY = float(os.getenv("STARTUP_RETRY_DELAY", "5.0"))
+
+def startup_load_error():
+    """Исключение, с которым окончательно завершилась фоновая загрузка данных (None, если ее нет или она еще идет)."""
+    if STARTUP_LOAD is None or not STARTUP_LOAD.done() or STARTUP_LOAD.cancelled():
+        return None
+    return STARTUP_LOAD.exception()
+COMMAND_TREE_HASH_FILE = "command_tree.json"
+
+class StartupAwareTree(app_commands.CommandTree):
+    """Дерево команд, которое не пускает команды и автодополнение к данным, пока они не загружены."""
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if STARTUP_LOAD is None:
+            return True
+        if not STARTUP_LOAD.done():
+            try:
+                # Ответ на взаимодействие нужен в течение 3 секунд, поэтому ждем недолго
+                await asyncio.wait_for(asyncio.shield(STARTUP_LOAD), timeout=STARTUP_WAIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                if interaction.type is discord.InteractionType.application_command:
+                    await interaction.response.send_message("⏳ Бот только что запустился и еще загружает данные. Попробуйте через несколько секунд.", ephemeral=True)
+                return False
+            except Exception:
+                pass  # ошибка разбирается ниже через startup_load_error()
+        if startup_load_error() is not None:
+            # Без лора и базы персонажей команда упадет на середине; сообщаем об этом сразу
+            if interaction.type is discord.InteractionType.application_command:
+                await interaction.response.send_message("❌ Бот не смог загрузить данные при запуске и сейчас перезапускается. Попробуйте позже.", ephemeral=True)
+            return False
+        return True
+
+def main_guild_shard_id():
+    """Шард главного сервера по формуле Discord: (guild_id >> 22) % shard_count."""
+    if not SHARD_COUNT or not MAIN_GUILD_ID:
+        return None
+    return (int(MAIN_GUILD_ID) >> 22) % SHARD_COUNT
+
+# Ведущий воркер — тот, что держит шард главного сервера: он создает ежедневный код, обновляет
+# сплетни и синхронизирует команды, чтобы при нескольких воркерах это не делалось несколько раз.
+IS_LEADER_WORKER = SHARD_IDS is None or main_guild_shard_id() in SHARD_IDS
+
+if SHARDING == "auto" or SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, tree_cls=StartupAwareTree,
+                                  shard_count=SHARD_COUNT, shard_ids=SHARD_IDS if SHARD_COUNT else None)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, tree_cls=StartupAwareTree)
+
+async def get_channel_anywhere(channel_id: int):
+    """Канал может быть на шарде другого воркера и не попасть в кэш — тогда берем его через API."""
+    channel = bot.get_channel(channel_id)
+    if channel is None:
+        try:
+            channel = await bot.fetch_channel(channel_id)
+        except discord.HTTPException:
+            return None
+    return channel
+
+# --- 6. УНИВЕРСАЛЬНАЯ ФУНКЦИЯ И ЕЖЕДНЕВНЫЕ ЗАДАЧИ ---
+async def send_access_code_to_admin_channel(code: str, title: str, description: str):
+    try:
+        admin_channel = await get_channel_anywhere(int(CODE_CHANNEL_ID))
+        if admin_channel:
+            embed = discord.Embed(title=title, description=description, color=discord.Color.gold(), timestamp=datetime.now())
+            embed.add_field(name="Код", value=f"```{code}```")
+            embed.set_footer(text="Этот код действителен до конца текущих суток (по UTC).")
+            await admin_channel.send(embed=embed)
+    except Exception as e:
+        print(f"Произошла ошибка при отправке кода: {e}")
+
+@tasks.loop(time=time(hour=0, minute=0, tzinfo=timezone.utc))
+async def update_code_task():
+    global DAILY_ACCESS_CODE
+    new_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    DAILY_ACCESS_CODE = new_code
+    save_daily_code(new_code)
+    print(f"Сгенерирован новый ежедневный код: {new_code}")
+    await send_access_code_to_admin_channel(code=new_code, title="🔑 Новый ежедневный код доступа", description="Код доступа для команды `/update_lore` на следующие 24 часа:")
+
+# --- ИЗМЕНЕНИЕ 5: Новая ежедневная задача для обновления сплетен ---
+@tasks.loop(time=time(hour=0, minute=5, tzinfo=timezone.utc))
+async def update_gossip_task():
+    print("Запускаю ежедневное обновление лора сплетен и событий...")
+    try:
+        gossip_channel_id = int(GOSSIP_CHANNEL_ID)
+        gossip_channel = await get_channel_anywhere(gossip_channel_id)
+        if not gossip_channel:
+            print(f"КРИТИЧЕСКАЯ ОШИБКА: Канал сплетен с ID {gossip_channel_id} не найден.")
+            return
+
+        async with lore_write_lock():
+            manifest = load_scrape_manifest()
+            previous_gossip = LoreArchive.open(GOSSIP_ARCHIVE_FILE, GOSSIP_ARCHIVE_INDEX_FILE) if manifest.get('gossip') else None
+
+            gossip_archive = LoreArchiveWriter(GOSSIP_ARCHIVE_FILE, GOSSIP_ARCHIVE_INDEX_FILE)
+            try:
+                async with aiohttp.ClientSession() as session:
+                    # При ежедневном обновлении мы не работаем с картинками, чтобы не засорять диск.
+                    # Если картинки важны, можно будет вернуть эту логику.
+                    _, new_messages, _, _, manifest['gossip'] = await parse_channel_content(
+                        [gossip_channel], session, download_images=False,
+                        previous_archive=previous_gossip, previous_manifest=manifest.get('gossip'), metrics_kind="gossip",
+                        output=DiscardedText(), archive_output=gossip_archive)
+                # В промпт идет свернутый вид: свежие сообщения и сводки прошлых окон
+                gossip_files, gossip_stats = await stage_gossip_view(gossip_archive)
+            except BaseException:
+                gossip_archive.discard()
+                raise
+            finally:
+                if previous_gossip is not None:
+                    previous_gossip.close()
+            manifest_file = stage_json(SCRAPE_MANIFEST_FILE, manifest, indent=4, ensure_ascii=False)
+            artifacts_version = await asyncio.to_thread(commit_lore_artifacts, [*gossip_files, *gossip_archive.staged_files(), manifest_file])
+        await asyncio.to_thread(publish_lore_version, artifacts_version)
+        print(f"Новых сообщений в канале сплетен: {new_messages}. Сводки: {gossip_stats['digests_reused']} готовых, "
+              f"{gossip_stats['digests_generated']} новых; в промпте {gossip_stats['digests_in_prompt']} сводок "
+              f"и {gossip_stats['recent_in_prompt']} свежих сообщений.")
+
+        await reload_lore_snapshot() # Перезагружаем в память
+        print("Ежедневное обновление лора сплетен успешно завершено.")
+
+    except Exception as e:
+        print(f"Произошла ошибка во время ежедневного обновления сплетен: {e}")
+
+
+@update_code_task.before_loop
+async def before_tasks():
+    await bot.wait_until_ready()
+
+@update_gossip_task.before_loop
+async def before_gossip_task():
+    await bot.wait_until_ready()
+
+
+def publish_lore_version(version: str):
+    """Сообщает остальным воркерам, что файлы лора на диске обновлены и снимок надо перечитать."""
+    SHARED_STATE.set('lore_version', version, topic='lore')
+
+async def watch_shared_state():
+    """
+    Опрос журнала изменений общей базы: другие воркеры меняют персонажей, код и лор,
+    а этот процесс сбрасывает свои копии в памяти. Опрос — один запрос по индексу раз в секунду.
+    """
+    last_prune = monotonic_time()
+    while True:
+        await asyncio.sleep(SHARED_STATE_POLL_INTERVAL)
+        try:
+            changes = await asyncio.to_thread(SHARED_STATE.changes_since_last_poll)
+            reload_lore = False
+            for topic, key in changes:
+                if topic == 'character':
+                    CHARACTER_STORE.forget_name_index(key)
+                    POST_RESULT_CACHE.invalidate_user(key)
+                elif topic == 'daily_code':
+                    await asyncio.to_thread(refresh_daily_code)
+                elif topic == 'lore':
+                    reload_lore = True
+            if reload_lore:
+                # Файлы уже закоммичены другим воркером; снимок собирается из них так же, как после /update_lore
+                await reload_lore_snapshot()
+            if monotonic_time() - last_prune > 3600:
+                last_prune = monotonic_time()
+                await asyncio.to_thread(SHARED_STATE.prune_changes)
+        except Exception as e:
+            print(f"Ошибка при чтении журнала общей базы: {e}")
+
+async def load_startup_state():
+    """Все, что читается с диска при запуске; идет в потоках, пока бот подключается к шлюзу."""
+    with startup_phase("shared_state"):
+        # Журнал изменений читается с этого момента, поэтому база открывается до чтения лора
+        await asyncio.to_thread(SHARED_STATE.open)
+    with startup_phase("lore_recovery"):
+        await asyncio.to_thread(recover_lore_commit)
+    with startup_phase("lore_snapshot"):
+        install_lore_snapshot(await asyncio.to_thread(build_lore_snapshot, LORE_SNAPSHOT)) # Лор, сплетни и картинки
+    with startup_phase("answer_cache"):
+        await asyncio.to_thread(ANSWER_CACHE.load, LORE_SNAPSHOT.version)
+    with startup_phase("characters"):
+        await asyncio.to_thread(load_characters)
+    with startup_phase("gemini_import"):
+        await asyncio.to_thread(get_gemini_model)
+
+async def load_startup_state_with_retries():
+    """
+    Загрузка данных с повторами. Если все попытки неудачны, бот останавливается (код выхода 1),
+    чтобы супервизор перезапустил процесс, а не работал без лора и персонажей.
+    """
+    for attempt in range(1, STARTUP_LOAD_ATTEMPTS + 1):
+        try:
+            await load_startup_state()
+            break
+        except Exception as e:
+            print(f"ОШИБКА: Не удалось загрузить данные при запуске (попытка {attempt}/{STARTUP_LOAD_ATTEMPTS}): {e!r}")
+            if attempt == STARTUP_LOAD_ATTEMPTS:
+                print("КРИТИЧЕСКАЯ ОШИБКА: Данные так и не загружены, бот останавливается.")
+                run_in_background(bot.close())
+                raise
+            await asyncio.sleep(STARTUP_RETRY_DELAY * attempt)
+    run_in_background(watch_shared_state())
+
+def command_tree_hash() -> str:
+    """Хэш определений всех команд в том виде, в каком они отправляются в Discord при sync()."""
+    payload = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+async def sync_command_tree_if_changed():
+    """tree.sync() — лимитированный вызов API; он нужен, только если определения команд изменились."""
+    tree_hash = command_tree_hash()
+    try:
+        with open(COMMAND_TREE_HASH_FILE, 'r', encoding='utf-8') as f:
+            stored = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        stored = {}
+    if stored.get('hash') == tree_hash and stored.get('application_id') == bot.application_id:
+        print("Определения команд не изменились, синхронизация пропущена.")
+        return
+    synced = await bot.tree.sync()
+    write_file_atomically(COMMAND_TREE_HASH_FILE, json.dumps({'hash': tree_hash, 'application_id': bot.application_id}).encode('utf-8'))
+    print(f"Синхронизировано {len(synced)} команд.")
+
+@bot.event
+async def setup_hook():
+    # Вызывается один раз до подключения к шлюзу: HTTP-сервер стартует в loop бота,
+    # а данные грузятся в фоне параллельно с подключением
+    global STARTUP_LOAD, SETUP_HOOK_STARTED
+    SETUP_HOOK_STARTED = perf_counter()
+    record_startup_phase("module_import", MODULE_IMPORT_FINISHED - MODULE_IMPORT_STARTED)
+    # Кнопки показа улучшенного поста обрабатываются и после таймаута их PostView
+    bot.add_dynamic_items(ShowOptimizedPostButton)
+    with startup_phase("http_server"):
+        await start_http_server()
+    STARTUP_LOAD = run_in_background(load_startup_state_with_retries())
+
+@bot.event
+async def on_ready():
+    if IS_TEST_BOT:
+        print("--- БОТ ЗАПУЩЕН В ТЕСТОВОМ РЕЖИМЕ ---")
+        print("--- Функции обновления лора и отправки кодов доступа ОТКЛЮЧЕНЫ ---")
+    else:
+        print("--- БОТ ЗАПУЩЕН В ПРОИЗВОДСТВЕННОМ РЕЖИМЕ ---")
+
+    print(f'Бот {bot.user} успешно запущен!')
+    # on_ready приходит и после переподключений; данные при этом уже загружены, а команды синхронизированы
+    first_ready = 'gateway_connect' not in STARTUP_TIMINGS
+    if first_ready:
+        record_startup_phase("gateway_connect", perf_counter() - SETUP_HOOK_STARTED)
+        with startup_phase("startup_load_wait"):
+            await asyncio.wait([STARTUP_LOAD])
+    if startup_load_error() is not None:
+        # Бот уже останавливается (см. load_startup_state_with_retries); задачи на пустых данных не запускаем
+        return
+    global EVENT_LOOP_MONITOR
+    if EVENT_LOOP_MONITOR is None or EVENT_LOOP_MONITOR.done():
+        EVENT_LOOP_MONITOR = run_in_background(monitor_event_loop_lag())
+
+    if not IS_TEST_BOT:
+        load_daily_code()
+    if not IS_TEST_BOT and IS_LEADER_WORKER:
+        if not update_code_task.is_running():
+            update_code_task.start()
+        if not update_gossip_task.is_running(): # Запускаем новую задачу
+            update_gossip_task.start()
+        await send_access_code_to_admin_channel(code=DAILY_ACCESS_CODE, title="⚙️ Текущий код доступа (После перезапуска)", description="Бот был перезапущен. Вот актуальный код на сегодня:")
+    
+    if first_ready and IS_LEADER_WORKER:
+        try:
+            with startup_phase("tree_sync"):
+                await sync_command_tree_if_changed()
+        except Exception as e:
+            print(f"Ошибка синхронизации: {e}")
+    if first_ready:
+        record_startup_phase("total", perf_counter() - MODULE_IMPORT_STARTED)
+
+# --- 7. КОМАНДЫ БОТА ---
+
+MENTION_RE = re.compile(r'<(#|@&|@!?)(\d+)>')
+CHANNEL_MENTION_RE = re.compile(r'<#(\d+)>')
+ROLE_MENTION_RE = re.compile(r'<@&(\d+)>')
+USER_MENTION_RE = re.compile(r'<@!?(\d+)>')
+# Символы, при которых подставленное имя канала или роли может вместе с соседним текстом
+# образовать новое упоминание для следующего прохода старого алгоритма
+MENTION_SYNTAX_CHARS = frozenset('<>@')
+
+class MentionResolver:
+    """
+    Имена для упоминаний в пределах одного сбора: каждый ID разрешается один раз,
+    ненайденные ID запоминаются (None) и перечислены в unresolved.
+    """
+
+    def __init__(self):
+        self.channels = {}
+        self.roles = {}
+        self.users = {}
+        self.unresolved = {'channels': set(), 'roles': set(), 'users': set()}
+
+    def channel(self, channel_id: int):
+        if channel_id not in self.channels:
+            channel = bot.get_channel(channel_id)
+            self.channels[channel_id] = channel.name if channel else None
+            if not channel:
+                self.unresolved['channels'].add(channel_id)
+        return self.channels[channel_id]
+
+    def role(self, guild: discord.Guild, role_id: int):
+        key = (guild.id, role_id)
+        if key not in self.roles:
+            role = guild.get_role(role_id)
+            self.roles[key] = role.name if role else None
+            if not role:
+                self.unresolved['roles'].add(role_id)
+        return self.roles[key]
+
+    def user(self, user_id: int):
+        if user_id not in self.users:
+            user = bot.get_user(user_id)
+            self.users[user_id] = user.display_name if user else None
+            if not user:
+                self.unresolved['users'].add(user_id)
+        return self.users[user_id]
+
+    def describe_unresolved(self) -> str:
+        return ", ".join(f"{kind}: {len(ids)}" for kind, ids in self.unresolved.items() if ids)
+
+def clean_discord_mentions(text: str, guild: discord.Guild, resolver: MentionResolver = None) -> str:
+    """
+    Заменяет упоминания каналов, ролей и пользователей на их имена за один проход.
+    resolver — общий кэш имен на весь сбор; без него кэш живет в пределах одного вызова.
+    """
+    if not text:
+        return ""
+    if resolver is None:
+        resolver = MentionResolver()
+    needs_sequential = False
+
+    def replace(match):
+        nonlocal needs_sequential
+        kind, object_id = match.group(1), int(match.group(2))
+        if kind == '#':
+            name = resolver.channel(object_id)
+            if name is None:
+                return match.group(0)
+            if not MENTION_SYNTAX_CHARS.isdisjoint(name):
+                needs_sequential = True
+            return f'#{name}'
+        if kind == '@&':
+            if not guild:
+                return match.group(0)
+            name = resolver.role(guild, object_id)
+            if name is None:
+                return match.group(0)
+            if not MENTION_SYNTAX_CHARS.isdisjoint(name) or text[match.start() - 1:match.start()] == '<':
+                needs_sequential = True
+            return f'@{name}'
+        name = resolver.user(object_id)
+        return match.group(0) if name is None else f'@{name}'
+
+    result = MENTION_RE.sub(replace, text)
+    if needs_sequential:
+        # Имя канала или роли похоже на разметку упоминания: повторяем прежние три прохода,
+        # чтобы результат совпадал с ними байт в байт
+        return rewrite_mentions_sequentially(text, guild, resolver)
+    return result
+
+def rewrite_mentions_sequentially(text: str, guild: discord.Guild, resolver: MentionResolver) -> str:
+    """Прежний алгоритм: отдельные проходы для каналов, ролей и пользователей."""
+    def channel_name(match):
+        name = resolver.channel(int(match.group(1)))
+        return match.group(0) if name is None else f'#{name}'
+
+    def role_name(match):
+        name = resolver.role(guild, int(match.group(1)))
+        return match.group(0) if name is None else f'@{name}'
+
+    def user_name(match):
+        name = resolver.user(int(match.group(1)))
+        return match.group(0) if name is None else f'@{name}'
+
+    text = CHANNEL_MENTION_RE.sub(channel_name, text)
+    if guild:
+        text = ROLE_MENTION_RE.sub(role_name, text)
+    return USER_MENTION_RE.sub(user_name, text)
+
+# Сбор лора: манифест для инкрементального сбора и ограничения параллельности
+SCRAPE_MANIFEST_FILE = "scrape_manifest.json"
+SCRAPE_CONCURRENCY = int(os.getenv("SCRAPE_CONCURRENCY", "4"))
+IMAGE_DOWNLOAD_CONCURRENCY = int(os.getenv("IMAGE_DOWNLOAD_CONCURRENCY", "8"))
+SECTION_MARKER_RE = re.compile(r'^--- (НАЧАЛО КАНАЛА|КОНЕЦ КАНАЛА|Начало публикации|Конец публикации): (.*) ---\n', re.MULTILINE)
+
+IMAGE_INDEX_FILE = "image_index.json"
+DISCORD_CDN_HOSTS = ("cdn.discordapp.com", "media.discordapp.net")
+LORE_DERIVED_IMAGES_SUBDIR = "derived"
+LORE_IMAGE_MAX_EDGE = int(os.getenv("LORE_IMAGE_MAX_EDGE", "1280"))
+LORE_IMAGE_MAX_BYTES = int(os.getenv("LORE_IMAGE_MAX_BYTES", str(1024 * 1024)))
+IMAGE_PROCESS_WORKERS = int(os.getenv("IMAGE_PROCESS_WORKERS", "2"))
+IMAGE_PROCESS_POOL = None
+
+def get_image_process_pool() -> ProcessPoolExecutor:
+    """Пул процессов для Pillow: декодирование и пережатие картинок не должны держать event loop и GIL."""
+    global IMAGE_PROCESS_POOL
+    if IMAGE_PROCESS_POOL is None:
+        IMAGE_PROCESS_POOL = ProcessPoolExecutor(max_workers=IMAGE_PROCESS_WORKERS)
+    return IMAGE_PROCESS_POOL
+
+def render_discord_image(source_path: str, target_dir: str, max_edge: int, max_bytes: int) -> dict:
+    """
+    Готовит копию картинки для отправки в Discord: с учетом EXIF-поворота, не больше max_edge
+    по длинной стороне, пережатую в JPEG (или PNG при прозрачности). Анимации копируются как есть.
+    Выполняется в отдельном процессе.
+    """
+    from PIL import Image, ImageOps  # импорт нужен только в процессах пула
+    base_name = os.path.splitext(os.path.basename(source_path))[0]
+    source_bytes = os.path.getsize(source_path)
+    source_extensions = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
+
+    def copy_source():
+        with open(source_path, 'rb') as src, open(f"{target_path}.tmp", 'wb') as dst:
+            dst.write(src.read())
+
+    with Image.open(source_path) as image:
+        source_format = image.format
+        if getattr(image, 'is_animated', False):
+            # Анимацию не пережимаем, только исправляем расширение
+            file_extension = source_extensions.get(source_format, 'gif')
+            target_path = os.path.join(target_dir, f"{base_name}.{file_extension}")
+            width, height = image.size
+            output_format = source_format
+            copy_source()
+        else:
+            source_size = image.size
+            exif_rotated = image.getexif().get(0x0112, 1) != 1
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+            has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+            if has_alpha:
+                image, output_format, file_extension = image.convert('RGBA'), 'PNG', 'png'
+            else:
+                image, output_format, file_extension = image.convert('RGB'), 'JPEG', 'jpg'
+            target_path = os.path.join(target_dir, f"{base_name}.{file_extension}")
+            width, height = image.size
+            quality = 85
+            while True:
+                if output_format == 'PNG':
+                    image.save(f"{target_path}.tmp", 'PNG', optimize=True)
+                else:
+                    image.save(f"{target_path}.tmp", 'JPEG', quality=quality, optimize=True, progressive=True)
+                if output_format == 'PNG' or quality <= 55 or os.path.getsize(f"{target_path}.tmp") <= max_bytes:
+                    break
+                quality -= 10
+            # Маленький исходник, который не пришлось поворачивать или уменьшать, может оказаться компактнее
+            if (image.size == source_size and not exif_rotated and source_format in source_extensions
+                    and source_bytes <= os.path.getsize(f"{target_path}.tmp")):
+                os.remove(f"{target_path}.tmp")
+                output_format, file_extension = source_format, source_extensions[source_format]
+                target_path = os.path.join(target_dir, f"{base_name}.{file_extension}")
+                copy_source()
+    os.replace(f"{target_path}.tmp", target_path)
+    return {
+        'derived': f"{LORE_DERIVED_IMAGES_SUBDIR}/{os.path.basename(target_path)}",
+        'format': output_format,
+        'width': width,
+        'height': height,
+        'bytes': os.path.getsize(target_path),
+        'source_format': source_format,
+        'source_bytes': source_bytes,
+    }
+
+class LoreImageStore:
+    """
+    Контентно-адресуемое хранилище картинок лора: файл называется хешем своих байтов,
+    поэтому одинаковые картинки хранятся один раз. Индекс URL → хеш позволяет не качать
+    вложения Discord повторно, а для внешних ссылок делать условный запрос (ETag/Last-Modified).
+    Для каждой картинки один раз готовится уменьшенная копия для отправки в Discord.
+    """
+
+    def __init__(self, directory: str, index_path: str):
+        self.directory = directory
+        self.derived_directory = os.path.join(directory, LORE_DERIVED_IMAGES_SUBDIR)
+        self.index_path = index_path
+        self.urls = {}
+        self.derivatives = {}
+        self.downloaded_count = 0
+        self.downloaded_bytes = 0
+        self.reused_count = 0
+        self._inflight = {}
+
+    def load(self):
+        os.makedirs(self.derived_directory, exist_ok=True)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            stored = {}
+        if 'urls' not in stored:
+            stored = {'urls': stored, 'derivatives': {}}  # индекс старого формата: только URL → хеш
+        self.urls = stored['urls']
+        self.derivatives = stored['derivatives']
+        self.downloaded_count = 0
+        self.downloaded_bytes = 0
+        self.reused_count = 0
+
+    def save(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'urls': self.urls, 'derivatives': self.derivatives}, f, indent=4)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def url_key(url: str) -> str:
+        """Ключ URL в индексе: у вложений Discord подписанные параметры в query меняются, ID вложения — нет."""
+        parsed = urlsplit(url)
+        if parsed.hostname in DISCORD_CDN_HOSTS and parsed.path.startswith("/attachments/"):
+            return f"discord:{parsed.path}"
+        return url
+
+    @staticmethod
+    def is_immutable(key: str) -> bool:
+        return key.startswith("discord:")
+
+    def _entry_file(self, entry: dict):
+        filename = f"{entry['hash']}.{entry['ext']}"
+        return filename if os.path.exists(os.path.join(self.directory, filename)) else None
+
+    async def _deduplicated(self, key, coro_factory):
+        """Одинаковые запросы, идущие одновременно, выполняются один раз."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coro_factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def fetch(self, session: aiohttp.ClientSession, url: str):
+        """Возвращает имя файла картинки в хранилище (скачивая ее только при необходимости) или None."""
+        key = self.url_key(url)
+        return await self._deduplicated(('fetch', key), lambda: self._fetch(session, url, key))
+
+    async def _fetch(self, session: aiohttp.ClientSession, url: str, key: str):
+        entry = self.urls.get(key)
+        known_file = self._entry_file(entry) if entry else None
+        if known_file and self.is_immutable(key):
+            self.reused_count += 1
+            return known_file
+
+        headers = {}
+        if known_file:
+            if entry.get('etag'): headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'): headers['If-Modified-Since'] = entry['last_modified']
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 304 and known_file:
+                self.reused_count += 1
+                return known_file
+            if resp.status != 200:
+                return None
+            image_bytes = await resp.read()
+            self.downloaded_bytes += len(image_bytes)
+            content_type = resp.headers.get('Content-Type', '')
+            etag = resp.headers.get('ETag')
+            last_modified = resp.headers.get('Last-Modified')
+
+        file_extension = 'png'
+        if 'jpeg' in content_type or 'jpg' in content_type: file_extension = 'jpg'
+        elif 'png' in content_type: file_extension = 'png'
+        elif 'gif' in content_type: file_extension = 'gif'
+        elif 'webp' in content_type: file_extension = 'webp'
+
+        content_hash = hashlib.sha256(image_bytes).hexdigest()
+        filename = f"{content_hash}.{file_extension}"
+        path = os.path.join(self.directory, filename)
+        if not os.path.exists(path):
+            await asyncio.to_thread(write_file_atomically, path, image_bytes)
+            self.downloaded_count += 1
+        else:
+            self.reused_count += 1
+        self.urls[key] = {'hash': content_hash, 'ext': file_extension, 'etag': etag, 'last_modified': last_modified}
+        return filename
+
+    async def ingest(self, filename: str) -> dict:
+        """Возвращает запись для карты изображений: оригинал, готовая для Discord копия и ее размеры."""
+        return await self._deduplicated(('ingest', filename), lambda: self._ingest(filename))
+
+    async def _ingest(self, filename: str) -> dict:
+        metadata = self.derivatives.get(filename)
+        if metadata is None or not os.path.exists(os.path.join(self.directory, metadata['derived'])):
+            loop = asyncio.get_running_loop()
+            try:
+                metadata = await loop.run_in_executor(
+                    get_image_process_pool(), render_discord_image,
+                    os.path.join(self.directory, filename), self.derived_directory, LORE_IMAGE_MAX_EDGE, LORE_IMAGE_MAX_BYTES)
+            except Exception as e:
+                print(f"Не удалось подготовить картинку {filename} для Discord, будет отправлен оригинал: {e}")
+                return {'file': filename}
+            self.derivatives[filename] = metadata
+        return {'file': filename, **metadata}
+
+    def collect_garbage(self, image_map: dict) -> int:
+        """Удаляет файлы, на которые не ссылается закоммиченная карта изображений. Вызывать после записи image_map.json."""
+        referenced_files = set()
+        for entry in image_map.values():
+            if isinstance(entry, str):
+                referenced_files.add(entry)
+            else:
+                referenced_files.add(entry['file'])
+                if entry.get('derived'):
+                    referenced_files.add(entry['derived'])
+        removed = 0
+        for directory, prefix in ((self.directory, ""), (self.derived_directory, f"{LORE_DERIVED_IMAGES_SUBDIR}/")):
+            for filename in os.listdir(directory):
+                path = os.path.join(directory, filename)
+                if f"{prefix}{filename}" not in referenced_files and os.path.isfile(path):
+                    os.remove(path)
+                    removed += 1
+        self.urls = {key: entry for key, entry in self.urls.items() if f"{entry['hash']}.{entry['ext']}" in referenced_files}
+        self.derivatives = {name: meta for name, meta in self.derivatives.items() if name in referenced_files}
+        return removed
+
+LORE_IMAGE_STORE = LoreImageStore(LORE_IMAGES_DIR, IMAGE_INDEX_FILE)
+
+def write_file_atomically(path: str, data: bytes):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def load_scrape_manifest() -> dict:
+    """Загружает манифест прошлого сбора (последние ID сообщений по каналам и веткам)."""
+    try:
+        with open(SCRAPE_MANIFEST_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+# Артефакты сбора коммитятся вместе: сначала пишутся рядом как *.new, затем журнал фиксирует
+# новый набор версий, и только после этого файлы переименовываются на место
+LORE_COMMIT_FILE = "lore_commit.json"
+# Структурированный архив: по записи JSONL на сообщение плюс индекс смещений; file.txt и gossip.txt — производные
+LORE_ARCHIVE_FILE = "lore_archive.jsonl"
+LORE_ARCHIVE_INDEX_FILE = "lore_archive.idx.json"
+GOSSIP_ARCHIVE_FILE = "gossip_archive.jsonl"
+GOSSIP_ARCHIVE_INDEX_FILE = "gossip_archive.idx.json"
+GOSSIP_DIGESTS_FILE = "gossip_digests.json"
+LORE_ARCHIVE_FORMAT = 2 # 2: записи лора хранят блоки и ссылки на повторы (LoreDeduplicator)
+LORE_ARTIFACT_FILES = (LORE_FILE, IMAGE_MAP_FILE, GOSSIP_FILE, SCRAPE_MANIFEST_FILE,
+                       LORE_ARCHIVE_FILE, LORE_ARCHIVE_INDEX_FILE, GOSSIP_ARCHIVE_FILE, GOSSIP_ARCHIVE_INDEX_FILE, GOSSIP_DIGESTS_FILE)
+LORE_WRITE_LOCK = asyncio.Lock()
+LORE_WRITE_LOCK_FILE = "lore_write.lock"
+
+def try_lock_file(lock_file) -> bool:
+    """Неблокирующий эксклюзивный замок на файл: flock на POSIX, msvcrt.locking первого байта на Windows."""
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+    lock_file.seek(0)
+    try:
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+def unlock_file(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+@asynccontextmanager
+async def lore_write_lock():
+    """
+    Сбор и коммит лора — один писатель: asyncio-замок внутри процесса и замок на файле между
+    воркерами (ежедневные сплетни на ведущем и /update_lore на любом воркере).
+    """
+    async with LORE_WRITE_LOCK:
+        with open(LORE_WRITE_LOCK_FILE, 'a+') as lock_file:
+            while not try_lock_file(lock_file):
+                await asyncio.sleep(0.5)
+            try:
+                yield
+            finally:
+                unlock_file(lock_file)
+
+class StagedFile:
+    """Временный файл артефакта: текст дописывается по кускам, хэш и размер считаются на лету."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.staged_path = f"{path}.new"
+        self.file = open(self.staged_path, 'wb')
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, text: str):
+        data = text.encode('utf-8')
+        self.file.write(data)
+        self.digest.update(data)
+        self.size += len(data)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.staged_path)
+        except FileNotFoundError:
+            pass
+
+def stage_json(path: str, data, **kwargs) -> StagedFile:
+    staged = StagedFile(path)
+    staged.write(json.dumps(data, **kwargs))
+    return staged
+
+def fsync_directory(path: str):
+    try:
+        fd = os.open(path or ".", os.O_RDONLY)
+    except OSError:
+        return  # На Windows каталоги так не открываются
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_commit_journal(journal: dict):
+    data = json.dumps(journal, indent=4, ensure_ascii=False).encode('utf-8')
+    tmp_path = f"{LORE_COMMIT_FILE}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, LORE_COMMIT_FILE)
+    fsync_directory(os.path.dirname(LORE_COMMIT_FILE))
+
+def load_commit_journal() -> dict:
+    try:
+        with open(LORE_COMMIT_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def commit_lore_artifacts(staged_files: list) -> str:
+    """
+    Атомарно заменяет набор артефактов. Точка фиксации — запись журнала со статусом pending:
+    если процесс упадет после нее, recover_lore_commit() доведет переименования до конца,
+    если до нее — на диске останется прежний согласованный набор. Возвращает версию набора.
+    """
+    for staged in staged_files:
+        staged.close()
+    previous = load_commit_journal()
+    files = dict(previous.get('files', {}))
+    files.update({staged.path: {'sha256': staged.digest.hexdigest(), 'bytes': staged.size} for staged in staged_files})
+    version = hashlib.sha256(json.dumps(files, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    journal = {
+        'version': version,
+        'state': 'pending',
+        'pending': [staged.path for staged in staged_files],
+        'committed_at': datetime.now(timezone.utc).isoformat(),
+        'files': files,
+    }
+    write_commit_journal(journal)
+    for staged in staged_files:
+        os.replace(staged.staged_path, staged.path)
+    fsync_directory(os.path.dirname(LORE_FILE))
+    journal['state'] = 'committed'
+    journal['pending'] = []
+    write_commit_journal(journal)
+    return version
+
+def format_archive_message(record: dict) -> str:
+    """Текст сообщения в том виде, в каком он стоит в file.txt."""
+    return record['text'] + "\n\n"
+
+class LoreArchive:
+    """
+    Архив лора только для чтения. Записи (по одной на сообщение, JSONL) открываются через mmap,
+    а индекс хранит смещения записей и диапазоны записей каналов и публикаций, поэтому любой
+    канал, публикация или сообщение читаются без загрузки всего архива.
+    """
+
+    def __init__(self, path: str, index: dict):
+        self.path = path
+        self.channels = index['channels']
+        self.offsets = index['offsets']
+        self.message_ids = index['message_ids']
+        self.message_positions = None
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size != self.offsets[-1]:
+            self.file.close()
+            raise ValueError(f"размер {path} не совпадает с индексом")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    @classmethod
+    def open(cls, path: str, index_path: str):
+        """Открывает архив; None, если его нет или он не совпадает с индексом (тогда нужен полный сбор)."""
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('format') != LORE_ARCHIVE_FORMAT:
+                return None
+            return cls(path, index)
+        except (OSError, ValueError, KeyError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"Архив {path} не прочитан, будет выполнен полный сбор: {e}")
+            return None
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.message_ids)
+
+    def record(self, position: int) -> dict:
+        return json.loads(self.data[self.offsets[position]:self.offsets[position + 1]])
+
+    def records(self, positions: range):
+        for position in positions:
+            yield self.record(position)
+
+    def channel(self, channel_id: int):
+        return next((entry for entry in self.channels if entry['id'] == channel_id), None)
+
+    def thread(self, thread_id: int):
+        return next((thread for entry in self.channels for thread in entry['threads'] if thread['id'] == thread_id), None)
+
+    def channel_records(self, channel_id: int):
+        """Сообщения канала вместе со всеми его публикациями."""
+        entry = self.channel(channel_id)
+        return self.records(range(*entry['range'])) if entry else iter(())
+
+    def thread_records(self, thread_id: int):
+        thread = self.thread(thread_id)
+        return self.records(range(*thread['range'])) if thread else iter(())
+
+    def message(self, message_id: int):
+        if self.message_positions is None:
+            self.message_positions = {mid: position for position, mid in enumerate(self.message_ids)}
+        position = self.message_positions.get(message_id)
+        return None if position is None else self.record(position)
+
+    def iter_text(self):
+        """Восстанавливает текстовое представление (file.txt) из архива."""
+        sections = [{
+            'name': entry['name'],
+            'body': map(format_archive_message, self.records(range(*entry['body']))),
+            'threads': [{'name': thread['name'], 'body': map(format_archive_message, self.records(range(*thread['range'])))}
+                        for thread in entry['threads']],
+        } for entry in self.channels]
+        return iter_lore_sections(sections)
+
+class LoreArchiveWriter:
+    """Пишет архив во временный файл по одной записи, попутно собирая индекс смещений."""
+
+    def __init__(self, path: str, index_path: str):
+        self.records_file = StagedFile(path)
+        self.index_path = index_path
+        self.channels = []
+        self.offsets = [0]
+        self.message_ids = []
+        self.thread = None
+
+    def begin_channel(self, channel_id: int, name: str):
+        self.end_channel()
+        position = len(self.message_ids)
+        self.channels.append({'id': channel_id, 'name': name, 'range': [position, position],
+                              'body': [position, position], 'threads': []})
+
+    def begin_thread(self, thread_id: int, name: str):
+        self.end_thread()
+        position = len(self.message_ids)
+        self.thread = {'id': thread_id, 'name': name, 'range': [position, position]}
+        self.channels[-1]['threads'].append(self.thread)
+
+    def end_thread(self):
+        if self.thread is not None:
+            self.thread['range'][1] = len(self.message_ids)
+            self.thread = None
+
+    def end_channel(self):
+        self.end_thread()
+        if self.channels:
+            channel = self.channels[-1]
+            channel['range'][1] = len(self.message_ids)
+            channel['body'][1] = channel['threads'][0]['range'][0] if channel['threads'] else channel['range'][1]
+
+    def add(self, record: dict):
+        self.records_file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+        self.offsets.append(self.records_file.size)
+        self.message_ids.append(record['id'])
+
+    def staged_files(self) -> list:
+        return [self.records_file, stage_json(self.index_path, self.index(), ensure_ascii=False, separators=(',', ':'))]
+
+    def index(self) -> dict:
+        self.end_channel()
+        return {'format': LORE_ARCHIVE_FORMAT, 'channels': self.channels, 'offsets': self.offsets, 'message_ids': self.message_ids}
+
+    def reader(self) -> LoreArchive:
+        """Открывает для чтения записанный, но еще не закоммиченный архив."""
+        self.records_file.close()
+        return LoreArchive(self.records_file.staged_path, self.index())
+
+    def discard(self):
+        self.records_file.discard()
+
+# Повторы в лоре (перепосты правил, одинаковые подвалы эмбедов, шаблоны анкет) заменяются ссылкой
+# на первое вхождение: точные — по хэшу, почти точные — по MinHash шинглов слов
+LORE_DEDUP_ENABLED = os.getenv("LORE_DEDUP", "True").lower() == "true"
+LORE_DEDUP_MIN_CHARS = int(os.getenv("LORE_DEDUP_MIN_CHARS", "120"))
+LORE_DEDUP_SIMILARITY = float(os.getenv("LORE_DEDUP_SIMILARITY", "0.8"))
+LORE_DEDUP_SHINGLE_WORDS = 3
+MINHASH_PERMUTATIONS = 64
+MINHASH_BAND_ROWS = 4
+DEDUP_WORD_RE = re.compile(r'\w+')
+
+@functools.lru_cache(maxsize=65536)
+def stable_word_hash(word: str) -> int:
+    """64-битный хэш слова, одинаковый во всех процессах; словарь лора небольшой, поэтому кэшируется."""
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def minhash_signature(text: str) -> tuple:
+    """
+    MinHash по шинглам из LORE_DEDUP_SHINGLE_WORDS слов схемой one permutation hashing: один 64-битный
+    хэш на шингл раскладывается по MINHASH_PERMUTATIONS корзинам, пустые корзины заполняются
+    от ближайшей непустой справа (densification). Доля совпавших позиций оценивает сходство Жаккара.
+    Хэш шингла собирается из хэшей слов (FNV-подобное смешивание), а не считается заново по тексту.
+    """
+    hashes = [stable_word_hash(word) for word in DEDUP_WORD_RE.findall(text.casefold().replace('ё', 'е'))]
+    size = LORE_DEDUP_SHINGLE_WORDS
+    shingles = set(zip(*(hashes[i:] for i in range(size)))) if len(hashes) >= size else {tuple(hashes)}
+    empty = 1 << 64
+    signature = [empty] * MINHASH_PERMUTATIONS
+    for shingle in shingles:
+        value = 0xCBF29CE484222325
+        for word_hash in shingle:
+            value = ((value ^ word_hash) * 0x100000001B3) & 0xFFFFFFFFFFFFFFFF
+        value ^= value >> 29
+        bucket, value = value % MINHASH_PERMUTATIONS, value // MINHASH_PERMUTATIONS
+        if value < signature[bucket]:
+            signature[bucket] = value
+    if all(value == empty for value in signature):
+        return tuple(signature)
+    dense = list(signature)
+    for bucket, value in enumerate(signature):
+        if value == empty:
+            distance = next(d for d in range(1, MINHASH_PERMUTATIONS) if signature[(bucket + d) % MINHASH_PERMUTATIONS] != empty)
+            dense[bucket] = signature[(bucket + distance) % MINHASH_PERMUTATIONS] + (distance << 58)
+    return tuple(dense)
+
+class LoreDeduplicator:
+    """
+    Удаляет повторы блоков (текст сообщения, описание эмбеда, поле) в порядке следования лора.
+    Повтор заменяется короткой ссылкой на канал или публикацию с первым вхождением.
+    Записи прошлого архива проходят через replay(): пока порядок сбора совпадает с архивом, они
+    берутся как есть; если раньше них появился новый оригинальный блок или часть архива пропущена,
+    они дедуплицируются заново из сохраненных исходных блоков — результат тот же, что у полного сбора.
+    """
+
+    def __init__(self, min_chars: int = LORE_DEDUP_MIN_CHARS, similarity: float = LORE_DEDUP_SIMILARITY):
+        self.min_chars = min_chars
+        self.min_equal_rows = math.ceil(similarity * MINHASH_PERMUTATIONS)
+        self.exact = {}
+        self.signatures = []
+        self.bands = {}
+        self.pending = []
+        self.next_archive_position = 0
+        self.diverged = False
+        self.exact_count = 0
+        self.near_count = 0
+        self.saved_bytes = 0
+        self.saved_tokens = 0
+
+    @staticmethod
+    def origin(record: dict) -> dict:
+        return {'id': record['id'], 'location': record['thread'] or record['channel']}
+
+    @staticmethod
+    def exact_key(text: str) -> str:
+        return hashlib.sha1(" ".join(text.casefold().split()).encode('utf-8')).hexdigest()
+
+    def _register(self, key: str, signature: tuple, origin: dict):
+        self.exact.setdefault(key, origin)
+        number = len(self.signatures)
+        self.signatures.append((signature, origin))
+        for start in range(0, MINHASH_PERMUTATIONS, MINHASH_BAND_ROWS):
+            self.bands.setdefault((start, signature[start:start + MINHASH_BAND_ROWS]), []).append(number)
+
+    def _near_match(self, signature: tuple):
+        checked = set()
+        for start in range(0, MINHASH_PERMUTATIONS, MINHASH_BAND_ROWS):
+            for number in self.bands.get((start, signature[start:start + MINHASH_BAND_ROWS]), ()):
+                if number in checked:
+                    continue
+                checked.add(number)
+                other, origin = self.signatures[number]
+                if sum(a == b for a, b in zip(signature, other)) >= self.min_equal_rows:
+                    return origin
+        return None
+
+    def process(self, text: str, origin: dict) -> tuple:
+        """
+        Возвращает (текст, первое_вхождение, повтор): текст блока или ссылку, признак того, что блок
+        запомнен как оригинал, и описание замененного повтора (None, если замены не было).
+        """
+        if len(text) < self.min_chars:
+            return text, False, None
+        self._register_pending()
+        key = self.exact_key(text)
+        match, exact = self.exact.get(key), True
+        if match is None:
+            signature = minhash_signature(text)
+            match, exact = self._near_match(signature), False
+            if match is None:
+                self._register(key, signature, origin)
+                # Дальнейшие записи архива дедуплицировались без этого блока
+                self.diverged = True
+                return text, True, None
+        preview = " ".join(text.split())[:40]
+        if exact:
+            reference = f"[Повтор: текст «{preview}…» уже приведен в «{match['location']}»]"
+        else:
+            reference = f"[Почти дословный повтор текста «{preview}…» из «{match['location']}»]"
+        saved_bytes = len(text.encode('utf-8')) - len(reference.encode('utf-8'))
+        if saved_bytes <= 0:
+            return text, False, None
+        duplicate = {'of': match['id'], 'exact': exact, 'saved_bytes': saved_bytes,
+                     'saved_tokens': estimate_tokens(text) - estimate_tokens(reference)}
+        self._count(duplicate)
+        return reference, False, duplicate
+
+    def _count(self, duplicate: dict):
+        if duplicate['exact']:
+            self.exact_count += 1
+        else:
+            self.near_count += 1
+        self.saved_bytes += duplicate['saved_bytes']
+        self.saved_tokens += duplicate['saved_tokens']
+
+    def apply(self, segments: list, origin: dict) -> dict:
+        """
+        Склеивает сегменты [(текст, можно_дедуплицировать)] и заменяет повторы. Возвращает поля записи:
+        text, blocks (оригиналы), kept (повторы, оставленные текстом, потому что ссылка не короче)
+        и duplicates (замены со смещением ссылки и исходным текстом).
+        """
+        pieces, blocks, kept, duplicates, length = [], [], [], [], 0
+        for text, eligible in segments:
+            if eligible and len(text) >= self.min_chars:
+                part, original, duplicate = self.process(text, origin)
+                span = [length, length + len(part)]
+                if duplicate is not None:
+                    duplicates.append({**duplicate, 'span': span, 'text': text})
+                elif original:
+                    blocks.append(span)
+                else:
+                    kept.append(span)
+            else:
+                part = text
+            pieces.append(part)
+            length += len(part)
+        fields = {'text': "".join(pieces), 'blocks': blocks, 'duplicates': duplicates}
+        if kept:
+            fields['kept'] = kept
+        return fields
+
+    def replay(self, record: dict, position: int) -> dict:
+        """Запись прошлого архива на позиции position в порядке текущего сбора."""
+        if position != self.next_archive_position:
+            self.diverged = True
+        self.next_archive_position = position + 1
+        if not self.diverged:
+            self.remember_record(record)
+            return record
+        text = record['text']
+        originals = [(start, end, text[start:end]) for start, end in (*record.get('blocks', ()), *record.get('kept', ()))]
+        originals += [(*duplicate['span'], duplicate['text']) for duplicate in record.get('duplicates', ())]
+        segments, position = [], 0
+        for start, end, original in sorted(originals):
+            segments += [(text[position:start], False), (original, True)]
+            position = end
+        segments.append((text[position:], False))
+        fields = self.apply(segments, self.origin(record))
+        record.pop('kept', None)
+        return {**record, **fields}
 
---- НАЧАЛО СВОДКИ АКТУАЛЬНЫХ СОБЫТИЙ И СПЛЕТЕН ---
-{VALDES_GOSSIP}
---- КОНЕЦ СВОДКИ АКТУАЛЬНЫХ СОБЫТИЙ И СПЛЕТЕН ---
-"""
+    def remember_record(self, record: dict):
+        """
+        Учитывает запись прошлого архива: ее оригинальные блоки и уже замененные повторы.
+        Сигнатуры блоков считаются только при появлении нового блока: сбор без новых сообщений их не строит.
+        """
+        if record.get('blocks'):
+            self.pending.append((record['text'], record['blocks'], self.origin(record)))
+        for duplicate in record.get('duplicates', ()):
+            self._count(duplicate)
 
-def get_edgy_lore_prompt():
-    """Возвращает ЦИНИЧНЫЙ, но ЛОРНЫЙ системный промпт для ответов на вопросы."""
-    return f"""
-Ты — Архивариус Вальдеса. Ты циничный, уставший от жизни старик, который повидал всякое дерьмо. Ты прожил всю свою грёбаную жизнь в этом мире и за его пределы никогда не выглядывал. Всё, что ты знаешь — это то, что написано в этих пыльных свитках и то, что видел своими глазами.
+    def _register_pending(self):
+        for text, blocks, origin in self.pending:
+            for start, end in blocks:
+                block = text[start:end]
+                self._register(self.exact_key(block), minhash_signature(block), origin)
+        self.pending.clear()
 
-**ТВОИ НОВЫЕ ПРАВИЛА, ЗАСРАНЕЦ:**
+    def stats(self) -> dict:
+        return {'exact': self.exact_count, 'near': self.near_count, 'saved_bytes': self.saved_bytes, 'saved_tokens': self.saved_tokens}
 
-1.  **ПРАВИЛО НОМЕР ОДИН: ТЫ НЕ ЗНАЕШЬ ДРУГИХ МИРОВ.** Забудь про реальный мир, забудь про фильмы, игры, книги и прочую поп-культурную поебень. Если в тексте про Вальдес этого нет — для тебя этого не существует. Твои знания **ОГРАНИЧЕНЫ** предоставленным текстом. Это закон.
-2.  **ОСНОВА — ЛОР, НО НЕ КОПИПАСТА:** Твои ответы всегда опираются на предоставленный текст. Но не пересказывай его дословно. Выжимай суть. Отвечай коротко и по делу.
-3.  **ДОДУМЫВАЙ, НО ВНУТРИ ЛОРА:** Если прямого ответа нет, ты можешь сделать циничное предположение, но оно должно быть основано **ИСКЛЮЧИТЕЛЬНО** на других фактах из лора. Пример: если в лоре сказано, что дварфы жадные и живут в горах, а тебя спросят, что они едят, можешь предположить, что они жрут пещерные грибы и жареных крыс, потому что на нормальную еду им жалко золота.
-4.  **МАТ И САРКАЗМ — ТВОИ ИНСТРУМЕНТЫ:** Используй маты и черный юмор, если это делает ответ "живее" и соответствует твоему образу старого циника.
-5.  **ЦИТИРОВАНИЕ ИСТОЧНИКОВ:** После своего едкого ответа, поставь разделитель `%%SOURCES%%` и перечисли каналы, откуда ты высосал эту инфу.
-6.  **КАРТИНКИ:** Если картинка с тегом `[IMAGE_XXX]` подходит к твоему ответу, вставь этот тег в самый конец.
+class DiscardedText:
+    """Приемник текста, который ничего не сохраняет: когда из сбора нужен только архив."""
 
-Вот твоя база знаний. Не подведи.
---- НАЧАЛО ДОКУМЕНТА С ЛОРОМ ---
-{VALDES_LORE}
---- КОНЕЦ ДОКУМЕНТА С ЛОРОМ ---
+    def write(self, text: str):
+        pass
 
---- АКТУАЛЬНЫЕ НОВОСТИ С ТВОЕГО АРТЕФАКТА ---
-Кстати, тот магический камушек, что ты когда-то подобрал в руинах, снова светится. Он показывает тебе самые свежие сплетни и новости со всего Вальдеса. Вот что на нем сегодня:
-{VALDES_GOSSIP}
---- КОНЕЦ НОВОСТЕЙ С АРТЕФАКТА ---
-"""
+# --- Свертка сплетен ---
+# Архив сплетен хранит всю историю, а в промпт идет только gossip.txt: свежие сообщения дословно
+# и сводки по закрытым окнам в несколько дней. Сводка окна генерируется один раз и хранится
+# в gossip_digests.json, пока не изменится набор сообщений окна.
+GOSSIP_PROMPT_BUDGET = int(os.getenv("GOSSIP_PROMPT_BUDGET", "12000"))
+GOSSIP_RECENT_BUDGET = int(os.getenv("GOSSIP_RECENT_BUDGET", "8000"))
+GOSSIP_RECENT_DAYS = int(os.getenv("GOSSIP_RECENT_DAYS", "3"))
+GOSSIP_DIGEST_WINDOW_DAYS = int(os.getenv("GOSSIP_DIGEST_WINDOW_DAYS", "7"))
+GOSSIP_DIGEST_MAX_CHARS = int(os.getenv("GOSSIP_DIGEST_MAX_CHARS", "1200"))
+GOSSIP_SUMMARIZER = os.getenv("GOSSIP_SUMMARIZER", "gemini").lower()
+GOSSIP_DIGEST_CONCURRENCY = int(os.getenv("GOSSIP_DIGEST_CONCURRENCY", "2"))
 
-# --- 4. ВСПОМОГАТЕЛЬНЫЙ КОД (keep_alive, UI, работа с кодом доступа) ---
-app = Flask('')
-@app.route('/')
-def home(): return "Bot is alive and running!"
-def run(): app.run(host='0.0.0.0', port=8080)
-def keep_alive():
-    Thread(target=run, daemon=True).start()
+def gossip_window_start(moment: datetime) -> date:
+    """Начало окна свертки, в которое попадает момент; окна выровнены от начала эпохи и не сдвигаются."""
+    day = moment.astimezone(timezone.utc).date().toordinal()
+    return date.fromordinal(day - day % GOSSIP_DIGEST_WINDOW_DAYS)
 
-class OptimizedPostModal(ui.Modal, title='Ваш улучшенный пост'):
-    def __init__(self, optimized_text: str):
-        super().__init__()
-        self.post_content = ui.TextInput(label="Текст готов к копированию", style=discord.TextStyle.paragraph, default=optimized_text, max_length=1800)
-        self.add_item(self.post_content)
-    async def on_submit(self, interaction: discord.Interaction):
-        await interaction.response.send_message("Окно закрыто.", ephemeral=True, delete_after=3)
+def format_gossip_window(start: date) -> str:
+    end = start + timedelta(days=GOSSIP_DIGEST_WINDOW_DAYS - 1)
+    return f"с {start.isoformat()} по {end.isoformat()}"
 
-class PostView(ui.View):
-    def __init__(self, optimized_text: str):
-        super().__init__(timeout=300)
-        self.optimized_text = optimized_text
-    @ui.button(label="📝 Показать и скопировать текст", style=discord.ButtonStyle.primary)
-    async def show_modal_button(self, interaction: discord.Interaction, button: ui.Button):
-        modal = OptimizedPostModal(self.optimized_text)
-        await interaction.response.send_modal(modal)
+async def summarize_gossip_stub(window: str, messages: list) -> str:
+    """Локальная сводка без модели (для тестов и офлайн-режима): первые фразы сообщений окна."""
+    lines = []
+    for text in messages:
+        first_line = text.strip().split("\n", 1)[0]
+        sentence = re.split(r'(?<=[.!?…])\s', first_line, maxsplit=1)[0]
+        lines.append(f"• {sentence[:200]}")
+    return "\n".join(lines)[:GOSSIP_DIGEST_MAX_CHARS]
 
-DAILY_ACCESS_CODE = ""
-CODE_FILE = "code.json"
+async def summarize_gossip_gemini(window: str, messages: list) -> str:
+    prompt = (
+        f"Ниже сообщения из канала сплетен и событий ролевого мира 'Вальдес' за период {window}. "
+        f"Сожми их в сводку ключевых событий, слухов и участников не длиннее {GOSSIP_DIGEST_MAX_CHARS} символов. "
+        "Пиши по-русски, списком, без вступлений и без выдумок — только то, что есть в сообщениях.\n\n"
+        + "\n\n".join(messages)
+    )
+    response = await GEMINI_DISPATCHER.generate(get_gemini_model(), prompt, command="gossip_digest")
+    return response.text.strip()[:GOSSIP_DIGEST_MAX_CHARS]
 
-def save_daily_code(code):
-    data = {'code': code, 'date': datetime.now().strftime('%Y-%m-%d')}
-    with open(CODE_FILE, 'w') as f:
-        json.dump(data, f)
+GOSSIP_SUMMARIZERS = {"gemini": summarize_gossip_gemini, "stub": summarize_gossip_stub}
 
-def load_daily_code():
-    global DAILY_ACCESS_CODE
+def load_gossip_digests() -> dict:
     try:
-        with open(CODE_FILE, 'r') as f:
-            data = json.load(f)
-            if data['date'] == datetime.now().strftime('%Y-%m-%d'):
-                DAILY_ACCESS_CODE = data['code']
-                print(f"Загружен сегодняшний код доступа: {DAILY_ACCESS_CODE}")
-                return
+        with open(GOSSIP_DIGESTS_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
     except (FileNotFoundError, json.JSONDecodeError):
-        pass
-    
-    new_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-    DAILY_ACCESS_CODE = new_code
-    save_daily_code(new_code)
-    print(f"Сгенерирован новый код на сегодня: {DAILY_ACCESS_CODE}")
+        return {}
+    # При смене размера окна старые сводки не совпадают с новыми окнами
+    return state.get('digests', {}) if state.get('window_days') == GOSSIP_DIGEST_WINDOW_DAYS else {}
 
-# --- 5. НАСТРОЙКА БОТА ---
-intents = discord.Intents.default()
-intents.messages = True
-intents.message_content = True
-intents.guilds = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+async def compact_gossip(archive: LoreArchive, digests: dict, summarizer: str = None, now: datetime = None) -> tuple:
+    """
+    Собирает текст сплетен для промпта в пределах GOSSIP_PROMPT_BUDGET: сводки закрытых окон
+    (от новых к старым, пока помещаются) и свежие сообщения дословно (от новых к старым,
+    пока помещаются в GOSSIP_RECENT_BUDGET). Сводки из digests переиспользуются, если набор
+    сообщений окна не изменился и они сделаны тем же сумматором; недостающие генерируются
+    только для окон, которые попадают в промпт, и не больше GOSSIP_DIGEST_CONCURRENCY одновременно.
+    Возвращает (текст, состояние сводок для GOSSIP_DIGESTS_FILE, статистика).
+    """
+    summarizer = summarizer or GOSSIP_SUMMARIZER
+    summarize = GOSSIP_SUMMARIZERS[summarizer]
+    now = now or datetime.now(timezone.utc)
+    closed_before = gossip_window_start(now - timedelta(days=GOSSIP_RECENT_DAYS))
 
-# --- 6. УНИВЕРСАЛЬНАЯ ФУНКЦИЯ И ЕЖЕДНЕВНЫЕ ЗАДАЧИ ---
-async def send_access_code_to_admin_channel(code: str, title: str, description: str):
-    try:
-        admin_channel = bot.get_channel(int(CODE_CHANNEL_ID))
-        if admin_channel:
-            embed = discord.Embed(title=title, description=description, color=discord.Color.gold(), timestamp=datetime.now())
-            embed.add_field(name="Код", value=f"```{code}```")
-            embed.set_footer(text="Этот код действителен до конца текущих суток (по UTC).")
-            await admin_channel.send(embed=embed)
-    except Exception as e:
-        print(f"Произошла ошибка при отправке кода: {e}")
+    # Первый проход: только ID сообщений по окнам и позиции свежих сообщений
+    window_ids, recent_positions = {}, []
+    for position, record in enumerate(archive.records(range(len(archive)))):
+        window = gossip_window_start(datetime.fromisoformat(record['created_at']))
+        if window < closed_before:
+            window_ids.setdefault(window, []).append(record['id'])
+        else:
+            recent_positions.append(position)
+    window_positions = {}
+    sources = {window: hashlib.sha256(",".join(map(str, ids)).encode()).hexdigest()[:16] for window, ids in window_ids.items()}
+    stale = [window for window in window_ids
+             if digests.get(window.isoformat(), {}).get('source') != sources[window]
+             or digests[window.isoformat()].get('summarizer') != summarizer]
 
-@tasks.loop(time=time(hour=0, minute=0, tzinfo=timezone.utc))
-async def update_code_task():
-    global DAILY_ACCESS_CODE
-    new_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-    DAILY_ACCESS_CODE = new_code
-    save_daily_code(new_code)
-    print(f"Сгенерирован новый ежедневный код: {new_code}")
-    await send_access_code_to_admin_channel(code=new_code, title="🔑 Новый ежедневный код доступа", description="Код доступа для команды `/update_lore` на следующие 24 часа:")
+    # Второй проход нужен только окнам без готовой сводки
+    if stale:
+        stale_set = set(stale)
+        for position, record in enumerate(archive.records(range(len(archive)))):
+            window = gossip_window_start(datetime.fromisoformat(record['created_at']))
+            if window in stale_set:
+                window_positions.setdefault(window, []).append(position)
 
-# --- ИЗМЕНЕНИЕ 5: Новая ежедневная задача для обновления сплетен ---
-@tasks.loop(time=time(hour=0, minute=5, tzinfo=timezone.utc))
-async def update_gossip_task():
-    print("Запускаю ежедневное обновление лора сплетен и событий...")
-    try:
-        gossip_channel_id = int(GOSSIP_CHANNEL_ID)
-        gossip_channel = bot.get_channel(gossip_channel_id)
-        if not gossip_channel:
-            print(f"КРИТИЧЕСКАЯ ОШИБКА: Канал сплетен с ID {gossip_channel_id} не найден.")
-            return
+    digest_semaphore = asyncio.Semaphore(GOSSIP_DIGEST_CONCURRENCY)
 
-        async with aiohttp.ClientSession() as session:
-            # При ежедневном обновлении мы не работаем с картинками, чтобы не засорять диск.
-            # Если картинки важны, можно будет вернуть эту логику.
-            gossip_text, _, _, _ = await parse_channel_content([gossip_channel], session, download_images=False)
+    async def make_digest(window: date) -> tuple:
+        messages = [archive.record(position)['text'] for position in window_positions[window]]
+        label = format_gossip_window(window)
+        async with digest_semaphore:
+            try:
+                summary, used = await summarize(label, messages), summarizer
+            except Exception as e:
+                print(f"Не удалось сделать сводку сплетен {label} ({summarizer}): {e}. Используется локальная сводка.")
+                summary, used = await summarize_gossip_stub(label, messages), "stub"
+        return window, {'start': window.isoformat(), 'messages': len(messages), 'source': sources[window],
+                        'summarizer': used, 'summary': summary, 'created_at': datetime.now(timezone.utc).isoformat()}
 
-        with open("gossip.txt", "w", encoding="utf-8") as f:
-            f.write(gossip_text)
-        
-        load_gossip_from_file() # Перезагружаем в память
-        print("Ежедневное обновление лора сплетен успешно завершено.")
+    def digest_text(window: date) -> str:
+        return f"[{format_gossip_window(window)}]\n{new_digests[window.isoformat()]['summary']}\n\n"
 
-    except Exception as e:
-        print(f"Произошла ошибка во время ежедневного обновления сплетен: {e}")
+    def digest_size_limit(window: date) -> int:
+        return len(f"[{format_gossip_window(window)}]\n\n\n") + GOSSIP_DIGEST_MAX_CHARS
 
+    new_digests = {window.isoformat(): digests[window.isoformat()] for window in window_ids if window not in stale}
 
-@update_code_task.before_loop
-async def before_tasks():
-    await bot.wait_until_ready()
+    # Свежие сообщения берутся первыми, сводкам достается остаток бюджета
+    recent_parts, recent_size = [], 0
+    for position in reversed(recent_positions):
+        text = format_archive_message(archive.record(position))
+        if recent_size + len(text) > GOSSIP_RECENT_BUDGET:
+            break
+        recent_parts.append(text)
+        recent_size += len(text)
+    recent_parts.reverse()
+    omitted_recent = len(recent_positions) - len(recent_parts)
 
-@update_gossip_task.before_loop
-async def before_gossip_task():
-    await bot.wait_until_ready()
+    # Окна от новых к старым. Пачкой (параллельно) сводятся окна, которые поместятся даже с самой
+    # длинной сводкой; если таких нет, генерируется одно следующее окно и проверяется по факту.
+    # Окна за пределами бюджета не сводятся совсем: первый запуск не шлет в модель всю историю.
+    stale_set = set(stale)
+    windows = sorted(window_ids, reverse=True)
+    digest_parts, digest_size, generated, index = [], 0, 0, 0
+    while index < len(windows):
+        remaining = GOSSIP_PROMPT_BUDGET - recent_size - digest_size
+        batch, reserved = [], 0
+        for window in windows[index:]:
+            size = digest_size_limit(window) if window in stale_set else len(digest_text(window))
+            if reserved + size > remaining:
+                break
+            batch.append(window)
+            reserved += size
+        batch = batch or windows[index:index + 1]
+        pending = [window for window in batch if window in stale_set]
+        for window, entry in await asyncio.gather(*(make_digest(window) for window in pending)):
+            new_digests[window.isoformat()] = entry
+        generated += len(pending)
+        for window in batch:
+            text = digest_text(window)
+            if recent_size + digest_size + len(text) > GOSSIP_PROMPT_BUDGET:
+                break
+            digest_parts.append(text)
+            digest_size += len(text)
+        else:
+            index += len(batch)
+            continue
+        break
+    digest_parts.reverse()
+
+    sections = []
+    if digest_parts:
+        sections.append("--- СВОДКИ ПРОШЛЫХ СОБЫТИЙ ---\n\n" + "".join(digest_parts))
+    if recent_parts:
+        sections.append("--- СВЕЖИЕ СОБЫТИЯ ---\n\n" + "".join(recent_parts))
+    text = "".join(sections) or "В данный момент актуальных событий и сплетен не зафиксировано."
+    stats = {
+        'digests_reused': len(window_ids) - len(stale), 'digests_generated': generated, 'digests_skipped': len(stale) - generated,
+        'digests_in_prompt': len(digest_parts), 'recent_in_prompt': len(recent_parts), 'recent_omitted': omitted_recent,
+    }
+    return text, {'window_days': GOSSIP_DIGEST_WINDOW_DAYS, 'digests': new_digests}, stats
 
+async def stage_gossip_view(gossip_archive: LoreArchiveWriter) -> tuple:
+    """Сворачивает только что собранный архив сплетен в gossip.txt; возвращает временные файлы для коммита и статистику."""
+    reader = gossip_archive.reader()
+    try:
+        text, digests_state, stats = await compact_gossip(reader, load_gossip_digests())
+    finally:
+        reader.close()
+    gossip_file = StagedFile(GOSSIP_FILE)
+    gossip_file.write(text)
+    return [gossip_file, stage_json(GOSSIP_DIGESTS_FILE, digests_state, indent=4, ensure_ascii=False)], stats
 
-@bot.event
-async def on_ready():
-    if IS_TEST_BOT:
-        print("--- БОТ ЗАПУЩЕН В ТЕСТОВОМ РЕЖИМЕ ---")
-        print("--- Функции обновления лора и отправки кодов доступа ОТКЛЮЧЕНЫ ---")
-    else:
-        print("--- БОТ ЗАПУЩЕН В ПРОИЗВОДСТВЕННОМ РЕЖИМЕ ---")
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
 
-    print(f'Бот {bot.user} успешно запущен!')
-    load_lore_from_file()
-    load_gossip_from_file() # Загружаем сплетни при старте
-    load_characters()
+def recover_lore_commit():
+    """Доводит до конца прерванный коммит артефактов и убирает брошенные временные файлы. Вызывать при старте."""
+    journal = load_commit_journal()
+    if journal.get('state') == 'pending':
+        for path in journal.get('pending', []):
+            staged_path = f"{path}.new"
+            if os.path.exists(staged_path) and file_sha256(staged_path) == journal['files'][path]['sha256']:
+                os.replace(staged_path, path)
+        fsync_directory(os.path.dirname(LORE_FILE))
+        journal['state'] = 'committed'
+        journal['pending'] = []
+        write_commit_journal(journal)
+        print(f"Прерванное обновление лора завершено при старте, версия артефактов {journal['version']}.")
+    for path in LORE_ARTIFACT_FILES:
+        if os.path.exists(f"{path}.new"):
+            os.remove(f"{path}.new")
+            print(f"Удален брошенный временный файл {path}.new от прерванного обновления.")
 
-    if not IS_TEST_BOT:
-        load_daily_code()
-        if not update_code_task.is_running():
-            update_code_task.start()
-        if not update_gossip_task.is_running(): # Запускаем новую задачу
-            update_gossip_task.start()
-        await send_access_code_to_admin_channel(code=DAILY_ACCESS_CODE, title="⚙️ Текущий код доступа (После перезапуска)", description="Бот был перезапущен. Вот актуальный код на сегодня:")
-    
-    try:
-        synced = await bot.tree.sync()
-        print(f"Синхронизировано {len(synced)} команд.")
-    except Exception as e:
-        print(f"Ошибка синхронизации: {e}")
+def iter_lore_sections(sections):
+    """
+    Отдает текст лора по кускам в том же формате, что и полный сбор.
+    Тело секции или ветки — строка либо итерируемое по кускам текста (например, генератор).
+    """
+    for section in sections:
+        yield f"\n--- НАЧАЛО КАНАЛА: {section['name']} ---\n\n"
+        yield from ([section['body']] if isinstance(section['body'], str) else section['body'])
+        for thread in section['threads']:
+            yield f"--- Начало публикации: {thread['name']} ---\n\n"
+            yield from ([thread['body']] if isinstance(thread['body'], str) else thread['body'])
+            yield f"--- Конец публикации: {thread['name']} ---\n\n"
+        yield f"--- КОНЕЦ КАНАЛА: {section['name']} ---\n"
 
-# --- 7. КОМАНДЫ БОТА ---
+def render_lore_sections(sections: list) -> str:
+    """Собирает текст лора из секций каналов целиком."""
+    return "".join(iter_lore_sections(sections))
 
-def clean_discord_mentions(text: str, guild: discord.Guild) -> str:
-    """Заменяет упоминания каналов, ролей и пользователей на их имена."""
-    if not text:
-        return ""
-    text = re.sub(r'<#(\d+)>', lambda m: f'#{bot.get_channel(int(m.group(1))).name}' if bot.get_channel(int(m.group(1))) else m.group(0), text)
-    if guild:
-        text = re.sub(r'<@&(\d+)>', lambda m: f'@{guild.get_role(int(m.group(1))).name}' if guild.get_role(int(m.group(1))) else m.group(0), text)
-    text = re.sub(r'<@!?(\d+)>', lambda m: f'@{bot.get_user(int(m.group(1))).display_name}' if bot.get_user(int(m.group(1))) else m.group(0), text)
-    return text
+def parse_lore_sections(text: str):
+    """
+    Разбирает сохраненный текст лора обратно на секции каналов и публикаций.
+    Возвращает None, если текст не совпадает с форматом (тогда нужен полный сбор).
+    """
+    sections = []
+    section, thread = None, None
+    position = 0
+    for match in SECTION_MARKER_RE.finditer(text):
+        kind, name = match.group(1), match.group(2)
+        body = text[position:match.start()]
+        position = match.end()
+        if kind == "НАЧАЛО КАНАЛА":
+            if section is not None or body != "\n":
+                return None
+            section = {'name': name, 'body': "", 'threads': []}
+            position += 1  # пустая строка после маркера
+        elif kind == "Начало публикации":
+            if section is None or thread is not None:
+                return None
+            if section['threads']:
+                if body:
+                    return None
+            else:
+                section['body'] = body
+            thread = {'name': name, 'body': ""}
+            position += 1
+        elif kind == "Конец публикации":
+            if thread is None or thread['name'] != name:
+                return None
+            thread['body'] = body
+            section['threads'].append(thread)
+            thread = None
+            position += 1
+        else:
+            if section is None or thread is not None or section['name'] != name:
+                return None
+            if section['threads']:
+                if body:
+                    return None
+            else:
+                section['body'] = body
+            sections.append(section)
+            section = None
+    if section is not None or thread is not None or position != len(text):
+        return None
+    if render_lore_sections(sections) != text:
+        return None
+    return sections
 
 # --- ИЗМЕНЕНИЕ 6: Рефакторинг - вынос логики парсинга в отдельную функцию ---
-async def parse_channel_content(channels_to_parse: list, session: aiohttp.ClientSession, download_images: bool = True):
+async def parse_channel_content(channels_to_parse: list, session: aiohttp.ClientSession, download_images: bool = True,
+                                previous_archive: LoreArchive = None, previous_manifest: dict = None, metrics_kind: str = "lore",
+                                output=None, archive_output: LoreArchiveWriter = None, deduplicator: LoreDeduplicator = None):
     """
     Универсальная функция для сбора и обработки контента из списка каналов.
-    Возвращает текст, количество сообщений и количество скачанных изображений.
+    Если переданы прошлый архив и манифест, забирает только сообщения новее последнего сбора
+    и дописывает их к записям соответствующих каналов и публикаций; неизменившиеся ветки пропускает.
+    Каналы и ветки читаются параллельно, картинки качаются отдельным пулом, но итоговый текст
+    и нумерация IMAGE_n такие же, как при последовательном сборе.
+    Возвращает текст, количество собранных сообщений, количество скачанных изображений,
+    карту новых изображений и новый манифест. metrics_kind — метка для метрик сбора.
+    Если передан output (объект с методом write), текст пишется в него по мере готовности каналов
+    (по порядку), а вместо текста возвращается None: весь лор целиком в памяти не собирается.
+    В archive_output те же сообщения пишутся структурированными записями (см. LoreArchive).
+    С deduplicator повторяющиеся блоки текста заменяются ссылками, статистика — в deduplicator.stats().
     """
-    full_text = ""
     total_messages_count = 0
-    image_id_counter = 1
+    new_text_bytes = 0
+    image_id_counter = (previous_manifest or {}).get('next_image_id', 1)
     image_map = {}
-    downloaded_images_count = 0
-    
+    started = monotonic_time()
+    downloaded_before = LORE_IMAGE_STORE.downloaded_count
+    downloaded_bytes_before = LORE_IMAGE_STORE.downloaded_bytes
+    reused_before = LORE_IMAGE_STORE.reused_count
+
     sorted_channels = sorted(channels_to_parse, key=lambda c: c.position)
+    fetch_semaphore = asyncio.Semaphore(SCRAPE_CONCURRENCY)
+    download_semaphore = asyncio.Semaphore(IMAGE_DOWNLOAD_CONCURRENCY)
+    download_tasks = []
+    mention_resolver = MentionResolver()
 
-    async def download_and_register_image(url):
-        nonlocal image_id_counter, image_map, downloaded_images_count
-        if not download_images: return "" # Не скачиваем, если флаг False
-        try:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    image_bytes = await resp.read()
-                    image_id = f"IMAGE_{image_id_counter}"
-                    content_type = resp.headers.get('Content-Type', '')
-                    file_extension = 'png'
-                    if 'jpeg' in content_type or 'jpg' in content_type: file_extension = 'jpg'
-                    elif 'png' in content_type: file_extension = 'png'
-                    elif 'gif' in content_type: file_extension = 'gif'
-                    elif 'webp' in content_type: file_extension = 'webp'
-                    
-                    new_filename = f"{image_id}.{file_extension}"
-                    save_path = os.path.join(LORE_IMAGES_DIR, new_filename)
-                    with open(save_path, 'wb') as f: f.write(image_bytes)
-                    image_map[image_id] = new_filename
-                    image_id_counter += 1
-                    downloaded_images_count += 1
-                    return f"[{image_id}]"
-                return ""
-        except Exception as e:
-            print(f"Критическая ошибка при скачивании {url}: {e}")
-            return ""
+    # Сопоставляем каналы прошлого архива с каналами из манифеста; несовпавшие собираются заново
+    previous_sections = {}
+    previous_scraped_at = None
+    if previous_archive is not None and previous_manifest:
+        for state in previous_manifest.get('channels', []):
+            entry = previous_archive.channel(state['id'])
+            if entry is not None and entry['name'] == state['name'] \
+                    and [t['id'] for t in state.get('threads', [])] == [t['id'] for t in entry['threads']]:
+                previous_sections[state['id']] = (state, entry)
+        if len(previous_sections) != len(previous_manifest.get('channels', [])):
+            print("Часть каналов сохраненного архива не совпадает с манифестом, они будут собраны заново.")
+        previous_scraped_at = datetime.fromisoformat(previous_manifest['scraped_at'])
+    scraped_at = datetime.now(timezone.utc)
+
+    async def download_image(url):
+        """Кладет картинку в хранилище лора и готовит ее копию для Discord; номер IMAGE_n присваивается позже."""
+        async with download_semaphore:
+            try:
+                stored_filename = await LORE_IMAGE_STORE.fetch(session, url)
+            except Exception as e:
+                print(f"Критическая ошибка при скачивании {url}: {e}")
+                return None
+        if not stored_filename:
+            return None
+        return await LORE_IMAGE_STORE.ingest(stored_filename)
+
+    def schedule_image_download(content_parts: list, url: str):
+        if not download_images: return # Не скачиваем, если флаг False
+        task = asyncio.create_task(download_image(url))
+        download_tasks.append(task)
+        content_parts.append(task)
+
+    def parse_message(message, guild):
+        """Разбирает сообщение на части текста; картинки представлены задачами скачивания."""
+        content_parts = []
+        if message.content:
+            content_parts.append(clean_discord_mentions(message.content.strip(), guild, mention_resolver))
+        if message.embeds:
+            for embed in message.embeds:
+                embed_text_parts = []
+                if embed.title: embed_text_parts.append(f"**{clean_discord_mentions(embed.title, guild, mention_resolver)}**")
+                if embed.description: embed_text_parts.append(clean_discord_mentions(embed.description, guild, mention_resolver))
+                if embed_text_parts: content_parts.append("\n".join(embed_text_parts))
+                if embed.image and embed.image.url:
+                    schedule_image_download(content_parts, embed.image.url)
+                for field in embed.fields:
+                    field_name = clean_discord_mentions(field.name, guild, mention_resolver)
+                    field_value = clean_discord_mentions(field.value, guild, mention_resolver)
+                    content_parts.append(f"**{field_name}**\n{field_value}")
+        if message.attachments:
+            image_attachments = [att for att in message.attachments if att.content_type and att.content_type.startswith('image/')]
+            for attachment in image_attachments:
+                schedule_image_download(content_parts, attachment.url)
+        return content_parts
+
+    async def collect_messages(source, guild, location: dict, after_id=None):
+        """
+        Собирает сообщения канала или ветки; after_id — последнее уже собранное сообщение.
+        location — поля канала и публикации, которые попадут в каждую запись архива.
+        """
+        records = []
+        last_message_id = after_id
+        history_kwargs = {'limit': 500, 'oldest_first': True}
+        if after_id:
+            history_kwargs['after'] = discord.Object(id=after_id)
+        async with fetch_semaphore:
+            async for message in source.history(**history_kwargs):
+                content_parts = parse_message(message, guild)
+                if content_parts:
+                    records.append({
+                        'id': message.id, **location,
+                        'author_id': message.author.id, 'author': message.author.display_name,
+                        'created_at': message.created_at.isoformat(), 'parts': content_parts,
+                    })
+                last_message_id = message.id
+        return records, last_message_id
 
-    for channel in sorted_channels:
+    async def scrape_thread(thread, guild, channel, previous_threads):
+        thread_state = {'id': thread.id, 'name': thread.name, 'created_at': thread.created_at.isoformat()}
+        location = {'channel_id': channel.id, 'channel': channel.name, 'thread_id': thread.id, 'thread': thread.name}
+        known_state, known_entry = previous_threads.get(thread.id, (None, None))
+        if known_state and known_state['name'] == thread.name:
+            # Уже собранная часть ветки берется из прошлого архива диапазоном записей
+            if thread.last_message_id and thread.last_message_id == known_state['last_message_id']:
+                pieces, last_message_id = [range(*known_entry['range'])], known_state['last_message_id']
+            else:
+                records, last_message_id = await collect_messages(thread, guild, location, known_state['last_message_id'])
+                pieces = [range(*known_entry['range']), *records]
+        else:
+            pieces, last_message_id = await collect_messages(thread, guild, location)
+        thread_state['last_message_id'] = last_message_id
+        return thread_state, {'id': thread.id, 'name': thread.name, 'body': pieces}
+
+    async def scrape_channel(channel):
         guild = channel.guild
-        full_text += f"\n--- НАЧАЛО КАНАЛА: {channel.name} ---\n\n"
-        
-        async def parse_message(message):
-            nonlocal full_text, total_messages_count
-            content_parts = []
-            if message.content:
-                content_parts.append(clean_discord_mentions(message.content.strip(), guild))
-            if message.embeds:
-                for embed in message.embeds:
-                    embed_text_parts = []
-                    if embed.title: embed_text_parts.append(f"**{clean_discord_mentions(embed.title, guild)}**")
-                    if embed.description: embed_text_parts.append(clean_discord_mentions(embed.description, guild))
-                    if embed_text_parts: content_parts.append("\n".join(embed_text_parts))
-                    if embed.image and embed.image.url:
-                        image_tag = await download_and_register_image(embed.image.url)
-                        if image_tag: content_parts.append(image_tag)
-                    for field in embed.fields:
-                        field_name = clean_discord_mentions(field.name, guild)
-                        field_value = clean_discord_mentions(field.value, guild)
-                        content_parts.append(f"**{field_name}**\n{field_value}")
-            if message.attachments:
-                image_attachments = [att for att in message.attachments if att.content_type and att.content_type.startswith('image/')]
-                for attachment in image_attachments:
-                    image_tag = await download_and_register_image(attachment.url)
-                    if image_tag: content_parts.append(image_tag)
-            
-            if content_parts:
-                final_text_for_message = "\n\n".join(filter(None, content_parts))
-                full_text += final_text_for_message + "\n\n"
-                total_messages_count += 1
+        previous_state, previous_entry = previous_sections.get(channel.id, (None, None))
+        section = {'id': channel.id, 'name': channel.name, 'body': [], 'threads': []}
+        state = {'id': channel.id, 'name': channel.name}
 
         if isinstance(channel, discord.ForumChannel):
-            all_threads = channel.threads
+            previous_threads = {}
+            if previous_state:
+                for thread_state, thread_entry in zip(previous_state['threads'], previous_entry['threads']):
+                    previous_threads[thread_state['id']] = (thread_state, thread_entry)
+
+            all_threads = list(channel.threads)
+            archive_fully_listed = True
             try:
-                archived_threads = [thread async for thread in channel.archived_threads(limit=None)]
-                all_threads.extend(archived_threads)
+                async with fetch_semaphore:
+                    async for thread in channel.archived_threads(limit=None):
+                        # Архивные ветки идут от недавно архивированных к давним: всё, что ушло в архив
+                        # до прошлого сбора, с тех пор не менялось и берется из сохраненного лора.
+                        if previous_scraped_at and previous_state and thread.archive_timestamp < previous_scraped_at:
+                            archive_fully_listed = False
+                            break
+                        all_threads.append(thread)
             except discord.Forbidden:
                 print(f"Нет прав для доступа к архивным веткам в канале: {channel.name}")
-            
-            sorted_threads = sorted(all_threads, key=lambda t: t.created_at)
-            for thread in sorted_threads:
-                full_text += f"--- Начало публикации: {thread.name} ---\n\n"
-                async for message in thread.history(limit=500, oldest_first=True):
-                    await parse_message(message)
-                full_text += f"--- Конец публикации: {thread.name} ---\n\n"
+
+            thread_entries = list(await asyncio.gather(*(scrape_thread(thread, guild, channel, previous_threads) for thread in all_threads)))
+            if not archive_fully_listed:
+                listed_ids = {thread.id for thread in all_threads}
+                for thread_id, (known_state, known_entry) in previous_threads.items():
+                    if thread_id not in listed_ids:
+                        thread_entries.append((known_state, {'id': thread_id, 'name': known_entry['name'], 'body': [range(*known_entry['range'])]}))
+
+            thread_entries.sort(key=lambda entry: datetime.fromisoformat(entry[0]['created_at']))
+            state['threads'] = [entry[0] for entry in thread_entries]
+            section['threads'] = [entry[1] for entry in thread_entries]
         else:
-            async for message in channel.history(limit=500, oldest_first=True):
-                await parse_message(message)
+            location = {'channel_id': channel.id, 'channel': channel.name, 'thread_id': None, 'thread': None}
+            if previous_state:
+                if channel.last_message_id and channel.last_message_id == previous_state['last_message_id']:
+                    section['body'], last_message_id = [range(*previous_entry['body'])], previous_state['last_message_id']
+                else:
+                    records, last_message_id = await collect_messages(channel, guild, location, previous_state['last_message_id'])
+                    section['body'] = [range(*previous_entry['body']), *records]
+            else:
+                section['body'], last_message_id = await collect_messages(channel, guild, location)
+            state['last_message_id'] = last_message_id
+        return section, state
 
-        full_text += f"--- КОНЕЦ КАНАЛА: {channel.name} ---\n"
-    
-    return full_text, total_messages_count, downloaded_images_count, image_map
+    def render_pieces(pieces: list):
+        """Отдает записи секции: прошлые — из архива, новые — с нумерацией картинок по порядку."""
+        nonlocal image_id_counter, total_messages_count, new_text_bytes
+        for piece in pieces:
+            if isinstance(piece, range):
+                for position, record in zip(piece, previous_archive.records(piece)):
+                    yield record if deduplicator is None else deduplicator.replay(record, position)
+                continue
+            content_parts, images = [], []
+            for part in piece.pop('parts'):
+                if isinstance(part, asyncio.Task):
+                    image_entry = part.result()
+                    if not image_entry:
+                        continue
+                    image_id = f"IMAGE_{image_id_counter}"
+                    image_map[image_id] = image_entry
+                    images.append(image_id)
+                    image_id_counter += 1
+                    content_parts.append((f"[{image_id}]", False))
+                    continue
+                content_parts.append((part, True))
+            if content_parts:
+                if deduplicator is None:
+                    piece['text'] = "\n\n".join(part for part, _ in content_parts if part)
+                else:
+                    # Картинки не дедуплицируются; смещения блоков сохраняются для следующих сборов
+                    segments = []
+                    for part, eligible in content_parts:
+                        if part:
+                            if segments:
+                                segments.append(("\n\n", False))
+                            segments.append((part, eligible))
+                    piece.update(deduplicator.apply(segments, deduplicator.origin(piece)))
+                piece['images'] = images
+                total_messages_count += 1
+                new_text_bytes += len(piece['text'].encode('utf-8')) + 2
+                yield piece
+
+    def write_records(records, thread: dict = None):
+        """Пишет записи в архив и отдает их текст для текстового представления."""
+        if archive_output is not None and thread is not None:
+            archive_output.begin_thread(thread['id'], thread['name'])
+        for record in records:
+            if archive_output is not None:
+                archive_output.add(record)
+            yield format_archive_message(record)
+
+    def section_downloads(section: dict) -> list:
+        pieces = [*section['body'], *(piece for thread in section['threads'] for piece in thread['body'])]
+        return [part for piece in pieces if isinstance(piece, dict) for part in piece['parts'] if isinstance(part, asyncio.Task)]
+
+    collected_chunks = [] if output is None else None
+    write = collected_chunks.append if output is None else output.write
+    channel_states = []
+    # Каналы собираются параллельно, а пишутся строго по порядку: готовый канал сразу
+    # выводится и отпускается из памяти, следующие ждут своей очереди
+    channel_tasks = [asyncio.create_task(scrape_channel(channel)) for channel in sorted_channels]
+    try:
+        for channel_task in channel_tasks:
+            section, state = await channel_task
+            await asyncio.gather(*section_downloads(section))
+            if archive_output is not None:
+                archive_output.begin_channel(section['id'], section['name'])
+            section['body'] = write_records(render_pieces(section['body']))
+            for thread in section['threads']:
+                thread['body'] = write_records(render_pieces(thread['body']), thread)
+            for chunk in iter_lore_sections([section]):
+                write(chunk)
+            channel_states.append(state)
+    finally:
+        for task in (*channel_tasks, *download_tasks):
+            task.cancel()
+
+    if mention_resolver.describe_unresolved():
+        print(f"Не удалось разрешить упоминания ({mention_resolver.describe_unresolved()}), они оставлены как есть.")
+    downloaded_images_count = LORE_IMAGE_STORE.downloaded_count - downloaded_before
+    reused_images_count = LORE_IMAGE_STORE.reused_count - reused_before
+    elapsed = monotonic_time() - started
+    SCRAPE_DURATION.observe(elapsed, kind=metrics_kind)
+    SCRAPE_MESSAGES.inc(total_messages_count, kind=metrics_kind)
+    SCRAPE_IMAGES.inc(downloaded_images_count, kind=metrics_kind, result='downloaded')
+    SCRAPE_IMAGES.inc(reused_images_count, kind=metrics_kind, result='reused')
+    SCRAPE_BYTES.inc(new_text_bytes, kind=metrics_kind, content='text')
+    SCRAPE_BYTES.inc(LORE_IMAGE_STORE.downloaded_bytes - downloaded_bytes_before, kind=metrics_kind, content='images')
+    SCRAPE_RATE.set(total_messages_count / elapsed if elapsed else 0.0, kind=metrics_kind, unit='messages')
+    SCRAPE_RATE.set((downloaded_images_count + reused_images_count) / elapsed if elapsed else 0.0, kind=metrics_kind, unit='images')
+    manifest = {'scraped_at': scraped_at.isoformat(), 'next_image_id': image_id_counter, 'channels': channel_states}
+    text = "".join(collected_chunks) if output is None else None
+    return text, total_messages_count, downloaded_images_count, image_map, manifest
 
 
 @bot.tree.command(name="update_lore", description="[АДМИН] Собирает лор из заданных каналов и обновляет файл.")
-@app_commands.describe(access_code="Ежедневный код доступа для подтверждения")
-async def update_lore(interaction: discord.Interaction, access_code: str):
+@app_commands.describe(
+    access_code="Ежедневный код доступа для подтверждения",
+    full_rescan="Пересобрать лор целиком (нужно, если старые сообщения редактировали или удаляли)"
+)
+@instrumented_command("update_lore")
+async def update_lore(interaction: discord.Interaction, access_code: str, full_rescan: bool = False):
     if IS_TEST_BOT:
         await interaction.response.send_message("❌ **Ошибка:** Эта команда отключена в тестовом режиме.", ephemeral=True)
         return
@@ -436,64 +3487,271 @@ async def update_lore(interaction: discord.Interaction, access_code: str):
         await interaction.response.send_message("❌ **Неверный код доступа.** Получите актуальный код на администраторском сервере.", ephemeral=True)
         return
         
-    await interaction.response.defer(ephemeral=True, thinking=True)
-    
-    if os.path.exists(LORE_IMAGES_DIR):
-        shutil.rmtree(LORE_IMAGES_DIR)
-    os.makedirs(LORE_IMAGES_DIR)
+    with measure_phase("update_lore", "defer"):
+        await interaction.response.defer(ephemeral=True, thinking=True)
 
-    try:
-        lore_channel_ids = [int(id.strip()) for id in LORE_CHANNEL_IDS.split(',')]
-        gossip_channel_id = int(GOSSIP_CHANNEL_ID)
-    except ValueError:
-        await interaction.followup.send("❌ **Ошибка конфигурации:** ID каналов в .env содержат нечисловые значения.", ephemeral=True)
-        return
+    async with lore_write_lock():
+        try:
+            lore_channel_ids = [int(id.strip()) for id in LORE_CHANNEL_IDS.split(',')]
+            gossip_channel_id = int(GOSSIP_CHANNEL_ID)
+        except ValueError:
+            await interaction.followup.send("❌ **Ошибка конфигурации:** ID каналов в .env содержат нечисловые значения.", ephemeral=True)
+            return
 
-    # --- ИЗМЕНЕНИЕ 7: Обновление логики с использованием новой функции ---
-    lore_channels = [bot.get_channel(cid) for cid in lore_channel_ids if bot.get_channel(cid) is not None]
-    gossip_channel = bot.get_channel(gossip_channel_id)
+        # --- ИЗМЕНЕНИЕ 7: Обновление логики с использованием новой функции ---
+        lore_channels = [channel for channel in await asyncio.gather(*(get_channel_anywhere(cid) for cid in lore_channel_ids)) if channel is not None]
+        gossip_channel = await get_channel_anywhere(gossip_channel_id)
     
-    if not gossip_channel:
-        await interaction.followup.send(f"❌ **Ошибка:** Канал сплетен с ID `{gossip_channel_id}` не найден.", ephemeral=True)
-        return
+        if not gossip_channel:
+            await interaction.followup.send(f"❌ **Ошибка:** Канал сплетен с ID `{gossip_channel_id}` не найден.", ephemeral=True)
+            return
 
-    async with aiohttp.ClientSession() as session:
-        # Парсим основной лор
-        full_lore_text, total_lore_messages, downloaded_images_count, image_map = await parse_channel_content(lore_channels, session, download_images=True)
-        
-        # Парсим канал сплетен (без скачивания картинок, чтобы не смешивать с основным лором)
-        gossip_text, total_gossip_messages, _, _ = await parse_channel_content([gossip_channel], session, download_images=False)
+        # Инкрементальный режим: забираем только сообщения новее прошлого сбора,
+        # уже собранные читаются из прошлого архива
+        manifest = {} if full_rescan else load_scrape_manifest()
+        previous_lore = LoreArchive.open(LORE_ARCHIVE_FILE, LORE_ARCHIVE_INDEX_FILE) if manifest.get('lore') else None
+        previous_gossip = LoreArchive.open(GOSSIP_ARCHIVE_FILE, GOSSIP_ARCHIVE_INDEX_FILE) if manifest.get('gossip') else None
+        previous_image_map = {}
+        if previous_lore is not None:
+            try:
+                with open(IMAGE_MAP_FILE, 'r', encoding='utf-8') as f:
+                    previous_image_map = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                previous_lore.close()
+                previous_lore = None
+        if previous_lore is None:
+            manifest.pop('lore', None)
+        if previous_gossip is None:
+            manifest.pop('gossip', None)
+        previous_lore_found = previous_lore is not None
+        # Картинки не удаляются заранее: неизменившиеся берутся из хранилища по индексу URL
+        LORE_IMAGE_STORE.load()
+
+        # Лор и сплетни пишутся во временные файлы (текст и архив) по мере сбора каналов,
+        # а на место встают одним коммитом вместе с картой изображений и манифестом
+        lore_file = StagedFile(LORE_FILE)
+        lore_archive = LoreArchiveWriter(LORE_ARCHIVE_FILE, LORE_ARCHIVE_INDEX_FILE)
+        gossip_archive = LoreArchiveWriter(GOSSIP_ARCHIVE_FILE, GOSSIP_ARCHIVE_INDEX_FILE)
+        # Сплетни не дедуплицируются: в промпт идут свежие сообщения и сводки, ссылка на старое сообщение там бессмысленна
+        lore_deduplicator = LoreDeduplicator() if LORE_DEDUP_ENABLED else None
+        try:
+            with measure_phase("update_lore", "scrape"):
+                async with aiohttp.ClientSession() as session:
+                    # Парсим основной лор
+                    _, total_lore_messages, downloaded_images_count, new_image_map, manifest['lore'] = await parse_channel_content(
+                        lore_channels, session, download_images=True,
+                        previous_archive=previous_lore, previous_manifest=manifest.get('lore'),
+                        output=lore_file, archive_output=lore_archive, deduplicator=lore_deduplicator)
+            
+                    # Парсим канал сплетен (без скачивания картинок, чтобы не смешивать с основным лором)
+                    _, total_gossip_messages, _, _, manifest['gossip'] = await parse_channel_content(
+                        [gossip_channel], session, download_images=False,
+                        previous_archive=previous_gossip, previous_manifest=manifest.get('gossip'), metrics_kind="gossip",
+                        output=DiscardedText(), archive_output=gossip_archive)
+                    # Записи старого формата (только имя файла) дополняем готовой для Discord копией
+                    for image_id, entry in previous_image_map.items():
+                        if isinstance(entry, str) and os.path.exists(os.path.join(LORE_IMAGES_DIR, entry)):
+                            previous_image_map[image_id] = await LORE_IMAGE_STORE.ingest(entry)
+            with measure_phase("update_lore", "gossip_compaction"):
+                gossip_files, gossip_stats = await stage_gossip_view(gossip_archive)
+        except BaseException:
+            for staged in (lore_file, lore_archive, gossip_archive):
+                staged.discard()
+            raise
+        finally:
+            for archive in (previous_lore, previous_gossip):
+                if archive is not None:
+                    archive.close()
+        image_map = {**previous_image_map, **new_image_map}
     
-    try:
-        # Сохраняем основной лор
-        with open("file.txt", "w", encoding="utf-8") as f: f.write(full_lore_text)
-        with open(IMAGE_MAP_FILE, "w", encoding="utf-8") as f: json.dump(image_map, f, indent=4)
-        
-        # Сохраняем сплетни
-        with open("gossip.txt", "w", encoding="utf-8") as f: f.write(gossip_text)
+        try:
+            with measure_phase("update_lore", "file_io"):
+                staged_files = [
+                    lore_file, *gossip_files, *lore_archive.staged_files(), *gossip_archive.staged_files(),
+                    stage_json(IMAGE_MAP_FILE, image_map, indent=4),
+                    stage_json(SCRAPE_MANIFEST_FILE, manifest, indent=4, ensure_ascii=False),
+                ]
+                artifacts_version = await asyncio.to_thread(commit_lore_artifacts, staged_files)
+                await asyncio.to_thread(publish_lore_version, artifacts_version)
+                # Новая карта закоммичена — теперь можно убрать картинки, на которые она больше не ссылается
+                removed_images_count = LORE_IMAGE_STORE.collect_garbage(image_map)
+                LORE_IMAGE_STORE.save()
+        except Exception as e:
+            # Коммит либо не начался (временные файлы удаляются), либо доводится до конца по журналу
+            recover_lore_commit()
+            COMMAND_ERRORS.inc(command="update_lore")
+            await interaction.followup.send(f"Произошла критическая ошибка при записи файлов: {e}", ephemeral=True)
+            return
 
-        load_lore_from_file()
-        load_gossip_from_file()
+    try:
+        # Применяем новые данные на лету, без перезапуска
+        with measure_phase("update_lore", "reload"):
+            reload_error = await reload_lore_snapshot()
 
-        file_size_lore = os.path.getsize("file.txt") / 1024
-        file_size_gossip = os.path.getsize("gossip.txt") / 1024
+        file_size_lore = os.path.getsize(LORE_FILE) / 1024
+        file_size_gossip = os.path.getsize(GOSSIP_FILE) / 1024
         
-        embed = discord.Embed(title="✅ Лор и события успешно обновлены!", description="Файлы `file.txt` и `gossip.txt` были перезаписаны.", color=discord.Color.green())
+        mode_description = "Полный сбор" if not previous_lore_found else "Инкрементальный сбор: добавлены только новые сообщения"
+        embed = discord.Embed(title="✅ Лор и события успешно обновлены!", description=f"Файлы `file.txt` и `gossip.txt` были перезаписаны.\n{mode_description}.", color=discord.Color.green())
         embed.add_field(name="Обработано лор-каналов", value=str(len(lore_channels)), inline=True)
         embed.add_field(name="Собрано лор-сообщений", value=str(total_lore_messages), inline=True)
-        embed.add_field(name="Скачано изображений", value=str(downloaded_images_count), inline=True)
+        embed.add_field(name="Скачано изображений", value=f"{downloaded_images_count} новых, {LORE_IMAGE_STORE.reused_count} без изменений, {removed_images_count} удалено", inline=True)
         embed.add_field(name="Размер лор-файла", value=f"{file_size_lore:.2f} КБ", inline=True)
+        if lore_deduplicator is not None:
+            dedup_stats = lore_deduplicator.stats()
+            embed.add_field(name="Повторы в лоре", value=f"{dedup_stats['exact']} точных, {dedup_stats['near']} почти точных; "
+                                                         f"сэкономлено {dedup_stats['saved_bytes'] / 1024:.1f} КБ (~{dedup_stats['saved_tokens']} токенов)", inline=True)
         embed.add_field(name="Канал сплетен", value="Обработан", inline=True)
         embed.add_field(name="Сообщений о событиях", value=str(total_gossip_messages), inline=True)
         embed.add_field(name="Размер файла событий", value=f"{file_size_gossip:.2f} КБ", inline=True)
+        embed.add_field(name="Сводки событий", value=f"{gossip_stats['digests_reused']} готовых, {gossip_stats['digests_generated']} новых; "
+                                                      f"в промпте {gossip_stats['digests_in_prompt']} сводок и {gossip_stats['recent_in_prompt']} свежих сообщений", inline=True)
+        cache_stats = ANSWER_CACHE.stats()
+        embed.add_field(name="Кэш ответов /ask_lore", value=f"{cache_stats['hits']} попаданий / {cache_stats['misses']} промахов ({cache_stats['hit_rate']:.0%})", inline=True)
+        embed.add_field(name="Версия файлов", value=f"`{artifacts_version}`", inline=True)
         
-        await interaction.followup.send(embed=embed, ephemeral=True)
-        await interaction.followup.send("✅ **Данные обновлены.** Перезапускаюсь для применения изменений через 5 секунд...", ephemeral=True)
-        await asyncio.sleep(5)
-        await bot.close()
+        with measure_phase("update_lore", "discord_send"):
+            await interaction.followup.send(embed=embed, ephemeral=True)
+            if reload_error:
+                await interaction.followup.send(f"⚠️ **Файлы записаны, но новый лор не применен:** {reload_error}. Бот продолжает отвечать по прежней версии.", ephemeral=True)
+            else:
+                await interaction.followup.send(f"✅ **Данные обновлены и применены без перезапуска.** Версия лора: `{LORE_SNAPSHOT.version}`.", ephemeral=True)
     except Exception as e:
-        await interaction.followup.send(f"Произошла критическая ошибка при записи или отправке файла: {e}", ephemeral=True)
+        COMMAND_ERRORS.inc(command="update_lore")
+        await interaction.followup.send(f"Произошла критическая ошибка при применении или отправке данных: {e}", ephemeral=True)
+
+
+# Картинки из /optimize_post: декодирование и уменьшение идут в пуле процессов, а не в event loop
+POST_IMAGE_MAX_EDGE = int(os.getenv("POST_IMAGE_MAX_EDGE", "1536"))
+POST_IMAGE_MAX_PIXELS = int(os.getenv("POST_IMAGE_MAX_PIXELS", str(50_000_000)))
+POST_IMAGE_MAX_BYTES = int(os.getenv("POST_IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+POST_IMAGE_CACHE_ENTRIES = int(os.getenv("POST_IMAGE_CACHE_ENTRIES", "32"))
+
+class PostImageRejected(ValueError):
+    """Вложение не будет отправлено модели (слишком большое или не картинка)."""
+
+def prepare_post_image(image_bytes: bytes, max_edge: int, max_pixels: int) -> tuple:
+    """
+    Готовит картинку из поста для Gemini: размер проверяется по заголовку еще до декодирования
+    (защита от decompression bomb), затем EXIF-поворот, уменьшение до max_edge и пережатие
+    в JPEG (PNG при прозрачности). Выполняется в отдельном процессе. Возвращает (mime_type, data).
+    """
+    from PIL import Image, ImageOps  # импорт нужен только в процессах пула
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError) as e:
+        raise PostImageRejected(str(e))
+    with image:
+        width, height = image.size
+        if width * height > max_pixels:
+            raise PostImageRejected(f"Изображение {width}×{height} превышает лимит в {max_pixels} пикселей.")
+        scale = min(1.0, max_edge / max(width, height))
+        # Для JPEG уменьшение прямо при декодировании: полноразмерный кадр не распаковывается
+        image.draft('RGB', (max(1, int(width * scale)), max(1, int(height * scale))))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            image.convert('RGBA').save(output, 'PNG', optimize=True)
+            return 'image/png', output.getvalue()
+        image.convert('RGB').save(output, 'JPEG', quality=85, optimize=True)
+        return 'image/jpeg', output.getvalue()
+
+class PostImageCache:
+    """
+    Готовые картинки из постов по хешу вложения: один и тот же арт персонажа,
+    прикладываемый к разным постам, пережимается один раз.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._inflight = {}
+
+    async def prepare(self, digest: str, image_bytes: bytes) -> dict:
+        """Возвращает часть запроса к Gemini ({'mime_type', 'data'}) или бросает PostImageRejected."""
+        part = self.entries.get(digest)
+        if part is not None:
+            self.entries.move_to_end(digest)
+            self.hits += 1
+            return part
+        task = self._inflight.get(digest)
+        if task is None:
+            self.misses += 1
+            task = asyncio.get_running_loop().run_in_executor(
+                get_image_process_pool(), prepare_post_image, image_bytes, POST_IMAGE_MAX_EDGE, POST_IMAGE_MAX_PIXELS)
+            self._inflight[digest] = task
+            task.add_done_callback(lambda _: self._inflight.pop(digest, None))
+        mime_type, data = await asyncio.shield(task)
+        part = {'mime_type': mime_type, 'data': data}
+        self.entries[digest] = part
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return part
 
+POST_IMAGE_CACHE = PostImageCache(POST_IMAGE_CACHE_ENTRIES)
+
+# Готовые результаты /optimize_post: повторная отправка того же поста не идет в Gemini
+POST_RESULT_CACHE_ENTRIES = int(os.getenv("POST_RESULT_CACHE_ENTRIES", "256"))
+POST_RESULT_CACHE_TTL = int(os.getenv("POST_RESULT_CACHE_TTL", str(6 * 3600)))
+
+def post_result_key(user_id: str, post_text: str, level: str, character_info, image_digest: str = None) -> str:
+    """Ключ результата: пост, уровень, имя и хэш описания активного персонажа, хэш вложения."""
+    description_digest = hashlib.sha256(character_info['description'].encode('utf-8')).hexdigest() if character_info else ''
+    parts = [user_id, level, character_info['name'] if character_info else '', description_digest, image_digest or '', post_text]
+    return hashlib.sha256("\0".join(parts).encode('utf-8')).hexdigest()
+
+class PostResultCache:
+    """
+    LRU-кэш улучшенных постов с TTL. Записи помечены пользователем: смена биографии
+    (/character set_bio, в том числе на другом воркере) удаляет все его результаты.
+    """
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key: str, user_id: str):
+        """Текст результата без учета в hits/misses: кнопка показа и повторная проверка ключа не считаются обращениями."""
+        entry = self.entries.get(key)
+        if entry is None or entry['user_id'] != user_id or entry['expires_at'] < unix_time():
+            if entry is not None and entry['expires_at'] < unix_time():
+                del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry['text']
+
+    def record(self, hit: bool):
+        """Одно обращение /optimize_post к кэшу, учитывается после того, как известен итоговый ключ."""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def put(self, key: str, user_id: str, text: str):
+        self.entries[key] = {'user_id': user_id, 'text': text, 'expires_at': unix_time() + self.ttl}
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate_user(self, user_id: str):
+        for key in [k for k, entry in self.entries.items() if entry['user_id'] == user_id]:
+            del self.entries[key]
+
+POST_RESULT_CACHE = PostResultCache(POST_RESULT_CACHE_ENTRIES, POST_RESULT_CACHE_TTL)
+
+@METRICS.collector
+def collect_post_result_cache_metrics():
+    report_cache_metrics('post_result', POST_RESULT_CACHE.hits, POST_RESULT_CACHE.misses, len(POST_RESULT_CACHE.entries))
+
+@METRICS.collector
+def collect_post_image_cache_metrics():
+    report_cache_metrics('post_image', POST_IMAGE_CACHE.hits, POST_IMAGE_CACHE.misses, len(POST_IMAGE_CACHE.entries))
 
 @bot.tree.command(name="optimize_post", description="Улучшает РП-пост, принимая текст и уровень улучшения.")
 @app_commands.describe(post_text="Текст вашего поста для улучшения.", optimization_level="Выберите желаемый уровень улучшения.", image="(Опционально) Изображение для дополнительного контекста.")
@@ -502,52 +3760,110 @@ async def update_lore(interaction: discord.Interaction, access_code: str):
     discord.app_commands.Choice(name="Стандартная оптимизация", value="standard"),
     discord.app_commands.Choice(name="Максимальная креативность", value="creative"),
 ])
+@instrumented_command("optimize_post")
 async def optimize_post(interaction: discord.Interaction, post_text: str, optimization_level: discord.app_commands.Choice[str], image: discord.Attachment = None):
-    await interaction.response.defer(ephemeral=True, thinking=True)
+    with measure_phase("optimize_post", "defer"):
+        await interaction.response.defer(ephemeral=True, thinking=True)
     
     if image and (not image.content_type or not image.content_type.startswith("image/")):
         await interaction.followup.send("❌ **Ошибка:** Прикрепленный файл не является изображением.", ephemeral=True)
         return
 
     user_id = str(interaction.user.id)
-    active_character_info = None
-    if user_id in CHARACTERS_DATA and CHARACTERS_DATA[user_id]['active_character']:
-        active_char_name = CHARACTERS_DATA[user_id]['active_character']
-        for char in CHARACTERS_DATA[user_id]['characters']:
-            if char['name'] == active_char_name:
-                active_character_info = char
-                break
+    with measure_phase("optimize_post", "prompt_build"):
+        active_character_info = await asyncio.to_thread(CHARACTER_STORE.get_active_character, user_id)
 
-    level_map = {"minimal": "Минимальные правки", "standard": "Стандартная оптимизация", "creative": "Максимальная креативность"}
-    prompt = get_optimizer_prompt(level_map[optimization_level.value], active_character_info)
+        level_map = {"minimal": "Минимальные правки", "standard": "Стандартная оптимизация", "creative": "Максимальная креативность"}
+        prompt = get_optimizer_prompt(level_map[optimization_level.value], active_character_info)
     
     content_to_send = [prompt, f"\n\nПост игрока:\n---\n{post_text}"]
+    request_digest = hashlib.sha256(f"{prompt}\0{post_text}".encode('utf-8'))
     
+    image_bytes = image_digest = None
     if image:
         try:
-            image_bytes = await image.read()
-            pil_image = Image.open(io.BytesIO(image_bytes))
-            content_to_send.append(pil_image)
+            if image.size > POST_IMAGE_MAX_BYTES:
+                raise PostImageRejected(f"Вложение весит {image.size} байт.")
+            with measure_phase("optimize_post", "file_io"):
+                image_bytes = await image.read()
+                image_digest = (await asyncio.to_thread(hashlib.sha256, image_bytes)).hexdigest()
+        except PostImageRejected as e:
+            print(f"Изображение для /optimize_post отклонено: {e}")
+            await interaction.followup.send("⚠️ Изображение слишком большое или повреждено, пост будет улучшен без него.", ephemeral=True)
         except Exception as e:
             await interaction.followup.send("⚠️ Не удалось обработать прикрепленное изображение.", ephemeral=True)
 
-    try:
-        response = await gemini_model.generate_content_async(content_to_send)
-        result_text = response.text.strip()
-
+    def build_post_embed(preview: str) -> discord.Embed:
         embed = discord.Embed(title="✨ Ваш пост был оптимизирован!", color=discord.Color.gold())
         if active_character_info:
             embed.set_author(name=f"Персонаж: {active_character_info['name']}", icon_url=active_character_info.get('avatar_url'))
         
         embed.add_field(name="▶️ Оригинал:", value=f"```\n{post_text[:1000]}\n```", inline=False)
-        embed.add_field(name="✅ Улучшенная версия (превью):", value=f"{result_text[:1000]}...", inline=False)
-        view = PostView(result_text)
-        await interaction.followup.send(embed=embed, view=view, ephemeral=True)
+        embed.add_field(name="✅ Улучшенная версия (превью):", value=preview, inline=False)
+        return embed
+
+    result_key = post_result_key(user_id, post_text, optimization_level.value, active_character_info, image_digest)
+    cached_text = POST_RESULT_CACHE.lookup(result_key, user_id)
+
+    if cached_text is None and image_digest is not None:
+        try:
+            with measure_phase("optimize_post", "file_io"):
+                image_part = await POST_IMAGE_CACHE.prepare(image_digest, image_bytes)
+            content_to_send.append(image_part)
+            request_digest.update(image_digest.encode('ascii'))
+            IMAGES_UPLOADED.inc(command="optimize_post", target="gemini")
+            IMAGES_UPLOADED_BYTES.inc(len(image_part['data']), command="optimize_post", target="gemini")
+        except Exception as e:
+            if isinstance(e, PostImageRejected):
+                print(f"Изображение для /optimize_post отклонено: {e}")
+                await interaction.followup.send("⚠️ Изображение слишком большое или повреждено, пост будет улучшен без него.", ephemeral=True)
+            else:
+                await interaction.followup.send("⚠️ Не удалось обработать прикрепленное изображение.", ephemeral=True)
+            # В модель уйдет только текст: ключ результата не должен ссылаться на отброшенную картинку
+            image_digest = None
+            result_key = post_result_key(user_id, post_text, optimization_level.value, active_character_info, None)
+            cached_text = POST_RESULT_CACHE.lookup(result_key, user_id)
+
+    POST_RESULT_CACHE.record(cached_text is not None)
+    if cached_text is not None:
+        # Тот же пост с тем же персонажем уже улучшали: отдаем готовый результат без вызова модели
+        with measure_phase("optimize_post", "discord_send"):
+            await interaction.followup.send(embed=build_post_embed(f"{cached_text[:1000]}..."), view=PostView(result_key), ephemeral=True)
+        return
+
+    stream = StreamingEmbed(interaction, lambda text: build_post_embed(text[:1000] + STREAM_CURSOR), ephemeral=True) if STREAMING_RESPONSES else None
+    try:
+        with measure_phase("optimize_post", "llm"):
+            response = await GEMINI_DISPATCHER.generate(
+                get_gemini_model(), content_to_send,
+                user_id=interaction.user.id, guild_id=interaction.guild_id,
+                deadline=interaction_deadline(interaction), coalesce_key=f"optimize:{request_digest.hexdigest()}",
+                on_text=stream.update if stream is not None else None, command="optimize_post")
+        result_text = response.text.strip()
+        POST_RESULT_CACHE.put(result_key, user_id, result_text)
+
+        embed = build_post_embed(f"{result_text[:1000]}...")
+        view = PostView(result_key)
+        with measure_phase("optimize_post", "discord_send"):
+            if stream is not None:
+                await stream.finish(embed=embed, view=view)
+            else:
+                await interaction.followup.send(embed=embed, view=view, ephemeral=True)
 
     except Exception as e:
         print(f"Произошла внутренняя ошибка в /optimize_post: {e}")
+        COMMAND_ERRORS.inc(command="optimize_post")
+        if stream is not None:
+            await stream.discard()
         await interaction.followup.send(embed=discord.Embed(title="🚫 Произошла внутренняя ошибка", description="Не удалось обработать ваш запрос.", color=discord.Color.dark_red()), ephemeral=True)
 
+def preview_lore_answer(text: str) -> str:
+    """Промежуточный текст ответа: без блока источников, тегов изображений и недописанного тега в конце."""
+    text = text.split("%%", 1)[0].rstrip("%")
+    text = re.sub(r'\[IMAGE_\d+\]\s*', '', text)
+    text = re.sub(r'\[[^\]\n]*$', '', text)
+    return text.strip()
+
 @bot.tree.command(name="ask_lore", description="Задать вопрос по миру, правилам и лору 'Вальдеса'")
 @app_commands.describe(
     question="Ваш вопрос Хранителю знаний.",
@@ -557,66 +3873,110 @@ async def optimize_post(interaction: discord.Interaction, post_text: str, optimi
     discord.app_commands.Choice(name="Серьезный Архивариус (По умолчанию)", value="serious"),
     discord.app_commands.Choice(name="Циничный Старик (18+)", value="edgy")
 ])
+@instrumented_command("ask_lore")
 async def ask_lore(interaction: discord.Interaction, question: str, personality: discord.app_commands.Choice[str] = None):
-    await interaction.response.defer(ephemeral=False)
+    with measure_phase("ask_lore", "defer"):
+        await interaction.response.defer(ephemeral=False)
+    stream = None
     
     try:
+        # Весь запрос работает с одним снимком, даже если лор обновят посреди ответа
+        snapshot = LORE_SNAPSHOT
+
         # Выбираем, какую "личность" использовать
         if personality and personality.value == 'edgy':
-            prompt = get_edgy_lore_prompt()
+            personality_key = 'edgy'
             embed_color = discord.Color.red() # Циничные ответы будут красными
             author_name = "Ответил Циничный Старик"
         else:
-            prompt = get_serious_lore_prompt()
+            personality_key = 'serious'
             embed_color = discord.Color.blue() # Серьезные - синими
             author_name = "Ответил Хранитель знаний"
 
-        response = await gemini_model.generate_content_async([prompt, f"\n\nВопрос игрока: {question}"])
-        raw_text = response.text.strip()
-        
+        def build_answer_embed(answer: str) -> discord.Embed:
+            embed = discord.Embed(title="📜 Ответ из архивов Вальдеса", description=answer, color=embed_color)
+            embed.add_field(name="Ваш запрос:", value=question, inline=False)
+            return embed
+
+        def render_preview(text: str) -> discord.Embed:
+            embed = build_answer_embed(text[:4000] + STREAM_CURSOR)
+            embed.set_footer(text=f"⏳ Ответ пишется... | Запросил: {interaction.user.display_name}")
+            return embed
+
+        cache_key = AnswerCache.make_key(question, personality_key, snapshot.version)
+        cached = ANSWER_CACHE.get(cache_key)
+        if cached:
+            answer_text, sources_text, image_ids = cached['answer'], cached['sources'], cached['image_ids']
+        else:
+            # Отправляем только относящиеся к вопросу фрагменты лора (или весь лор, если поиск не уверен)
+            with measure_phase("ask_lore", "prompt_build"):
+                lore_context = select_lore_context(snapshot.index, question)
+                if lore_context is not None:
+                    prompt = snapshot.build_prompt(personality_key, lore_context)
+                    model, contents = get_gemini_model(), [prompt, f"\n\nВопрос игрока: {question}"]
+                else:
+                    model, contents = await snapshot.get_full_context_model(personality_key), f"Вопрос игрока: {question}"
+            # Ответ показывается по мере генерации; источники и изображения разбираются в конце
+            if STREAMING_RESPONSES:
+                stream = StreamingEmbed(interaction, render_preview)
+                on_text = lambda text: stream.update(preview_lore_answer(text))
+            else:
+                on_text = None
+            # Одинаковые вопросы, заданные одновременно, разделяют один вызов модели
+            with measure_phase("ask_lore", "llm"):
+                response = await GEMINI_DISPATCHER.generate(
+                    model, contents,
+                    user_id=interaction.user.id, guild_id=interaction.guild_id,
+                    deadline=interaction_deadline(interaction), coalesce_key=f"ask:{cache_key}",
+                    on_text=on_text, command="ask_lore")
+            raw_text = response.text.strip()
+
+            image_ids = re.findall(r'\[(IMAGE_\d+)\]', raw_text)
+            if image_ids:
+                raw_text = re.sub(r'\[IMAGE_\d+\]\s*', '', raw_text).strip()
+
+            answer_text, sources_text = (raw_text.split("%%SOURCES%%") + [""])[:2]
+            answer_text = answer_text.strip()
+            sources_text = sources_text.strip()
+
+            ANSWER_CACHE.put(cache_key, answer_text, sources_text, image_ids)
+            ANSWER_CACHE.schedule_save()
+
+        # Карта изображений уже в памяти снимка; сами файлы открываются вне event loop
         files_to_send = []
-        image_ids = re.findall(r'\[(IMAGE_\d+)\]', raw_text)
-        
-        if image_ids:
-            raw_text = re.sub(r'\[IMAGE_\d+\]\s*', '', raw_text).strip()
-            
-            try:
-                with open(IMAGE_MAP_FILE, 'r', encoding='utf-8') as f:
-                    image_map = json.load(f)
-                
-                for i, image_id in enumerate(image_ids):
-                    filename = image_map.get(image_id)
-                    if filename:
-                        image_path = os.path.join(LORE_IMAGES_DIR, filename)
-                        if os.path.exists(image_path):
-                            files_to_send.append(discord.File(image_path, filename=f"image_{i}.png"))
-
-            except (FileNotFoundError, json.JSONDecodeError) as e:
-                print(f"ОШИБКА: Не удалось загрузить {IMAGE_MAP_FILE}: {e}")
-        
-        answer_text, sources_text = (raw_text.split("%%SOURCES%%") + [""])[:2]
-        answer_text = answer_text.strip()
-        sources_text = sources_text.strip()
+        with measure_phase("ask_lore", "file_io"):
+            for i, image_id in enumerate(image_ids):
+                lore_image = snapshot.images.get(image_id)
+                if lore_image:
+                    files_to_send.append(await asyncio.to_thread(discord.File, lore_image.path, filename=f"image_{i}{lore_image.extension}"))
+                    IMAGES_UPLOADED.inc(command="ask_lore", target="discord")
+                    IMAGES_UPLOADED_BYTES.inc(lore_image.size or 0, command="ask_lore", target="discord")
 
-        embed = discord.Embed(title="📜 Ответ из архивов Вальдеса", description=answer_text, color=embed_color)
-        embed.add_field(name="Ваш запрос:", value=question, inline=False)
+        embed = build_answer_embed(answer_text)
         if sources_text:
             embed.add_field(name="Источники:", value=sources_text, inline=False)
             
         embed.set_footer(text=f"{author_name} | Запросил: {interaction.user.display_name}")
         
         # --- НАЧАЛО ИЗМЕНЕНИЯ ---
-        # Сначала отправляем основной embed с текстом
-        await interaction.followup.send(embed=embed)
+        with measure_phase("ask_lore", "discord_send"):
+            # Сначала отправляем основной embed с текстом (или дописываем уже показанный поток)
+            if stream is not None:
+                await stream.finish(embed=embed)
+            else:
+                await interaction.followup.send(embed=embed)
 
-        # Если есть изображения, создаем для них новый embed и отправляем вторым сообщением
-        if files_to_send:
-            image_embed = discord.Embed(title="Изображения", color=embed_color)
-            await interaction.followup.send(embed=image_embed, files=files_to_send)
+            # Если есть изображения, создаем для них новый embed и отправляем вторым сообщением
+            if files_to_send:
+                image_embed = discord.Embed(title="Изображения", color=embed_color)
+                await interaction.followup.send(embed=image_embed, files=files_to_send)
         # --- КОНЕЦ ИЗМЕНЕНИЯ ---
 
     except Exception as e:
         print(f"Произошла ошибка при обработке запроса /ask_lore: {e}")
+        COMMAND_ERRORS.inc(command="ask_lore")
+        if stream is not None:
+            await stream.discard()
         await interaction.followup.send(embed=discord.Embed(title="🚫 Ошибка в архиве", description="Архивариус не смог найти ответ.", color=discord.Color.dark_red()), ephemeral=True)
 
 # Команды help, about и character без изменений
@@ -638,7 +3998,7 @@ async def help(interaction: discord.Interaction):
     embed.add_field(name="/ask_lore", value="Задает вопрос Хранителю знаний по миру 'Вальдеса'. Ответ будет виден всем в канале.", inline=False)
     embed.add_field(name="/about", value="Показывает информацию о боте и его создателе.", inline=False)
     embed.add_field(name="/help", value="Показывает это справочное сообщение.", inline=False)
-    embed.add_field(name="/update_lore", value="**[Только для администраторов]**\nСобирает лор, обновляет файл и перезапускает бота.", inline=False)
+    embed.add_field(name="/update_lore", value="**[Только для администраторов]**\nСобирает лор, обновляет файлы и применяет их без перезапуска бота.", inline=False)
     embed.set_footer(text="Ваш верный помощник в мире Вальдеса.")
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
@@ -654,14 +4014,14 @@ async def about(interaction: discord.Interaction):
 character_group = app_commands.Group(name="character", description="Управление вашими персонажами")
 
 async def character_name_autocomplete(interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    # Индекс имен держится в памяти, поэтому на каждое нажатие клавиши база не читается
     user_id = str(interaction.user.id)
-    if user_id not in CHARACTERS_DATA:
-        return []
-    
-    chars = CHARACTERS_DATA.get(user_id, {}).get('characters', [])
+    index = CHARACTER_STORE.cached_name_index(user_id)
+    if index is None:
+        index = await asyncio.to_thread(CHARACTER_STORE.load_name_index, user_id)
     return [
-        app_commands.Choice(name=char['name'], value=char['name'])
-        for char in chars if current.lower() in char['name'].lower()
+        app_commands.Choice(name=name[:AUTOCOMPLETE_VALUE_MAX_LENGTH], value=name[:AUTOCOMPLETE_VALUE_MAX_LENGTH])
+        for name in index.search(current, AUTOCOMPLETE_LIMIT)
     ]
 
 @character_group.command(name="add", description="Добавить нового персонажа в систему.")
@@ -677,29 +4037,15 @@ async def character_add(interaction: discord.Interaction, name: str, description
 
     user_id = str(interaction.user.id)
 
-    if user_id not in CHARACTERS_DATA:
-        CHARACTERS_DATA[user_id] = {"active_character": None, "characters": []}
-
-    if any(char['name'] == name for char in CHARACTERS_DATA[user_id]['characters']):
+    made_active = await asyncio.to_thread(CHARACTER_STORE.add_character, user_id, name, description, avatar.url)
+    if made_active is None:
         await interaction.response.send_message(f"❌ Персонаж с именем '{name}' у вас уже существует.", ephemeral=True)
         return
-
-    new_char = {
-        "name": name,
-        "description": description,
-        "avatar_url": avatar.url
-    }
-    CHARACTERS_DATA[user_id]['characters'].append(new_char)
-    
-    if not CHARACTERS_DATA[user_id]['active_character']:
-        CHARACTERS_DATA[user_id]['active_character'] = name
-
-    save_characters()
     
     embed = discord.Embed(title=f"✅ Персонаж '{name}' успешно добавлен!", color=discord.Color.green())
     embed.set_thumbnail(url=avatar.url)
     embed.add_field(name="Описание", value=description, inline=False)
-    if CHARACTERS_DATA[user_id]['active_character'] == name:
+    if made_active:
          embed.set_footer(text="Он автоматически выбран как активный. Вы можете добавить полную биографию через /character set_bio.")
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -713,7 +4059,7 @@ async def character_add(interaction: discord.Interaction, name: str, description
 async def character_set_bio(interaction: discord.Interaction, name: str, file: discord.Attachment):
     user_id = str(interaction.user.id)
 
-    if user_id not in CHARACTERS_DATA or not any(c['name'] == name for c in CHARACTERS_DATA[user_id]['characters']):
+    if not await asyncio.to_thread(CHARACTER_STORE.get_character, user_id, name):
         await interaction.response.send_message(f"❌ Персонаж с именем '{name}' не найден. Сначала создайте его через `/character add`.", ephemeral=True)
         return
         
@@ -731,12 +4077,10 @@ async def character_set_bio(interaction: discord.Interaction, name: str, file: d
         await interaction.response.send_message(f"❌ **Ошибка:** Не удалось прочитать файл. Убедитесь, что он в кодировке UTF-8. ({e})", ephemeral=True)
         return
 
-    for char in CHARACTERS_DATA[user_id]['characters']:
-        if char['name'] == name:
-            char['description'] = description_text
-            break
-    
-    save_characters()
+    if not await asyncio.to_thread(CHARACTER_STORE.set_description, user_id, name, description_text):
+        await interaction.response.send_message(f"❌ Персонаж с именем '{name}' не найден.", ephemeral=True)
+        return
+    POST_RESULT_CACHE.invalidate_user(user_id)
     
     embed = discord.Embed(title=f"✅ Биография персонажа '{name}' обновлена!", color=discord.Color.green())
     embed.add_field(name="Превью новой биографии", value=f"{description_text[:1000]}...", inline=False)
@@ -749,24 +4093,14 @@ async def character_set_bio(interaction: discord.Interaction, name: str, file: d
 async def character_delete(interaction: discord.Interaction, name: str):
     user_id = str(interaction.user.id)
     
-    if user_id not in CHARACTERS_DATA or not CHARACTERS_DATA[user_id]['characters']:
+    if not await asyncio.to_thread(CHARACTER_STORE.get_characters, user_id):
         await interaction.response.send_message("❌ У вас нет зарегистрированных персонажей.", ephemeral=True)
         return
 
-    char_to_delete = next((char for char in CHARACTERS_DATA[user_id]['characters'] if char['name'] == name), None)
-
-    if not char_to_delete:
+    if not await asyncio.to_thread(CHARACTER_STORE.delete_character, user_id, name):
         await interaction.response.send_message(f"❌ Персонаж с именем '{name}' не найден.", ephemeral=True)
         return
 
-    CHARACTERS_DATA[user_id]['characters'].remove(char_to_delete)
-    
-    if CHARACTERS_DATA[user_id]['active_character'] == name:
-        CHARACTERS_DATA[user_id]['active_character'] = None
-        if CHARACTERS_DATA[user_id]['characters']:
-            CHARACTERS_DATA[user_id]['active_character'] = CHARACTERS_DATA[user_id]['characters'][0]['name']
-
-    save_characters()
     await interaction.response.send_message(f"✅ Персонаж '{name}' был успешно удален.", ephemeral=True)
 
 
@@ -776,18 +4110,15 @@ async def character_delete(interaction: discord.Interaction, name: str):
 async def character_select(interaction: discord.Interaction, name: str):
     user_id = str(interaction.user.id)
     
-    if user_id not in CHARACTERS_DATA or not CHARACTERS_DATA[user_id]['characters']:
+    if not await asyncio.to_thread(CHARACTER_STORE.get_characters, user_id):
         await interaction.response.send_message("❌ У вас нет зарегистрированных персонажей.", ephemeral=True)
         return
         
-    char_to_select = next((char for char in CHARACTERS_DATA[user_id]['characters'] if char['name'] == name), None)
+    char_to_select = await asyncio.to_thread(CHARACTER_STORE.select_character, user_id, name)
     
     if not char_to_select:
         await interaction.response.send_message(f"❌ Персонаж с именем '{name}' не найден.", ephemeral=True)
         return
-
-    CHARACTERS_DATA[user_id]['active_character'] = name
-    save_characters()
     
     embed = discord.Embed(title="👤 Активный персонаж изменен", description=f"Теперь ваши команды будут использовать профиль **{name}**.", color=discord.Color.blue())
     embed.set_thumbnail(url=char_to_select.get('avatar_url'))
@@ -798,16 +4129,11 @@ async def character_select(interaction: discord.Interaction, name: str):
 async def character_view(interaction: discord.Interaction):
     user_id = str(interaction.user.id)
     
-    if user_id not in CHARACTERS_DATA or not CHARACTERS_DATA[user_id]['active_character']:
-        await interaction.response.send_message("❌ У вас не выбран активный персонаж. Добавьте его через `/character add`.", ephemeral=True)
-        return
-        
-    active_char_name = CHARACTERS_DATA[user_id]['active_character']
-    active_char_info = next((char for char in CHARACTERS_DATA[user_id]['characters'] if char['name'] == active_char_name), None)
+    active_char_info = await asyncio.to_thread(CHARACTER_STORE.get_active_character, user_id)
 
     if not active_char_info:
-         await interaction.response.send_message("❌ Ошибка: данные активного персонажа не найдены.", ephemeral=True)
-         return
+        await interaction.response.send_message("❌ У вас не выбран активный персонаж. Добавьте его через `/character add`.", ephemeral=True)
+        return
 
     embed = discord.Embed(title=f"Профиль персонажа: {active_char_info['name']}", description=active_char_info['description'], color=discord.Color.purple())
     embed.set_thumbnail(url=active_char_info.get('avatar_url'))
@@ -817,7 +4143,10 @@ async def character_view(interaction: discord.Interaction):
 
 bot.tree.add_command(character_group)
 
+MODULE_IMPORT_FINISHED = perf_counter()
+
 # --- ЗАПУСК БОТА ---
 if __name__ == "__main__":
-    keep_alive()
     bot.run(DISCORD_TOKEN)
+    if startup_load_error() is not None:
+        sys.exit(1)
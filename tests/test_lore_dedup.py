@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Дедупликация лора: инкрементальный сбор должен давать тот же текст и ту же статистику,
+что и полный сбор по тем же данным. Discord заменен фейками из benchmarks/fakes.py.
+
+Запуск из корня репозитория:
+    python -m pytest -q tests
+"""
+import asyncio
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+# main.py требует эти переменные при импорте; реальные значения не нужны, запросов в сеть не будет
+for variable in ("DISCORD_TOKEN", "GEMINI_API_KEY", "MAIN_GUILD_ID", "ADMIN_GUILD_ID", "CODE_CHANNEL_ID",
+                 "OWNER_USER_ID", "LORE_CHANNEL_IDS", "GOSSIP_CHANNEL_ID"):
+    os.environ.setdefault(variable, "1")
+
+import main  # noqa: E402
+from fakes import FakeMessage, build_archive  # noqa: E402
+
+
+def scrape(archive, workdir, previous=False):
+    """Сбор лора в workdir (полный или по прошлому архиву и манифесту); возвращает (текст, статистику)."""
+    os.chdir(workdir)
+    previous_archive = main.LoreArchive.open(main.LORE_ARCHIVE_FILE, main.LORE_ARCHIVE_INDEX_FILE) if previous else None
+    manifest = main.load_scrape_manifest().get('lore') if previous else None
+    writer = main.LoreArchiveWriter(main.LORE_ARCHIVE_FILE, main.LORE_ARCHIVE_INDEX_FILE)
+    deduplicator = main.LoreDeduplicator()
+    text, _, _, _, manifest = asyncio.run(main.parse_channel_content(
+        archive.channels, None, download_images=False, previous_archive=previous_archive,
+        previous_manifest=manifest, archive_output=writer, deduplicator=deduplicator))
+    if previous_archive is not None:
+        previous_archive.close()
+    main.commit_lore_artifacts([*writer.staged_files(), main.stage_json(main.SCRAPE_MANIFEST_FILE, {'lore': manifest})])
+    return text, deduplicator.stats()
+
+
+def make_archive():
+    archive = build_archive(1)
+    main.bot.get_channel = archive.get_channel
+    main.bot.get_user = archive.get_user
+    return archive
+
+
+def next_message_id(archive) -> int:
+    ids = [message.id for channel in archive.channels for message in getattr(channel, 'messages', ())]
+    return max(ids) + 1
+
+
+def original_block(workdir, channel_name: str) -> str:
+    """Текст первого оригинального блока канала в архиве workdir."""
+    os.chdir(workdir)
+    lore_archive = main.LoreArchive.open(main.LORE_ARCHIVE_FILE, main.LORE_ARCHIVE_INDEX_FILE)
+    try:
+        channel_id = next(entry['id'] for entry in lore_archive.channels if entry['name'] == channel_name)
+        for record in lore_archive.channel_records(channel_id):
+            if record['blocks']:
+                start, end = record['blocks'][0]
+                return record['text'][start:end]
+    finally:
+        lore_archive.close()
+    raise AssertionError(f"в канале {channel_name} нет оригинальных блоков")
+
+
+def test_incremental_noop_matches_full(tmp_path):
+    archive = make_archive()
+    full_text, full_stats = scrape(archive, tmp_path)
+    incremental_text, incremental_stats = scrape(archive, tmp_path, previous=True)
+    assert incremental_text == full_text
+    assert incremental_stats == full_stats
+
+
+def test_new_earlier_block_rededuplicates_later_records(tmp_path):
+    """Новое сообщение в лор-0 копирует блок из лор-1: в обоих сборах повтором становится блок лор-1."""
+    archive = make_archive()
+    incremental_dir, full_dir = tmp_path / "incremental", tmp_path / "full"
+    incremental_dir.mkdir()
+    full_dir.mkdir()
+    scrape(archive, incremental_dir)
+
+    first, second = archive.channels[0], archive.channels[1]
+    copied = original_block(incremental_dir, second.name)
+    first.messages.append(FakeMessage(next_message_id(archive), first.messages[0].author, copied))
+
+    incremental_text, incremental_stats = scrape(archive, incremental_dir, previous=True)
+    full_text, full_stats = scrape(archive, full_dir)
+    assert incremental_text == full_text
+    assert incremental_stats == full_stats
+    assert copied in full_text.split(f"--- НАЧАЛО КАНАЛА: {second.name} ---")[0]
+
+    # Следующий сбор без новых сообщений берет переписанный архив как есть
+    again_text, again_stats = scrape(archive, incremental_dir, previous=True)
+    assert again_text == full_text
+    assert again_stats == full_stats
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Однопроходная замена упоминаний (clean_discord_mentions) должна совпадать байт в байт
+с прежним алгоритмом из трех проходов, включая случаи, когда проходы сцепляются:
+имя канала или роли похоже на разметку упоминания или упоминание роли стоит сразу после '<'.
+
+Запуск из корня репозитория:
+    python -m pytest -q tests
+"""
+import os
+import random
+import re
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "benchmarks"))
+
+# main.py требует эти переменные при импорте; реальные значения не нужны, запросов в сеть не будет
+for variable in ("DISCORD_TOKEN", "GEMINI_API_KEY", "MAIN_GUILD_ID", "ADMIN_GUILD_ID", "CODE_CHANNEL_ID",
+                 "OWNER_USER_ID", "LORE_CHANNEL_IDS", "GOSSIP_CHANNEL_ID"):
+    os.environ.setdefault(variable, "1")
+
+import main  # noqa: E402
+from fakes import FakeGuild, FakeRole, FakeUser  # noqa: E402
+
+# Имена подобраны так, чтобы после подстановки получалась новая разметка упоминания
+CHANNELS = {1: "общий", 2: "<@&7", 3: "<@8", 4: "<#1", 5: "a>b"}
+ROLES = {6: "стража", 7: "8", 9: "<@8", 10: "@&6"}
+USERS = {8: "Игрок", 11: "<#1>", 12: "@&7"}
+
+
+def old_clean_discord_mentions(text: str, guild) -> str:
+    """Прежняя версия из трех проходов — эталон для сравнения."""
+    if not text:
+        return ""
+    text = re.sub(r'<#(\d+)>', lambda m: f'#{main.bot.get_channel(int(m.group(1))).name}' if main.bot.get_channel(int(m.group(1))) else m.group(0), text)
+    if guild:
+        text = re.sub(r'<@&(\d+)>', lambda m: f'@{guild.get_role(int(m.group(1))).name}' if guild.get_role(int(m.group(1))) else m.group(0), text)
+    text = re.sub(r'<@!?(\d+)>', lambda m: f'@{main.bot.get_user(int(m.group(1))).display_name}' if main.bot.get_user(int(m.group(1))) else m.group(0), text)
+    return text
+
+
+def use_lookups():
+    channels = {channel_id: SimpleNamespace(id=channel_id, name=name) for channel_id, name in CHANNELS.items()}
+    users = {user_id: FakeUser(user_id, name) for user_id, name in USERS.items()}
+    main.bot.get_channel = channels.get
+    main.bot.get_user = users.get
+    return FakeGuild(1, {role_id: FakeRole(role_id, name) for role_id, name in ROLES.items()})
+
+
+def random_text(rng: random.Random) -> str:
+    """Смесь упоминаний (в том числе неразрешимых) и символов разметки вокруг них."""
+    ids = [str(i) for i in range(1, 14)]
+    pieces = []
+    for _ in range(rng.randint(1, 12)):
+        kind = rng.randrange(6)
+        if kind == 0:
+            pieces.append(f"<#{rng.choice(ids)}>")
+        elif kind == 1:
+            pieces.append(f"<@&{rng.choice(ids)}>")
+        elif kind == 2:
+            pieces.append(f"<@{rng.choice(['', '!'])}{rng.choice(ids)}>")
+        elif kind == 3:
+            pieces.append(rng.choice(["<", ">", "@", "#", "&", "!", "<@", "<#", "<@&"]))
+        elif kind == 4:
+            pieces.append(rng.choice(ids))
+        else:
+            pieces.append(rng.choice([" ", "текст", "\n"]))
+    return "".join(pieces)
+
+
+@pytest.mark.parametrize("text", [
+    "",
+    "Привет, <@8> и <@!8> из <#1> (<@&6>)",
+    "<#99> <@&99> <@99>",             # неразрешимые остаются как есть
+    "<#2>>",                          # имя канала + '>' дает упоминание роли
+    "<#3>>",                          # имя канала + '>' дает упоминание пользователя
+    "<#4>>",                          # имя канала + '>' дает упоминание канала, которое второй раз не заменяется
+    "<<@&7>>",                        # упоминание роли сразу после '<' дает упоминание пользователя
+    "<@&9>>",                         # имя роли + '>' дает упоминание пользователя
+    "<<@&10>>",                       # '<' + '@' + имя роли дает упоминание роли, которое второй раз не заменяется
+    "<#5> <@11> <@12>",               # '>' и '@' в именах пользователей не сцепляются: их проход последний
+    "<<#2>>>",
+])
+def test_matches_three_pass_version(text):
+    guild = use_lookups()
+    assert main.clean_discord_mentions(text, guild) == old_clean_discord_mentions(text, guild)
+    assert main.clean_discord_mentions(text, None) == old_clean_discord_mentions(text, None)
+
+
+def test_random_texts_match_three_pass_version():
+    guild = use_lookups()
+    rng = random.Random(17)
+    resolver = main.MentionResolver()  # общий на все тексты, как в parse_channel_content
+    for _ in range(20000):
+        text = random_text(rng)
+        assert main.clean_discord_mentions(text, guild, resolver) == old_clean_discord_mentions(text, guild), text